@@ -0,0 +1,336 @@
+import numpy as np
+import pandas as pd
+
+# Shapes the anomaly report can be written in. Records are one per failing check
+# per reference, compact reports one per reference, see compact_anomalies.
+ANOMALY_FORMATS = ["records", "compact"]
+
+MARINE_MISMATCH_ISSUE = "Reference should not produce marine data."
+MARINE_SURVEY_CODE = "076"
+MISSING_ISSUE = "{column} missing in lookup."
+
+# Placeholder in the issue of a missing rule replaced by the missing column.
+COLUMN_PLACEHOLDER = "{column}"
+
+# Column of the compact report holding a bitmask of the checks each row failed,
+# with the bit numbered by the code of the check set. Every further CHECK_BITS
+# checks add a column, named by CHECKS_COLUMN and its number.
+CHECKS_COLUMN = "checks"
+CHECK_BITS = 64
+
+# Suffix of the file the code table of a compact report is written to.
+CODE_TABLE_SUFFIX = "_codes"
+
+
+def missing_rule(columns):
+    """
+    Builds a rule flagging references with a null in any of the given columns.
+    :param columns: Columns that must not be null - List(String)
+    :return rule: Anomaly rule - Dict
+    """
+    return {"rule_type": "missing", "columns": list(columns),
+            "issue": MISSING_ISSUE, "report_columns": []}
+
+
+def marine_mismatch_rule(survey_column, check_column, period_column):
+    """
+    Builds a rule flagging references producing marine from a non marine county.
+    :param survey_column: Column that holds the survey code - String
+    :param check_column: Column to check against(marine) - String
+    :param period_column: Column that holds the period - String
+    :return rule: Anomaly rule - Dict
+    """
+    return {"rule_type": "match",
+            "conditions": {survey_column: MARINE_SURVEY_CODE, check_column: "n"},
+            "issue": MARINE_MISMATCH_ISSUE,
+            "report_columns": [survey_column, check_column, period_column]}
+
+
+def build_rules(lookups, marine_mismatch_check, survey_column, period_column,
+                anomaly_rules=None):
+    """
+    Builds the list of anomaly rules for a run from the runtime configuration.
+    :param lookups: Information about lookups, their 'required' columns
+                    become missing column rules - Dict
+    :param marine_mismatch_check: True/False - Should check be done - Boolean
+    :param survey_column: Column that holds the survey code - String
+    :param period_column: Column that holds the period - String
+    :param anomaly_rules: Extra rules declared in the runtime variables - Dict
+    :return rules: Anomaly rules in the order they are reported - List(Dict)
+    """
+    rules = []
+    if marine_mismatch_check:
+        rules.append(marine_mismatch_rule(survey_column, "marine", period_column))
+
+    for lookup in lookups:
+        rules.append(missing_rule(lookups[lookup]["required"]))
+
+    if anomaly_rules:
+        for rule in sorted(anomaly_rules):
+            rules.append(anomaly_rules[rule])
+
+    return rules
+
+
+def rule_issues(rule):
+    """
+    Lists the checks a rule makes. Missing rules make a check per column so that
+    every failing column is reported, with COLUMN_PLACEHOLDER in their issue
+    replaced by the column. Any other braces in the issue are left as they are.
+    :param rule: Anomaly rule - Dict
+    :return checks: (issue, report_columns) per check - List(Tuple)
+    """
+    report_columns = rule.get("report_columns", [])
+
+    if rule["rule_type"] == "missing":
+        issue = rule.get("issue", MISSING_ISSUE)
+        return [(issue.replace(COLUMN_PLACEHOLDER, column), report_columns)
+                for column in rule["columns"]]
+
+    if rule["rule_type"] == "match":
+        return [(rule["issue"], report_columns)]
+
+    raise ValueError(f"Unknown anomaly rule type: {rule['rule_type']}")
+
+
+def rule_checks(data, rule):
+    """
+    Evaluates a rule against the data as boolean masks, one per check.
+    :param data: Enriched data - DataFrame
+    :param rule: Anomaly rule - Dict
+    :return checks: (issue, report_columns, mask) per check - List(Tuple)
+    """
+    issues = rule_issues(rule)
+
+    if rule["rule_type"] == "missing":
+        return [(issue, report_columns, data[column].isnull().to_numpy())
+                for (issue, report_columns), column in zip(issues, rule["columns"])]
+
+    mask = np.ones(len(data), dtype=bool)
+    for column, value in rule["conditions"].items():
+        mask &= (data[column] == value).to_numpy()
+    return [issues[0] + (mask,)]
+
+
+def rule_columns(rules):
+    """
+    Lists the columns the rules read, split by whether their values are needed
+    or only whether they are null.
+    :param rules: Anomaly rules - List(Dict)
+    :return value_columns: Columns compared or reported - Set(String)
+    :return null_columns: Other columns checked for nulls - Set(String)
+    """
+    value_columns = set()
+    null_columns = set()
+    for rule in rules:
+        value_columns.update(rule.get("report_columns", []))
+        if rule["rule_type"] == "missing":
+            null_columns.update(rule["columns"])
+        else:
+            value_columns.update(rule["conditions"])
+    return value_columns, null_columns - value_columns
+
+
+def issue_codes(rules):
+    """
+    Enumerates the checks made by the rules. The code of a check is its position
+    in the order checks are reported, and the bit it sets in the compact report.
+    The codes only depend on the rules, so are the same for every chunk or
+    partition of a run.
+    :param rules: Anomaly rules - List(Dict)
+    :return codes: Issue and report columns of each check, by code - List(Dict)
+    """
+    return [{"code": code, "issue": issue, "report_columns": list(report_columns)}
+            for code, (issue, report_columns) in enumerate(
+                check for rule in rules for check in rule_issues(rule))]
+
+
+def checks_columns(codes):
+    """
+    Names the bitmask columns of the compact report.
+    :param codes: Code table from issue_codes - List(Dict)
+    :return columns: One column per CHECK_BITS checks - List(String)
+    """
+    words = max(1, -(-len(codes) // CHECK_BITS))
+    return [CHECKS_COLUMN] + [f"{CHECKS_COLUMN}_{word}" for word in range(1, words)]
+
+
+def compact_anomalies(data, rules, identifier_column, keep_columns=()):
+    """
+    Evaluates every rule in one pass over the data and builds the compact anomaly
+    report directly from the masks. Each failing row appears once, with its
+    identifier, the values of the columns any check reports and a bitmask of the
+    checks it failed, keeping the row's index and order.
+    :param data: Enriched data - DataFrame
+    :param rules: Anomaly rules - List(Dict)
+    :param identifier_column: Column that holds the unique id of a row - String
+    :param keep_columns: Further columns to keep, such as the period to group
+                         the report by - List(String)
+    :return anomalies: One record per failing reference - DataFrame
+    """
+    checks = [check for rule in rules for check in rule_checks(data, rule)]
+    codes = issue_codes(rules)
+
+    if checks:
+        masks = np.column_stack([mask for _, _, mask in checks])
+    else:
+        masks = np.zeros((len(data), 0), dtype=bool)
+    rows = np.flatnonzero(masks.any(axis=1))
+
+    anomalies = pd.DataFrame(index=data.index[rows])
+    anomalies[identifier_column] = data[identifier_column].to_numpy()[rows]
+    for column in _report_columns(codes) + list(keep_columns):
+        if column not in anomalies.columns:
+            anomalies[column] = data[column].to_numpy()[rows]
+
+    # Distinct powers of two, so summing them sets each failing check's bit.
+    failing = masks[rows].astype(np.uint64)
+    for word, column in enumerate(checks_columns(codes)):
+        block = failing[:, word * CHECK_BITS:(word + 1) * CHECK_BITS]
+        bits = np.left_shift(np.uint64(1), np.arange(block.shape[1], dtype=np.uint64))
+        anomalies[column] = block @ bits
+
+    return anomalies
+
+
+def render_anomalies(anomalies, codes, identifier_column):
+    """
+    Expands a compact anomaly report into one record per failing check per
+    reference, the shape written by earlier versions. Records are ordered by row,
+    then by rule, and only report the columns their check reports.
+    :param anomalies: Compact anomaly report - DataFrame
+    :param codes: Code table from issue_codes - List(Dict)
+    :param identifier_column: Column that holds the unique id of a row - String
+    :return anomalies: One record per failing check per reference - DataFrame
+    """
+    if not codes:
+        return pd.DataFrame(columns=[identifier_column, "issue"])
+
+    failing = _failing_checks(anomalies, codes)
+    rows, check_codes = np.nonzero(failing)
+
+    records = pd.DataFrame(index=anomalies.index[rows])
+    records[identifier_column] = anomalies[identifier_column].to_numpy()[rows]
+    issues = np.array([code["issue"] for code in codes], dtype=object)
+    records["issue"] = issues[check_codes]
+
+    for column in _report_columns(codes):
+        reported = np.array([column in code["report_columns"] for code in codes])
+        values = pd.Series(anomalies[column].to_numpy()[rows], index=records.index)
+        row_reported = reported[check_codes]
+        if not row_reported.all():
+            values = values.where(row_reported)
+        records[column] = values
+
+    return records
+
+
+def detect_anomalies(data, rules, identifier_column):
+    """
+    Evaluates every rule in one pass over the data and builds the anomaly report,
+    one record per failing check per reference. Records are ordered by row, then
+    by rule.
+    :param data: Enriched data - DataFrame
+    :param rules: Anomaly rules - List(Dict)
+    :param identifier_column: Column that holds the unique id of a row - String
+    :return anomalies: One record per failing check per reference - DataFrame
+    """
+    return render_anomalies(compact_anomalies(data, rules, identifier_column),
+                            issue_codes(rules), identifier_column)
+
+
+def issue_count(anomalies, codes):
+    """
+    Counts the failing checks in a compact anomaly report, which is the number of
+    records it renders to.
+    :param anomalies: Compact anomaly report - DataFrame
+    :param codes: Code table from issue_codes - List(Dict)
+    :return count: Number of failing checks - Int
+    """
+    count = 0
+    for column in checks_columns(codes):
+        if column in anomalies.columns:
+            words = np.ascontiguousarray(anomalies[column].to_numpy(dtype=np.uint64))
+            count += int(np.unpackbits(words.view(np.uint8)).sum())
+    return count
+
+
+def summarise_anomalies(anomalies, codes, group_column):
+    """
+    Counts the failing checks of a compact anomaly report by code within each
+    group, such as each period.
+    :param anomalies: Compact anomaly report, keeping group_column - DataFrame
+    :param codes: Code table from issue_codes - List(Dict)
+    :param group_column: Column to group the report by - String
+    :return summary: group_column, code and count of each code failed in each
+                     group, in group then code order - DataFrame
+    """
+    failing = pd.DataFrame(_failing_checks(anomalies, codes).astype(np.int64),
+                           columns=[code["code"] for code in codes])
+    counts = failing.groupby(anomalies[group_column].to_numpy()).sum()
+
+    groups, check_codes = np.nonzero(counts.to_numpy())
+    return pd.DataFrame({
+        group_column: counts.index.to_numpy()[groups],
+        "code": counts.columns.to_numpy()[check_codes],
+        "count": counts.to_numpy()[groups, check_codes],
+    })
+
+
+def code_table(codes, summary, group_column):
+    """
+    Describes a compact anomaly report, to be kept or sent alongside it.
+    :param codes: Code table from issue_codes - List(Dict)
+    :param summary: Counts from summarise_anomalies - DataFrame
+    :param group_column: Column the summary is grouped by - String
+    :return table: Codes and the counts of each in each group - Dict
+    """
+    # Listed column by column, which gives Python rather than numpy values.
+    counts = [dict(zip(summary.columns, values)) for values in
+              zip(*(summary[column].tolist() for column in summary.columns))]
+    return {"codes": codes, "group_column": group_column, "counts": counts}
+
+
+def code_table_location(anomalies_location):
+    """
+    Names the file the code table of a compact anomaly report is written to.
+    :param anomalies_location: Name of the anomalies file in s3 - String
+    :return file_name: Name of the code table in s3 - String
+    """
+    return anomalies_location + CODE_TABLE_SUFFIX
+
+
+def merge_summaries(summaries, group_column):
+    """
+    Adds up summaries of parts of a compact anomaly report, such as its chunks.
+    :param summaries: Counts from summarise_anomalies - List(DataFrame)
+    :param group_column: Column the summaries are grouped by - String
+    :return summary: Counts of the whole report - DataFrame
+    """
+    summaries = [summary for summary in summaries if len(summary) > 0]
+    if not summaries:
+        return pd.DataFrame(columns=[group_column, "code", "count"])
+    return pd.concat(summaries, ignore_index=True)\
+        .groupby([group_column, "code"], sort=True)["count"].sum().reset_index()
+
+
+def _failing_checks(anomalies, codes):
+    # Unpacks the bitmasks into a row by code boolean matrix.
+    columns = []
+    for word, column in enumerate(checks_columns(codes)):
+        width = min(CHECK_BITS, len(codes) - word * CHECK_BITS)
+        # Little endian, so bit n of each word is the nth bit unpacked.
+        words = anomalies[column].to_numpy(dtype="<u8")
+        bits = np.unpackbits(words.view(np.uint8).reshape(-1, 8), axis=1,
+                             bitorder="little")
+        columns.append(bits[:, :width].view(bool))
+    return np.concatenate(columns, axis=1)
+
+
+def _report_columns(codes):
+    columns = []
+    for code in codes:
+        for column in code["report_columns"]:
+            if column not in columns:
+                columns.append(column)
+    return columns
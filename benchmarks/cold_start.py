@@ -0,0 +1,105 @@
+"""
+Measures the start up of a lambda module in a fresh interpreter, as in a new
+container. Run from the repository root with the module to measure, for example
+`PYTHONPATH=. python benchmarks/cold_start.py enrichment_method`, and the times
+in milliseconds are printed as JSON:
+    import_ms - importing the module
+    invalid_ms - the first invocation, with an event that fails validation
+    first_ms - the first successful invocation (method only)
+    warm_ms - a second successful invocation (method only)
+"""
+import importlib
+import json
+import os
+import sys
+import time
+
+bucket_name = "test_bucket"
+
+lookups = {
+    "0": {"file_name": "responder_county_lookup",
+          "columns_to_keep": ["responder_id", "county"],
+          "join_column": "responder_id",
+          "required": ["county"]},
+    "1": {"file_name": "county_marine_lookup",
+          "columns_to_keep": ["county_name", "region", "county", "marine"],
+          "join_column": "county",
+          "required": ["region", "marine"]}
+}
+
+
+class Context:
+    aws_request_id = "cold_start"
+
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+def measure(module_name):
+    """
+    Imports the module and invokes its handler.
+    :param module_name: Name of the lambda module - String
+    :return timings: Milliseconds taken by each step - Dict
+    """
+    timings = {}
+    os.environ["bucket_name"] = bucket_name
+
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    timings["import_ms"] = elapsed_ms(start)
+
+    start = time.perf_counter()
+    try:
+        module.lambda_handler({"RuntimeVariables": {"run_id": "cold_start"}},
+                              Context())
+    except Exception:
+        # The wrangler raises where the method returns the error.
+        pass
+    timings["invalid_ms"] = elapsed_ms(start)
+
+    if module_name != "enrichment_method":
+        return timings
+
+    # Imported after the module, so that they do not count towards its import.
+    import boto3
+    from moto import mock_s3
+
+    with mock_s3():
+        # Setting up the bucket loads the s3 service model, so first_ms only
+        # includes making the client.
+        client = boto3.client("s3", region_name="eu-west-2")
+        client.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={
+            "LocationConstraint": "eu-west-2"})
+        for lookup in lookups.values():
+            with open(f"tests/fixtures/{lookup['file_name']}.json", "rb") as file:
+                client.put_object(Bucket=bucket_name, Body=file.read(),
+                                  Key=lookup["file_name"] + ".json")
+        with open("tests/fixtures/test_method_input.json", "r") as file:
+            data = file.read()
+
+        event = {"RuntimeVariables": {
+            "bpm_queue_url": "fake_queue_url",
+            "data": data,
+            "environment": "sandbox",
+            "identifier_column": "responder_id",
+            "lookups": lookups,
+            "marine_mismatch_check": True,
+            "period_column": "period",
+            "run_id": "cold_start",
+            "survey": "BMI_SG",
+            "survey_column": "survey"}}
+
+        for name in ["first_ms", "warm_ms"]:
+            start = time.perf_counter()
+            output = module.lambda_handler(json.loads(json.dumps(event)), Context())
+            timings[name] = elapsed_ms(start)
+            if not output["success"]:
+                raise RuntimeError(output["error"])
+
+    return timings
+
+
+if __name__ == "__main__":
+    print(json.dumps(measure(sys.argv[1] if len(sys.argv) > 1
+                             else "enrichment_method")))
@@ -0,0 +1,122 @@
+import functools
+import json
+
+import numpy as np
+import pandas as pd
+
+fixtures = "tests/fixtures/"
+
+# Numeric survey questions, as in test_method_input.json.
+questions = ["Q601_asphalting_sand", "Q602_building_soft_sand", "Q603_concreting_sand",
+             "Q604_bituminous_gravel", "Q605_concreting_gravel", "Q606_other_gravel",
+             "Q607_constructional_fill"]
+
+# Share of responders found in the responder lookup.
+responder_coverage = 0.95
+
+
+@functools.lru_cache(maxsize=None)
+def synthesise_input(rows):
+    """
+    Builds survey data with the columns of test_method_input.json. Codes are drawn
+    from the lookup fixtures so that most rows are enriched.
+    :param rows: Number of rows - Int
+    :return data: Survey data - DataFrame
+    """
+    random = np.random.RandomState(rows)
+    regions = pd.read_json(fixtures + "region_lookup.json")
+
+    data = pd.DataFrame({
+        question: random.choice([0, 0, 0, 500, 2000, 20000], rows)
+        for question in questions})
+    data["Q608_total"] = data[questions].sum(axis=1)
+    data["enterprise_ref"] = random.randint(1, max(rows // 10, 2), rows)
+    data["gor_code"] = random.choice(regions["gor_code"], rows)
+    data["name"] = [f"Responder{number}" for number in range(rows)]
+    data["period"] = random.choice([201809, 201812], rows)
+    data["responder_id"] = random.permutation(rows) + 10000
+    data["response_type"] = random.choice([1, 2], rows)
+    data["survey"] = random.choice(["066", "076"], rows)
+    return data
+
+
+@functools.lru_cache(maxsize=None)
+def synthesise_lookups(rows):
+    """
+    Builds up to five lookups for data from synthesise_input. The first three
+    follow the Sand & Gravel chain responder -> county -> marine/region plus the
+    region names, the others join on the enterprise and survey.
+    :param rows: Number of rows in the data - Int
+    :return lookups: Lookup configuration, keyed "0" to "4" - Dict
+    :return files: Contents of each lookup file, by file name - Dict
+    """
+    random = np.random.RandomState(rows + 1)
+    counties = pd.read_json(fixtures + "county_marine_lookup.json")
+
+    covered = int(rows * responder_coverage)
+    files = {
+        "bench_responder_county_lookup": pd.DataFrame({
+            "responder_id": np.arange(covered) + 10000,
+            "county": random.choice(counties["county"], covered)}),
+        "bench_county_marine_lookup": counties,
+        "bench_region_lookup": pd.read_json(fixtures + "region_lookup.json"),
+        "bench_enterprise_lookup": pd.DataFrame({
+            "enterprise_ref": np.arange(1, max(rows // 10, 2)),
+            "enterprise_name": [f"Enterprise{number}"
+                                for number in range(1, max(rows // 10, 2))]}),
+        "bench_survey_lookup": pd.DataFrame({
+            "survey": ["066", "076"],
+            "survey_name": ["Sand & Gravel (Land)", "Sand & Gravel (Marine)"]}),
+    }
+
+    lookups = {
+        "0": {"file_name": "bench_responder_county_lookup",
+              "columns_to_keep": ["responder_id", "county"],
+              "join_column": "responder_id",
+              "required": ["county"]},
+        "1": {"file_name": "bench_county_marine_lookup",
+              "columns_to_keep": ["county_name", "region", "county", "marine"],
+              "join_column": "county",
+              "required": ["region", "marine"]},
+        "2": {"file_name": "bench_region_lookup",
+              "columns_to_keep": ["gor_code", "region_name"],
+              "join_column": "gor_code",
+              "required": ["region_name"]},
+        "3": {"file_name": "bench_enterprise_lookup",
+              "columns_to_keep": ["enterprise_ref", "enterprise_name"],
+              "join_column": "enterprise_ref",
+              "required": ["enterprise_name"]},
+        "4": {"file_name": "bench_survey_lookup",
+              "columns_to_keep": ["survey", "survey_name"],
+              "join_column": "survey",
+              "required": ["survey_name"]},
+    }
+    return lookups, {file_name: data.to_json(orient="records")
+                     for file_name, data in files.items()}
+
+
+def upload(client, bucket_name, rows):
+    """
+    Uploads the synthetic input and lookups to a (mocked) bucket.
+    :param client: s3 client - botocore.client.S3
+    :param bucket_name: Name of the s3 bucket - String
+    :param rows: Number of rows in the data - Int
+    :return lookups: Lookup configuration - Dict
+    """
+    lookups, files = synthesise_lookups(rows)
+    for file_name, body in files.items():
+        client.put_object(Bucket=bucket_name, Key=file_name + ".json", Body=body)
+    client.put_object(Bucket=bucket_name, Key=f"bench_input_{rows}.json",
+                      Body=synthesise_input(rows).to_json(orient="records"))
+    return lookups
+
+
+def first_lookups(lookups, count):
+    """
+    Takes the first count lookups, in the parsed form the method uses.
+    :param lookups: Lookup configuration - Dict
+    :param count: Number of lookups - Int
+    :return lookups: Lookup configuration keyed by integer - Dict
+    """
+    return {int(key): json.loads(json.dumps(lookups[key]))
+            for key in sorted(lookups)[:count]}
@@ -0,0 +1,23 @@
+import pytest
+
+import compression_functions
+import synthetic_data
+
+row_counts = [10000, 100000]
+
+
+@pytest.mark.parametrize("compression", [None] + compression_functions.COMPRESSIONS)
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_payload_compression(benchmark, rows, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    records = synthetic_data.synthesise_input(rows).to_json(orient="records")
+
+    def round_trip():
+        return compression_functions.decode_text(
+            compression_functions.encode_text(records, compression))
+
+    benchmark(round_trip)
+    encoded = compression_functions.encode_text(records, compression)
+    benchmark.extra_info["payload_bytes"] = len(encoded)
+    benchmark.extra_info["ratio"] = len(records) / len(encoded)
@@ -0,0 +1,249 @@
+import functools
+import json
+import resource
+import tracemalloc
+from unittest import mock
+
+import pandas as pd
+import pytest
+from es_aws_functions import test_generic_library
+from moto import mock_s3
+
+import anomaly_functions
+import disk_cache_functions
+import enrichment_method
+import enrichment_wrangler
+import lookup_functions
+import synthetic_data
+
+bucket_name = "test_bucket"
+
+row_counts = [1000, 10000, 100000, 1000000]
+lookup_counts = [1, 2, 3, 4, 5]
+
+# Fewer rounds for the larger inputs keeps the suite to a few minutes.
+rounds = {1000: 20, 10000: 10, 100000: 5, 1000000: 3}
+
+# Lookups uploaded for each input size, while the module's mocked s3 is up.
+uploaded = {}
+
+runtime_variables = {
+    "bpm_queue_url": "fake_queue_url",
+    "environment": "sandbox",
+    "marine_mismatch_check": True,
+    "period_column": "period",
+    "survey": "BMI_SG",
+    "survey_column": "survey",
+    "identifier_column": "responder_id",
+    "run_id": "bench"
+}
+
+
+@pytest.fixture(scope="module")
+def s3_client():
+    """
+    Starts a mocked s3 with a bucket that stays up for the whole module, so each
+    input size is only uploaded once.
+    :return client: s3 client - botocore.client.S3
+    """
+    with mock_s3():
+        client = test_generic_library.create_bucket(bucket_name)
+        uploaded.clear()
+        yield client
+
+
+def uploaded_lookups(client, rows):
+    """
+    Uploads the synthetic data for rows, unless already done.
+    :param client: s3 client from the s3_client fixture - botocore.client.S3
+    :param rows: Number of rows in the data - Int
+    :return lookups: Lookup configuration - Dict
+    """
+    if rows not in uploaded:
+        uploaded[rows] = synthetic_data.upload(client, bucket_name, rows)
+    return uploaded[rows]
+
+
+def record_memory(benchmark, function, *args):
+    """
+    Runs function once more with tracemalloc, outside the timed rounds, and saves
+    its peak traced allocation and the peak RSS of the process with the results.
+    :param benchmark: pytest-benchmark fixture
+    :param function: Function being benchmarked
+    :param args: Arguments for function
+    """
+    tracemalloc.start()
+    function(*args)
+    benchmark.extra_info["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    benchmark.extra_info["max_rss_kb"] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def enriched(client, rows):
+    """
+    Enriches the synthetic data with all five lookups.
+    :param client: s3 client from the s3_client fixture - botocore.client.S3
+    :param rows: Number of rows in the data - Int
+    :return data: Enriched data - DataFrame
+    """
+    lookups = synthetic_data.first_lookups(uploaded_lookups(client, rows), 5)
+    data, _ = enrichment_method.data_enrichment(
+        synthetic_data.synthesise_input(rows), True, "survey", "period", bucket_name,
+        lookups, "responder_id")
+    return data
+
+
+@pytest.mark.parametrize("cache", ["cold", "disk", "warm"])
+@pytest.mark.parametrize("lookup_count", lookup_counts)
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_data_enrichment(benchmark, monkeypatch, tmp_path, s3_client, rows,
+                                   lookup_count, cache):
+    lookups = synthetic_data.first_lookups(uploaded_lookups(s3_client, rows),
+                                           lookup_count)
+    data = synthetic_data.synthesise_input(rows)
+    # The marine column comes from the second lookup.
+    arguments = (data, lookup_count > 1, "survey", "period", bucket_name, lookups,
+                 "responder_id")
+    disk = disk_cache_functions.DiskCache(str(tmp_path))
+    monkeypatch.setattr(lookup_functions, "lookup_cache",
+                        lookup_functions.LookupCache(disk=disk))
+
+    def setup():
+        if cache == "cold":
+            lookup_functions.lookup_cache.clear()
+        elif cache == "disk":
+            # As if evicted from memory, or in a warm container whose memory
+            # cache was too small to keep it.
+            monkeypatch.setattr(lookup_functions, "lookup_cache",
+                                lookup_functions.LookupCache(disk=disk))
+
+    setup()
+    record_memory(benchmark, enrichment_method.data_enrichment, *arguments)
+    benchmark.pedantic(enrichment_method.data_enrichment, args=arguments,
+                       setup=setup, rounds=rounds[rows])
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_do_merge(benchmark, s3_client, rows):
+    uploaded_lookups(s3_client, rows)
+    arguments = (synthetic_data.synthesise_input(rows),
+                 "bench_responder_county_lookup", ["responder_id", "county"],
+                 "responder_id", bucket_name)
+
+    record_memory(benchmark, enrichment_method.do_merge, *arguments)
+    benchmark.pedantic(enrichment_method.do_merge, args=arguments, rounds=rounds[rows])
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_marine_mismatch_detector(benchmark, s3_client, rows):
+    arguments = (enriched(s3_client, rows), "survey", "marine", "period",
+                 "responder_id")
+
+    record_memory(benchmark, enrichment_method.marine_mismatch_detector, *arguments)
+    benchmark.pedantic(enrichment_method.marine_mismatch_detector, args=arguments,
+                       rounds=rounds[rows])
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_missing_column_detector(benchmark, s3_client, rows):
+    arguments = (enriched(s3_client, rows),
+                 ["county", "region", "marine", "region_name", "enterprise_name",
+                  "survey_name"],
+                 "responder_id")
+
+    record_memory(benchmark, enrichment_method.missing_column_detector, *arguments)
+    benchmark.pedantic(enrichment_method.missing_column_detector, args=arguments,
+                       rounds=rounds[rows])
+
+
+@pytest.mark.parametrize("anomaly_format", anomaly_functions.ANOMALY_FORMATS)
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_detect_anomalies(benchmark, s3_client, rows, anomaly_format):
+    lookups = synthetic_data.first_lookups(uploaded_lookups(s3_client, rows), 5)
+    rules = anomaly_functions.build_rules(lookups, True, "survey", "period")
+    if anomaly_format == "compact":
+        function = anomaly_functions.compact_anomalies
+    else:
+        function = anomaly_functions.detect_anomalies
+    arguments = (enriched(s3_client, rows), rules, "responder_id")
+
+    record_memory(benchmark, function, *arguments)
+    benchmark.extra_info["encoded_bytes"] = \
+        len(function(*arguments).to_json(orient="records"))
+    benchmark.pedantic(function, args=arguments, rounds=rounds[rows])
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_json_decode(benchmark, rows):
+    data = synthetic_data.synthesise_input(rows).to_json(orient="records")
+
+    record_memory(benchmark, pd.read_json, data)
+    benchmark.pedantic(pd.read_json, args=(data,), kwargs={"dtype": False},
+                       rounds=rounds[rows])
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_json_encode(benchmark, s3_client, rows):
+    data = enriched(s3_client, rows)
+
+    record_memory(benchmark, lambda: data.to_json(orient="records"))
+    benchmark.pedantic(data.to_json, kwargs={"orient": "records"},
+                       rounds=rounds[rows])
+
+
+@pytest.mark.parametrize("validate_only", [False, True])
+@pytest.mark.parametrize("mode", ["inline", "reference"])
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_lambda_handler(benchmark, s3_client, rows, mode, validate_only):
+    if mode == "inline" and rows > 100000:
+        pytest.skip("Inputs this large are always passed by reference.")
+
+    event = {"RuntimeVariables": dict(runtime_variables,
+                                      lookups=uploaded_lookups(s3_client, rows),
+                                      validate_only=validate_only)}
+    if mode == "inline":
+        event["RuntimeVariables"]["data"] = \
+            synthetic_data.synthesise_input(rows).to_json(orient="records")
+    else:
+        event["RuntimeVariables"].update({
+            "in_location": f"bench_input_{rows}",
+            "out_location": f"bench_output_{rows}",
+            "anomalies_location": f"bench_anomalies_{rows}"})
+
+    def run():
+        output = enrichment_method.lambda_handler(json.loads(json.dumps(event)),
+                                                  test_generic_library.context_object)
+        assert output["success"], output
+        return output
+
+    with mock.patch.dict(enrichment_method.os.environ, {"bucket_name": bucket_name}):
+        record_memory(benchmark, run)
+        benchmark.pedantic(run, rounds=rounds[rows])
+
+
+@pytest.mark.parametrize("upload", ["single", "multipart"])
+@pytest.mark.parametrize("writes", ["sequential", "concurrent"])
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_wrangler_write_output(benchmark, monkeypatch, s3_client, rows,
+                                         writes, upload):
+    data = synthetic_data.synthesise_input(rows)
+    # The data and anomalies the method passes back, anomalies being a row in ten.
+    texts = [data.to_json(orient="records"),
+             data[::10].to_json(orient="records")]
+    if upload == "single":
+        monkeypatch.setattr(enrichment_wrangler, "MULTIPART_THRESHOLD", float("inf"))
+    else:
+        monkeypatch.setattr(enrichment_wrangler, "MULTIPART_THRESHOLD", 0)
+
+    def run():
+        if writes == "sequential":
+            return sum(enrichment_wrangler.write_output(bucket_name, file_name, text)
+                       for file_name, text in zip(["out", "anomalies"], texts))
+        return enrichment_wrangler.write_concurrently([
+            functools.partial(enrichment_wrangler.write_output, bucket_name,
+                              file_name, text)
+            for file_name, text in zip(["out", "anomalies"], texts)])
+
+    record_memory(benchmark, run)
+    benchmark.pedantic(run, rounds=rounds[rows])
@@ -0,0 +1,48 @@
+import json
+
+import pandas as pd
+import pytest
+
+import json_functions
+import synthetic_data
+
+row_counts = [10000, 100000]
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_read_json(benchmark, rows):
+    records = synthetic_data.synthesise_input(rows).to_json(orient="records")
+
+    benchmark(pd.read_json, records, dtype=False)
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_read_records(benchmark, rows):
+    records = synthetic_data.synthesise_input(rows).to_json(orient="records")
+
+    benchmark(json_functions.read_records, records)
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_payload_as_string(benchmark, rows):
+    records = synthetic_data.synthesise_input(rows).to_json(orient="records")
+
+    def round_trip():
+        payload = json.dumps({"RuntimeVariables": {"data": records}})
+        return pd.read_json(json.loads(payload)["RuntimeVariables"]["data"],
+                            dtype=False)
+
+    benchmark(round_trip)
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_payload_as_records(benchmark, rows):
+    records = synthetic_data.synthesise_input(rows).to_json(orient="records")
+
+    def round_trip():
+        payload = json_functions.dumps_payload({"RuntimeVariables": {}}, records)
+        # As the lambda runtime parses the event.
+        return json_functions.read_records(
+            json.loads(payload)["RuntimeVariables"]["data"])
+
+    benchmark(round_trip)
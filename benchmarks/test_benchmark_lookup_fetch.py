@@ -0,0 +1,62 @@
+import time
+
+import boto3
+import pandas as pd
+import pytest
+from es_aws_functions import test_generic_library
+from moto import mock_s3
+
+import lookup_functions
+import startup_functions
+
+bucket_name = "test_bucket"
+
+# Latency added to every s3 request, as moto answers almost instantly.
+request_latency = 0.05
+
+lookup_counts = [1, 2, 4, 8]
+
+
+def add_latency(**_):
+    """
+    Sleeps before an s3 request is sent.
+    """
+    time.sleep(request_latency)
+
+
+def upload_lookups(count):
+    """
+    Uploads count small lookups to the mocked bucket.
+    :param count: Number of lookups - Int
+    :return lookups: Lookup configuration - List(Dict)
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    lookups = []
+    for number in range(count):
+        file_name = f"lookup_{number}"
+        data = pd.DataFrame({"county": range(100), f"value_{number}": range(100)})
+        client.put_object(Bucket=bucket_name, Key=file_name + ".json",
+                          Body=data.to_json(orient="records"))
+        lookups.append({"file_name": file_name, "join_column": "county",
+                        "columns_to_keep": ["county", f"value_{number}"]})
+    return lookups
+
+
+@pytest.mark.parametrize("max_workers", [1, lookup_functions.DEFAULT_FETCH_WORKERS])
+@pytest.mark.parametrize("count", lookup_counts)
+@mock_s3
+def test_benchmark_get_tables(benchmark, count, max_workers):
+    lookups = upload_lookups(count)
+    cache = lookup_functions.LookupCache()
+
+    # Clients come from the default session, and are made again to pick up the
+    # latency.
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register("before-send.s3", add_latency)
+    startup_functions.reset()
+
+    benchmark.pedantic(cache.get_tables, args=(bucket_name, lookups, max_workers),
+                       setup=cache.clear, rounds=5)
+
+    boto3.DEFAULT_SESSION.events.unregister("before-send.s3", add_latency)
+    startup_functions.reset()
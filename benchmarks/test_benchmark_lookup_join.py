@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import lookup_functions
+
+row_counts = [10000, 100000, 1000000]
+
+
+def synthesise(rows):
+    """
+    Builds survey data and a responder lookup covering 90% of the responders.
+    :param rows: Number of rows of survey data - Int
+    :return data: Survey data - DataFrame
+    :return lookup: Responder to county lookup - DataFrame
+    """
+    random = np.random.RandomState(rows)
+    responders = np.arange(rows) + 10000
+    data = pd.DataFrame({
+        "responder_id": random.permutation(responders),
+        "period": 201809,
+        "survey": random.choice(["066", "076"], rows),
+        "Q608_total": random.randint(0, 100000, rows),
+    })
+    lookup = pd.DataFrame({
+        "responder_id": responders[:int(rows * 0.9)],
+        "county": random.randint(1, 50, int(rows * 0.9)),
+    })
+    return data, lookup
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_merge(benchmark, rows):
+    data, lookup = synthesise(rows)
+
+    benchmark(pd.merge, data, lookup, on="responder_id", how="left")
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_lookup_table_build_and_enrich(benchmark, rows):
+    data, lookup = synthesise(rows)
+
+    def build_and_enrich():
+        table = lookup_functions.LookupTable(lookup, "responder_id",
+                                             ["responder_id", "county"])
+        return table.enrich(data)
+
+    benchmark(build_and_enrich)
+
+
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_lookup_table_enrich(benchmark, rows):
+    data, lookup = synthesise(rows)
+    table = lookup_functions.LookupTable(lookup, "responder_id",
+                                         ["responder_id", "county"])
+
+    benchmark(table.enrich, data)
+
+
+@pytest.mark.parametrize("index", ["hashed", "direct"])
+@pytest.mark.parametrize("rows", row_counts)
+def test_benchmark_integer_key_index(benchmark, monkeypatch, rows, index):
+    data, lookup = synthesise(rows)
+    if index == "hashed":
+        monkeypatch.setattr(lookup_functions, "DIRECT_ADDRESS_MAX_SPAN", 0)
+
+    def build_and_find():
+        table = lookup_functions.LookupTable(lookup, "responder_id",
+                                             ["responder_id", "county"])
+        return table, table.positions(data["responder_id"])
+
+    table, _ = benchmark(build_and_find)
+
+    # The hashed index is only built once it is first searched.
+    benchmark.extra_info["index_bytes"] = int(table.index.memory_usage(deep=True))
+    if table._direct_index is not None:
+        benchmark.extra_info["index_bytes"] += table._direct_index.nbytes
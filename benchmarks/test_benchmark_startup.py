@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Each round starts a new interpreter, as lambda does for a new container.
+rounds = 5
+
+
+@pytest.mark.parametrize("module_name", ["enrichment_method", "enrichment_wrangler"])
+def test_benchmark_cold_start(benchmark, module_name):
+    environ = dict(os.environ)
+    environ["PYTHONPATH"] = os.pathsep.join(
+        [os.getcwd()] + [path for path in [environ.get("PYTHONPATH")] if path])
+
+    def run():
+        output = subprocess.run(
+            [sys.executable, "benchmarks/cold_start.py", module_name], env=environ,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return json.loads(output.stdout)
+
+    timings = benchmark.pedantic(run, rounds=rounds)
+    benchmark.extra_info.update(timings)
@@ -0,0 +1,40 @@
+import argparse
+import json
+
+import composite_functions
+from enrichment_method import LookupSchema
+
+
+def main(args=None):
+    """
+    Builds a composite lookup artefact from the command line, for the method to
+    use in place of the lookups it is built from.
+    :param args: Command line arguments, taken from sys.argv if None - List(String)
+    :return manifest: Details of the stored artefact - Dict
+    """
+    parser = argparse.ArgumentParser(
+        description="Join a chain of lookups into one composite lookup in s3.")
+    parser.add_argument("config",
+                        help="JSON file holding the lookups, or runtime variables "
+                             "with a 'lookups' section")
+    parser.add_argument("--bucket", required=True, help="s3 bucket of the lookups")
+    parser.add_argument("--name", required=True,
+                        help="Name of the artefact, as given in composite_lookup")
+    parser.add_argument("--join-column", default="responder_id",
+                        help="Column the composite is keyed on")
+    arguments = parser.parse_args(args)
+
+    with open(arguments.config, "r") as file:
+        config = json.load(file)
+    lookups = LookupSchema(many=True).load(list(config.get("lookups", config).values()))
+
+    manifest = composite_functions.build_artefact(
+        arguments.bucket, dict(enumerate(lookups)), arguments.name,
+        arguments.join_column)
+
+    print(json.dumps(manifest, indent=2))
+    return manifest
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import hashlib
+import json
+
+from pandas.api.types import pandas_dtype
+
+import io_functions
+import lookup_functions
+import plan_functions
+import startup_functions
+
+# Format the composite artefacts are stored in.
+ARTEFACT_FORMAT = "arrow"
+
+
+def lookups_hash(bucket_name, lookups):
+    """
+    Hashes the configuration and current ETag of each lookup, so that the hash
+    changes if a lookup file is replaced or is joined differently.
+    :param bucket_name: Name of the s3 bucket - String
+    :param lookups: Information about each lookup, in join order - List(Dict)
+    :return content_hash: Hex digest - String
+    """
+    client = startup_functions.client("s3")
+    sources = []
+    for lookup in lookups:
+        file_format = io_functions.file_format_for(lookup["file_name"],
+                                                   lookup.get("file_format"))
+        head = client.head_object(
+            Bucket=bucket_name, Key=io_functions.s3_key(lookup["file_name"],
+                                                        file_format))
+        sources.append({"file_name": lookup["file_name"],
+                        "file_format": file_format,
+                        "join_column": lookup["join_column"],
+                        "columns_to_keep": lookup["columns_to_keep"],
+                        "etag": head["ETag"]})
+
+    return hashlib.sha256(json.dumps(sources, sort_keys=True).encode("utf-8"))\
+        .hexdigest()
+
+
+def build_artefact(bucket_name, lookups, name, join_column):
+    """
+    Joins the chain of lookups rooted at join_column into one composite table and
+    stores it in s3, along with a manifest named after the artefact holding the
+    hash of the lookups it was built from.
+    :param bucket_name: Name of the s3 bucket - String
+    :param lookups: Information about lookups required. - Dict
+    :param name: Name of the artefact, the manifest is saved as name.json - String
+    :param join_column: Column the composite is keyed on - String
+    :return manifest: Details of the stored artefact - Dict
+    """
+    join_plan = plan_functions.build_join_plan(lookups)
+    steps = [step for step in join_plan["steps"] if step["join_column"] == join_column]
+    if not steps:
+        raise ValueError(f"No lookups join on {join_column}.")
+
+    step_lookups = [lookups[lookup] for lookup in steps[0]["lookups"]]
+
+    # Hashed before reading, so a lookup replaced during the build makes the
+    # artefact stale rather than wrongly current.
+    content_hash = lookups_hash(bucket_name, step_lookups)
+    tables = lookup_functions.lookup_cache.get_tables(bucket_name, step_lookups)
+    composite = lookup_functions.CompositeTable(tables, join_column)
+
+    file_name = f"{name}-{content_hash[:16]}{io_functions.FILE_FORMATS[ARTEFACT_FORMAT]}"
+    io_functions.write_dataframe(bucket_name, file_name, composite.data,
+                                 ARTEFACT_FORMAT)
+
+    manifest = {
+        "hash": content_hash,
+        "file_name": file_name,
+        "join_column": join_column,
+        "columns": composite.value_columns,
+        "dtypes": {column: str(dtype) for column, dtype in composite.dtypes.items()},
+        "lookups": [lookup["file_name"] for lookup in step_lookups],
+    }
+    client = startup_functions.client("s3")
+    client.put_object(Bucket=bucket_name, Key=name + ".json",
+                      Body=json.dumps(manifest, indent=2))
+    return manifest
+
+
+def get_artefact_tables(bucket_name, name, lookups, join_plan):
+    """
+    Gets the stored composite for the step of the plan it was built for, if the
+    lookups of that step still hash to the same value.
+    :param bucket_name: Name of the s3 bucket - String
+    :param name: Name of the artefact - String
+    :param lookups: Information about lookups required. - Dict
+    :param join_plan: Plan from build_join_plan - Dict
+    :return tables: Composite for the join column of the step it replaces, empty if
+                    the artefact is stale - Dict
+    """
+    client = startup_functions.client("s3")
+    manifest = json.loads(client.get_object(Bucket=bucket_name,
+                                            Key=name + ".json")["Body"].read())
+
+    for step in join_plan["steps"]:
+        if step["join_column"] != manifest["join_column"]:
+            continue
+
+        step_lookups = [lookups[lookup] for lookup in step["lookups"]]
+        if lookups_hash(bucket_name, step_lookups) != manifest["hash"]:
+            break
+
+        table = lookup_functions.lookup_cache.get_table(
+            bucket_name, manifest["file_name"], manifest["join_column"],
+            [manifest["join_column"]] + manifest["columns"], ARTEFACT_FORMAT,
+            {column: pandas_dtype(dtype)
+             for column, dtype in manifest["dtypes"].items()})
+        return {step["join_column"]: table}
+
+    return {}
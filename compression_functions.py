@@ -0,0 +1,172 @@
+import base64
+import gzip
+import zlib
+
+# Compressions that can be requested in the runtime variables.
+COMPRESSIONS = ["gzip", "zstd"]
+
+# Bytes each compression starts its output with, which is how compressed data is
+# recognised when it is read.
+MAGIC_BYTES = {
+    "gzip": b"\x1f\x8b",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+
+# Levels that favour speed, as data is compressed once and read once.
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+_MAGIC_LENGTH = max(len(magic) for magic in MAGIC_BYTES.values())
+
+# Characters the base64 of compressed data starts with, being those made only from
+# magic bytes. JSON text never starts with a letter.
+_BASE64_PREFIXES = tuple(base64.b64encode(magic).decode("ascii")[:len(magic) * 8 // 6]
+                         for magic in MAGIC_BYTES.values())
+
+
+def _zstandard():
+    # Imported here as zstandard is only needed when zstd is requested or read.
+    import zstandard
+    return zstandard
+
+
+def detect(body):
+    """
+    Works out how data was compressed from the bytes it starts with.
+    :param body: Data that may be compressed - Bytes
+    :return compression: One of COMPRESSIONS, or None if not compressed - String
+    """
+    for compression, magic in MAGIC_BYTES.items():
+        if body[:len(magic)] == magic:
+            return compression
+    return None
+
+
+def compress(body, compression):
+    """
+    Compresses data.
+    :param body: Data to compress - Bytes
+    :param compression: One of COMPRESSIONS, or None to leave it as it is - String
+    :return body: Compressed data - Bytes
+    """
+    if compression is None:
+        return body
+    if compression == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return _zstandard().ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+
+
+def decompress(body):
+    """
+    Decompresses data if it starts with the magic bytes of a compression,
+    otherwise returns it as it is.
+    :param body: Data that may be compressed - Bytes
+    :return body: Uncompressed data - Bytes
+    """
+    compression = detect(body)
+    if compression == "gzip":
+        return gzip.decompress(body)
+    if compression == "zstd":
+        # Streamed, as the frame may not record its uncompressed size.
+        return _zstandard().ZstdDecompressor().decompressobj().decompress(body)
+    return body
+
+
+def compressor(compression):
+    """
+    Makes an object that compresses data a piece at a time, with compress and
+    flush methods as zlib's compression objects have.
+    :param compression: One of COMPRESSIONS - String
+    :return compressor: Compression object - Object
+    """
+    if compression == "gzip":
+        # wbits of 16 + 15 writes a gzip header and trailer.
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return _zstandard().ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+def open_stream(stream):
+    """
+    Wraps a file object so that reading it gives the uncompressed data, working
+    out the compression from its first bytes.
+    :param stream: File object with a read method - File
+    :return stream: File object with a read method - File
+    """
+    head = b""
+    while len(head) < _MAGIC_LENGTH:
+        chunk = stream.read(_MAGIC_LENGTH - len(head))
+        if not chunk:
+            break
+        head += chunk
+
+    stream = _PrefixedStream(head, stream)
+    compression = detect(head)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if compression == "zstd":
+        return _zstandard().ZstdDecompressor().stream_reader(stream)
+    return stream
+
+
+def encode_text(text, compression):
+    """
+    Compresses text to be passed inside a JSON payload, as base64.
+    :param text: Text to compress - String
+    :param compression: One of COMPRESSIONS, or None to leave it as it is - String
+    :return text: Base64 of the compressed text, or the text - String
+    """
+    if compression is None:
+        return text
+    return base64.b64encode(compress(text.encode("utf-8"), compression))\
+        .decode("ascii")
+
+
+def decode_bytes(text):
+    """
+    Gets the compressed bytes of text made by encode_text.
+    :param text: Text from encode_text - String
+    :return body: Compressed data, or None if the text was not compressed - Bytes
+    """
+    if not text.startswith(_BASE64_PREFIXES):
+        return None
+    return base64.b64decode(text)
+
+
+def decode_text(text):
+    """
+    Reverses encode_text, returning text that was not compressed as it is.
+    :param text: Text from encode_text - String
+    :return text: Uncompressed text - String
+    """
+    body = decode_bytes(text)
+    if body is None:
+        return text
+    return decompress(body).decode("utf-8")
+
+
+class _PrefixedStream:
+    """
+    File object reading some bytes already taken from a stream, then the rest of
+    the stream.
+    """
+
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._stream.read() if size is None or size < 0 else \
+                self._stream.read(size)
+
+        if size is None or size < 0:
+            data = self._head + self._stream.read()
+            self._head = b""
+            return data
+
+        data = self._head[:size]
+        self._head = self._head[size:]
+        return data
+
+    def readable(self):
+        return True
@@ -0,0 +1,214 @@
+import hashlib
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+# Directory the lookups are kept in, on the lambda's ephemeral storage.
+DEFAULT_DISK_CACHE_DIR = os.path.join(tempfile.gettempdir(), "enrichment_lookups")
+
+# Default upper bound on the space taken by the kept lookups (256 MB), half the
+# ephemeral storage a lambda has unless configured otherwise.
+DEFAULT_DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Changed whenever the files are written differently, so that files written by
+# an earlier version are never read.
+DISK_CACHE_VERSION = 1
+
+# Key of the schema metadata holding what a file was written from.
+METADATA_KEY = b"enrichment_lookup"
+
+_SUFFIX = ".arrow"
+
+
+class DiskCache:
+    """
+    Keeps lookups as uncompressed Arrow IPC files on the lambda's ephemeral
+    storage, named by a hash of the bucket and file name and the ETag the lookup
+    was read at, so that a replaced lookup is never read from an older file.
+    The files are memory-mapped when read, so numeric columns without nulls are
+    used where they lie in the file rather than parsed onto the heap.
+    Files are written under a temporary name and renamed into place, so a file
+    is either whole or absent, and a file removed while mapped stays readable
+    by whoever mapped it. Least recently used files are removed once the files
+    exceed max_bytes, and a max_bytes of 0 turns the cache off. The cache is also
+    off when pyarrow is not installed, leaving lookups to the memory cache.
+    """
+
+    def __init__(self, directory=DEFAULT_DISK_CACHE_DIR,
+                 max_bytes=DEFAULT_DISK_CACHE_MAX_BYTES):
+        self.directory = os.path.join(directory, f"v{DISK_CACHE_VERSION}")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Looked for rather than imported, as pyarrow is slow to import and is
+        # only needed once a lookup is kept.
+        self._pyarrow_installed = importlib.util.find_spec("pyarrow") is not None
+
+    @property
+    def enabled(self):
+        return self._pyarrow_installed and self.max_bytes > 0
+
+    def holds(self, bucket_name, file_name):
+        """
+        Checks whether any version of a lookup is kept.
+        :param bucket_name: Name of the s3 bucket - String
+        :param file_name: Name of the lookup file in s3 - String
+        :return holds: Whether a file is kept for the lookup - Boolean
+        """
+        return len(self._versions(bucket_name, file_name)) > 0
+
+    def load(self, bucket_name, file_name, etag, columns=None):
+        """
+        Memory-maps the kept copy of a lookup, removing any kept at other ETags.
+        :param bucket_name: Name of the s3 bucket - String
+        :param file_name: Name of the lookup file in s3 - String
+        :param etag: Current ETag of the lookup - String
+        :param columns: Columns needed from the lookup, or None for all - List(String)
+        :return data: Lookup data, or None if no kept copy is current and holds the
+                      columns - DataFrame
+        :return details: 'columns' and 'content_length' the copy was written with
+                         - Dict
+        """
+        path = self._path(bucket_name, file_name, etag)
+        for stale in self._versions(bucket_name, file_name):
+            if stale != path:
+                _remove(stale)
+
+        # Imported here as pyarrow is only needed once a lookup has been kept.
+        import pyarrow
+        import pyarrow.ipc
+
+        try:
+            table = pyarrow.ipc.open_file(pyarrow.memory_map(path, "r")).read_all()
+        except (OSError, pyarrow.ArrowException):
+            _remove(path)
+            return None, None
+
+        details = json.loads(table.schema.metadata[METADATA_KEY])
+        if columns is None and details["columns"] is not None or \
+                columns is not None and not set(columns).issubset(table.column_names):
+            return None, None
+
+        if columns is not None:
+            table = pyarrow.table({column: table.column(column)
+                                   for column in columns})
+        # Marked as used, so the least recently used files are removed first.
+        os.utime(path)
+        return _to_pandas(table), details
+
+    def store(self, bucket_name, file_name, etag, data, columns, content_length):
+        """
+        Writes a lookup and memory-maps it back, so the frame returned is backed
+        by the file rather than the heap where its columns allow.
+        :param bucket_name: Name of the s3 bucket - String
+        :param file_name: Name of the lookup file in s3 - String
+        :param etag: ETag the lookup was read at - String
+        :param data: Lookup data - DataFrame
+        :param columns: Columns read from the lookup, or None for all - List(String)
+        :param content_length: Size of the lookup file in s3 - Int
+        :return data: The data, from the file if it could be written - DataFrame
+        """
+        import pyarrow
+        import pyarrow.ipc
+
+        try:
+            table = pyarrow.Table.from_pandas(data, preserve_index=False)
+        except (pyarrow.ArrowException, TypeError, ValueError):
+            # Columns of mixed types cannot be written, the lookup is not kept.
+            return data
+
+        details = {"columns": columns, "content_length": content_length}
+        metadata = dict(table.schema.metadata or {})
+        metadata[METADATA_KEY] = json.dumps(details)
+        table = table.replace_schema_metadata(metadata)
+        if table.nbytes > self.max_bytes:
+            return data
+
+        path = self._path(bucket_name, file_name, etag)
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with pyarrow.OSFile(temporary_path, "wb") as sink:
+                with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(temporary_path, path)
+        except OSError:
+            # Out of space, the lookup is used from memory instead.
+            _remove(temporary_path)
+            return data
+
+        self._evict()
+        loaded, _ = self.load(bucket_name, file_name, etag, columns)
+        return data if loaded is None else loaded
+
+    def clear(self):
+        """
+        Removes every kept lookup.
+        """
+        for path in self._files():
+            _remove(path)
+
+    def _path(self, bucket_name, file_name, etag):
+        return os.path.join(self.directory,
+                            f"{_hash(bucket_name, file_name)}-{_hash(etag)}{_SUFFIX}")
+
+    def _versions(self, bucket_name, file_name):
+        prefix = _hash(bucket_name, file_name) + "-"
+        return [path for path in self._files()
+                if os.path.basename(path).startswith(prefix)]
+
+    def _files(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in names
+                if name.endswith(_SUFFIX)]
+
+    def _evict(self):
+        with self._lock:
+            files = []
+            for path in self._files():
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+            used = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if used <= self.max_bytes:
+                    break
+                _remove(path)
+                used -= size
+
+
+def _hash(*values):
+    return hashlib.sha256("\0".join(values).encode("utf-8")).hexdigest()[:32]
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _to_pandas(table):
+    # Split blocks keep each column in its own block, so numeric columns without
+    # nulls are left in the mapped file rather than copied into one 2D block.
+    data = table.to_pandas(split_blocks=True)
+
+    # Nulls in string columns come back as None, they are NaN when read from s3.
+    for column in data.columns:
+        values = data[column]
+        if values.dtype == object:
+            nulls = values.isnull().to_numpy()
+            if nulls.any():
+                values = values.to_numpy(copy=True)
+                values[nulls] = np.nan
+                data[column] = values
+    return data
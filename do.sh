@@ -65,6 +65,10 @@ test() {
    run -e PYTHONPATH=/usr/src/app python py.test "$@" 
 }
 
+bench() {
+   run -e PYTHONPATH=/usr/src/app python py.test benchmarks --benchmark-autosave --benchmark-compare --benchmark-compare-fail=mean:20% "$@"
+}
+
 shell() {
     run $@ /bin/bash
 }
@@ -117,6 +121,10 @@ Usage:
 
         Brings up python container, run backend tests using pytest, container removed once tests have finished. 
 
+    ${BOLD}bench${NORMAL} [<arg>]
+
+        Runs the benchmarks, saves the results under .benchmarks and compares them with the last saved run, failing if any mean is more than 20% slower.
+
 USAGE
 }
 
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import (is_bool_dtype, is_categorical_dtype, is_integer_dtype,
+                              is_object_dtype)
+
+# Types that can be declared for input columns.
+DTYPE_KINDS = ["category", "integer", "string"]
+
+# String columns with at most this many distinct values per row become categoricals.
+CATEGORY_MAX_RATIO = 0.5
+
+
+def plan_dtypes(data, input_schema=None, exclude=()):
+    """
+    Works out which columns can be held more compactly. Integer columns are
+    narrowed and string columns with few distinct values become categoricals,
+    unless input_schema declares otherwise. Floats are left alone so that the
+    values written out do not change.
+    :param data: Data to plan for - DataFrame
+    :param input_schema: Declared type of each column, one of DTYPE_KINDS - Dict
+    :param exclude: Columns to leave as they are - List(String)
+    :return dtype_plan: Type to convert each column to - Dict
+    """
+    input_schema = input_schema or {}
+
+    dtype_plan = {}
+    for column in data.columns:
+        if column in exclude:
+            continue
+
+        kind = input_schema.get(column)
+        if kind is None:
+            kind = _infer_kind(data[column])
+        if kind is not None:
+            dtype_plan[column] = kind
+    return dtype_plan
+
+
+def _infer_kind(values):
+    if is_integer_dtype(values.dtype) and not is_bool_dtype(values.dtype):
+        return "integer"
+
+    if is_object_dtype(values.dtype) and len(values) > 0 and \
+            values.nunique() <= CATEGORY_MAX_RATIO * len(values) and \
+            pd.api.types.infer_dtype(values, skipna=True) == "string":
+        return "category"
+    return None
+
+
+def compact_dtypes(data, input_schema=None, exclude=()):
+    """
+    Converts columns to the types from plan_dtypes. Only integer columns are
+    narrowed, a column declared as an integer that holds anything else is left
+    as it is.
+    :param data: Data to convert - DataFrame
+    :param input_schema: Declared type of each column, one of DTYPE_KINDS - Dict
+    :param exclude: Columns to leave as they are - List(String)
+    :return data: Data with compact columns - DataFrame
+    """
+    dtype_plan = plan_dtypes(data, input_schema, exclude)
+
+    # A shallow copy means only the converted columns are allocated.
+    compacted = data.copy(deep=False)
+    for column, kind in dtype_plan.items():
+        values = data[column]
+        if kind == "category" and not is_categorical_dtype(values.dtype):
+            compacted[column] = values.astype("category")
+        elif kind == "integer" and is_integer_dtype(values.dtype) and \
+                not is_bool_dtype(values.dtype):
+            compacted[column] = pd.to_numeric(values, downcast="integer")
+    return compacted
+
+
+def expand_dtypes(data):
+    """
+    Converts categoricals back to objects and narrowed integers back to int64, for
+    writing to formats that keep the column types.
+    :param data: Data to convert - DataFrame
+    :return data: Data with the usual pandas types - DataFrame
+    """
+    expanded = data.copy(deep=False)
+    for column in data.columns:
+        values = data[column]
+        if is_categorical_dtype(values.dtype):
+            expanded[column] = np.asarray(values, dtype=object)
+        elif values.dtype.kind == "i" and values.dtype.itemsize < 8:
+            expanded[column] = values.astype(np.int64)
+    return expanded
+
+
+def memory_usage(data):
+    """
+    Gets the memory held by a DataFrame, including the contents of object columns.
+    :param data: Data to measure - DataFrame
+    :return bytes: Bytes used - Int
+    """
+    return int(data.memory_usage(index=True, deep=True).sum())
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+from urllib.parse import unquote_plus
+
+from es_aws_functions import aws_functions, exception_classes, general_functions
+from marshmallow import EXCLUDE, Schema, fields
+
+import metrics_functions
+import startup_functions
+
+
+class EnvironmentSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    def handle_error(self, e, data, **kwargs):
+        logging.error(f"Error validating environment params: {e}")
+        raise ValueError(f"Error validating environment params: {e}")
+
+    metrics_enabled = fields.Boolean(missing=False)
+
+
+class CompletionSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    def handle_error(self, e, data, **kwargs):
+        logging.error(f"Error validating completion params: {e}")
+        raise ValueError(f"Error validating completion params: {e}")
+
+    anomaly_count = fields.Int(missing=0)
+    bpm_queue_url = fields.Str(required=True)
+    current_step_num = fields.Int(required=True)
+    environment = fields.Str(required=True)
+    error = fields.Str()
+    rows = fields.Int()
+    run_id = fields.Str(required=True)
+    sns_topic_arn = fields.Str(required=True)
+    success = fields.Boolean(required=True)
+    survey = fields.Str(required=True)
+    total_steps = fields.Int(required=True)
+
+
+# Schemas hold no state between loads, so one serves every invocation. The
+# environment is only loaded when it changes, see load_environment.
+completion_schema = CompletionSchema()
+
+
+def lambda_handler(event, context):
+    """
+    Completes an asynchronous enrichment run once the method has written its
+    completion object to s3, reporting the anomalies to sns and the end of the
+    step to BPM. The enriched data and anomalies are already in s3.
+    :param event: s3 event for the completion object - Dict
+    :param context: Context object.
+    :return Json: success and/or indication of error message.
+    """
+    current_module = "Enrichment - Finaliser"
+    error_message = ""
+
+    bpm_queue_url = None
+
+    run_id = 0
+    try:
+        environment_variables = startup_functions.load_environment(
+            EnvironmentSchema, os.environ)
+
+        # s3 sends one record for each object written.
+        record = event["Records"][0]["s3"]
+        bucket_name = record["bucket"]["name"]
+        completion_key = unquote_plus(record["object"]["key"])
+
+        completion = json.loads(startup_functions.client("s3").get_object(
+            Bucket=bucket_name, Key=completion_key)["Body"].read())
+        run_id = completion.get("run_id", run_id)
+
+        completion = completion_schema.load(completion)
+
+        # Environment Variables.
+        metrics_enabled = environment_variables["metrics_enabled"]
+
+        # Completion Variables.
+        anomaly_count = completion["anomaly_count"]
+        bpm_queue_url = completion["bpm_queue_url"]
+        current_step_num = completion["current_step_num"]
+        environment = completion["environment"]
+        sns_topic_arn = completion["sns_topic_arn"]
+        success = completion["success"]
+        survey = completion["survey"]
+        total_steps = completion["total_steps"]
+
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module, run_id,
+                                                           context=context)
+        raise exception_classes.LambdaFailure(error_message)
+
+    try:
+        logger = general_functions.get_logger(survey, current_module, environment,
+                                              run_id)
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module,
+                                                           run_id, context=context)
+
+        raise exception_classes.LambdaFailure(error_message)
+
+    metrics_functions.start_run(metrics_enabled, current_module, run_id, survey)
+
+    try:
+        logger.info(f"Started - retrieved completion from {completion_key}.")
+
+        if not success:
+            raise exception_classes.MethodFailure(completion.get("error"))
+
+        logger.info(f"Method enriched {completion.get('rows')} rows.")
+
+        with metrics_functions.stage("send_sns"):
+            aws_functions.send_sns_message_with_anomalies(anomaly_count > 0,
+                                                          sns_topic_arn, "Enrichment.")
+
+        logger.info("Successfully sent message to sns.")
+
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module,
+                                                           run_id, context=context,
+                                                           bpm_queue_url=bpm_queue_url)
+
+    finally:
+        metrics_functions.finish_run(success=len(error_message) == 0)
+        if (len(error_message)) > 0:
+            logger.error(error_message)
+            raise exception_classes.LambdaFailure(error_message)
+
+    logger.info("Successfully completed module: " + current_module)
+
+    # Send end of method status to BPM.
+    status = "DONE"
+    aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
+                                  current_step_num, total_steps)
+
+    return {"success": True}
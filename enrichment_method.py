@@ -1,10 +1,23 @@
+import itertools
 import logging
 import os
 
+import numpy as np
 import pandas as pd
 from es_aws_functions import aws_functions, general_functions
-from marshmallow import EXCLUDE, Schema, fields
-from marshmallow.validate import Range
+from marshmallow import EXCLUDE, Schema, ValidationError, fields, validates_schema
+from marshmallow.validate import OneOf, Range
+
+import anomaly_functions
+import compression_functions
+import disk_cache_functions
+import dtype_functions
+import io_functions
+import json_functions
+import lookup_functions
+import metrics_functions
+import plan_functions
+import startup_functions
 
 
 class EnvironmentSchema(Schema):
@@ -16,15 +29,39 @@ class EnvironmentSchema(Schema):
         raise ValueError(f"Error validating environment params: {e}")
 
     bucket_name = fields.Str(required=True)
+    lookup_cache_max_bytes = fields.Int(
+        missing=lookup_functions.DEFAULT_CACHE_MAX_BYTES)
+    lookup_disk_cache_max_bytes = fields.Int(
+        missing=disk_cache_functions.DEFAULT_DISK_CACHE_MAX_BYTES)
+    metrics_enabled = fields.Boolean(missing=False)
 
 
 class LookupSchema(Schema):
     file_name = fields.Str(required=True)
+    file_format = fields.Str(validate=OneOf(io_functions.FILE_FORMATS))
     columns_to_keep = fields.List(fields.String, required=True)
     join_column = fields.Str(required=True)
     required = fields.List(fields.String, required=True)
 
 
+class AnomalyRuleSchema(Schema):
+    rule_type = fields.Str(required=True, validate=OneOf(["match", "missing"]))
+    columns = fields.List(fields.String)
+    conditions = fields.Dict(keys=fields.Str(), values=fields.Raw())
+    issue = fields.Str()
+    report_columns = fields.List(fields.String, missing=[])
+
+    @validates_schema
+    def validate_rule_fields(self, rule, **kwargs):
+        # Rules that fail validation would otherwise fail part way through a run.
+        if rule["rule_type"] == "missing" and not rule.get("columns"):
+            raise ValidationError("columns are required for a missing rule.")
+        if rule["rule_type"] == "match" and \
+                (not rule.get("conditions") or "issue" not in rule):
+            raise ValidationError("conditions and issue are required for a match "
+                                  "rule.")
+
+
 class RuntimeSchema(Schema):
     class Meta:
         unknown = EXCLUDE
@@ -33,106 +70,497 @@ class RuntimeSchema(Schema):
         logging.error(f"Error validating runtime params: {e}")
         raise ValueError(f"Error validating runtime params: {e}")
 
-    bpm_queue_url = fields.Str(required=True)
-    data = fields.Str(required=True)
+    anomaly_rules = fields.Dict(
+        keys=fields.Int(validate=Range(min=0)),
+        values=fields.Nested(AnomalyRuleSchema, required=True),
+        missing={})
+    anomalies_location = fields.Str()
+    anomaly_format = fields.Str(validate=OneOf(anomaly_functions.ANOMALY_FORMATS),
+                                missing="records")
+    # None for runs whose caller reports to BPM itself, such as partitions.
+    bpm_queue_url = fields.Str(required=True, allow_none=True)
+    chunk_size = fields.Int(validate=Range(min=1))
+    completion_context = fields.Dict(keys=fields.Str(), missing={})
+    completion_location = fields.Str()
+    composite_lookup = fields.Str()
+    compression = fields.Str(validate=OneOf(compression_functions.COMPRESSIONS))
+    data = fields.Raw()
+    dry_run = fields.Boolean(missing=False)
     environment = fields.Str(required=True)
+    file_format = fields.Str(validate=OneOf(io_functions.FILE_FORMATS))
     identifier_column = fields.Str(required=True)
+    in_location = fields.Str()
+    incremental = fields.Boolean(missing=False)
+    input_schema = fields.Dict(
+        keys=fields.Str(),
+        values=fields.Str(validate=OneOf(dtype_functions.DTYPE_KINDS)),
+        missing={})
     lookups = fields.Dict(
         keys=fields.Int(validate=Range(min=0)),
         values=fields.Nested(LookupSchema, required=True))
     marine_mismatch_check = fields.Boolean(required=True)
+    out_location = fields.Str()
     period_column = fields.Str(required=True)
     run_id = fields.Str(required=True)
     survey = fields.Str(required=True)
     survey_column = fields.Str(required=True)
+    validate_only = fields.Boolean(missing=False)
+
+    @validates_schema
+    def validate_data_location(self, runtime_variables, **kwargs):
+        # Data passed by value is a JSON string, which may be compressed, or
+        # records the wrangler placed in the payload as they are.
+        if "data" in runtime_variables and \
+                not isinstance(runtime_variables["data"], (str, list)):
+            raise ValidationError("data must be a JSON string or a list of records.")
+
+        # Data is either passed by value or read from and written to s3.
+        if "in_location" in runtime_variables:
+            if "out_location" not in runtime_variables or \
+                    "anomalies_location" not in runtime_variables:
+                raise ValidationError("out_location and anomalies_location are "
+                                      "required with in_location.")
+        elif "data" not in runtime_variables:
+            raise ValidationError("One of data or in_location is required.")
+        elif "chunk_size" in runtime_variables:
+            raise ValidationError("chunk_size can only be used with in_location.")
+        elif "completion_location" in runtime_variables:
+            raise ValidationError("completion_location can only be used with "
+                                  "in_location.")
+
+        # The state of an incremental run is kept alongside its output.
+        if runtime_variables.get("incremental") and (
+                "in_location" not in runtime_variables or
+                "chunk_size" in runtime_variables):
+            raise ValidationError("incremental can only be used with in_location "
+                                  "and without chunk_size.")
+
+        # Validation builds no enriched data to stream or keep state for.
+        if runtime_variables.get("validate_only") and (
+                "chunk_size" in runtime_variables or
+                runtime_variables.get("incremental")):
+            raise ValidationError("validate_only cannot be used with chunk_size or "
+                                  "incremental.")
+
+
+# Schemas hold no state between loads, so one serves every invocation. The
+# environment is only loaded when it changes, see load_environment.
+runtime_schema = RuntimeSchema()
+lookup_schema = LookupSchema(many=True)
 
 
 def lambda_handler(event, context):
+    """
+    Runs one enrichment job, or when the event holds "Jobs" a batch of them, see
+    batch_enrichment.
+    :param event: event object.
+    :param context: Context object.
+    :return final_output: Output of enrich_job, or of batch_enrichment - Dict
+    """
+    if "Jobs" in event:
+        return batch_enrichment(event["Jobs"], context)
+    return enrich_job(event, context)
+
+
+def batch_enrichment(jobs, context):
+    """
+    Runs a batch of jobs in one invocation, each an event as enrich_job is given
+    with its own data, lookups and run_id. Every job succeeds or fails on its
+    own: errors are handled per job, so the BPM status of each run is right and
+    a failing job does not stop the rest. The distinct lookup files of the batch
+    are read once, with every column the jobs need from them.
+    :param jobs: Events of the jobs - List(Dict)
+    :param context: Context object.
+    :return final_output: Dict with "success", only true if every job succeeded,
+            and "results", the output of each job in order.
+    """
+    current_module = "Enrichment - Method"
+
+    results = []
+    with lookup_functions.lookup_cache.batch():
+        prefetch_lookups(jobs)
+
+        # Jobs run one after another, as metrics and the lookup cache statistics
+        # are kept for one run at a time.
+        for job in jobs:
+            try:
+                results.append(enrich_job(job, context))
+            except Exception as e:
+                # Only raised once the job has finished, such as when its
+                # completion could not be written.
+                runtime_variables = job.get("RuntimeVariables", {})
+                error_message = general_functions.handle_exception(
+                    e, current_module, runtime_variables.get("run_id", 0),
+                    context=context,
+                    bpm_queue_url=runtime_variables.get("bpm_queue_url"))
+                results.append({"success": False, "error": error_message})
+
+    return {"success": all(result["success"] for result in results),
+            "results": results}
+
+
+def prefetch_lookups(jobs):
+    """
+    Reads the lookups of a batch of jobs into the lookup cache. Jobs whose
+    variables are not valid are skipped, as are those using a composite lookup,
+    which may not need their lookups. Anything that fails here is reported by
+    the jobs it affects.
+    :param jobs: Events of the jobs - List(Dict)
+    :return failed: Lookup files that could not be read - List(String)
+    """
+    try:
+        environment_variables = startup_functions.load_environment(
+            EnvironmentSchema, os.environ)
+    except ValueError:
+        return []
+
+    lookups = []
+    for job in jobs:
+        try:
+            runtime_variables = job["RuntimeVariables"]
+            if "composite_lookup" not in runtime_variables:
+                lookups.extend(lookup_schema.load(
+                    list(runtime_variables["lookups"].values())))
+        except Exception:
+            continue
+
+    lookup_cache = lookup_functions.lookup_cache
+    lookup_cache.max_bytes = environment_variables["lookup_cache_max_bytes"]
+    lookup_cache.disk.max_bytes = environment_variables["lookup_disk_cache_max_bytes"]
+    return lookup_cache.prefetch(environment_variables["bucket_name"], lookups)
+
+
+def enrich_job(event, context):
     """
     Performs enrichment process, joining 2 lookups onto data and detecting anomalies.
+    Data is either passed in the event or, when in_location is given, read from s3
+    with the enriched data and anomalies written back to s3. A dry run only plans
+    the joins. When completion_location is given, the output is also written there
+    with the completion_context, to tell an asynchronous caller the run is over.
+    An incremental run only enriches the rows that changed since the last one.
+    With compression, the output passed back or written to s3 is compressed.
+    A validate_only run only finds the anomalies, without building, passing back
+    or writing the enriched data.
+    Compressed data and lookups are read whatever the compression. A compact
+    anomaly_format reports each reference once with a bitmask of its issues,
+    passing back "anomaly_codes" to read them by.
     :param event: event object.
     :param context: Context object.
     :return final_output: Dict with "success",
-            "data" and "anomalies" or "success and "error".
+            "data" and "anomalies" (or "rows" and "anomaly_count" when the data is
+            in s3, or "plan" for a dry run) or "success and "error".
     """
     # Set up logger.
     current_module = "Enrichment - Method"
     error_message = ''
 
     bpm_queue_url = None
+    completion_location = None
 
     run_id = 0
     try:
-        # Retrieve run_id before input validation
-        # Because it is used in exception handling
+        # Retrieve run_id and bpm_queue_url before input validation
+        # Because they are used in exception handling
+        bpm_queue_url = event['RuntimeVariables'].get('bpm_queue_url')
         run_id = event['RuntimeVariables']['run_id']
 
-        environment_variables = EnvironmentSchema().load(os.environ)
+        environment_variables = startup_functions.load_environment(
+            EnvironmentSchema, os.environ)
 
-        runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
+        runtime_variables = runtime_schema.load(event["RuntimeVariables"])
 
         # Environment Variables.
         bucket_name = environment_variables["bucket_name"]
+        lookup_cache_max_bytes = environment_variables["lookup_cache_max_bytes"]
+        lookup_disk_cache_max_bytes = \
+            environment_variables["lookup_disk_cache_max_bytes"]
+        metrics_enabled = environment_variables["metrics_enabled"]
 
         # Runtime Variables.
+        anomaly_format = runtime_variables["anomaly_format"]
+        anomaly_rules = runtime_variables["anomaly_rules"]
         bpm_queue_url = runtime_variables["bpm_queue_url"]
-        data = runtime_variables['data']
+        chunk_size = runtime_variables.get('chunk_size')
+        completion_context = runtime_variables['completion_context']
+        completion_location = runtime_variables.get('completion_location')
+        composite_lookup = runtime_variables.get('composite_lookup')
+        compression = runtime_variables.get('compression')
+        data = runtime_variables.get('data')
+        dry_run = runtime_variables['dry_run']
+        in_location = runtime_variables.get('in_location')
+        incremental = runtime_variables['incremental']
+        out_location = runtime_variables.get('out_location')
+        anomalies_location = runtime_variables.get('anomalies_location')
         environment = runtime_variables['environment']
+        file_format = runtime_variables.get('file_format')
         identifier_column = runtime_variables["identifier_column"]
+        input_schema = runtime_variables["input_schema"]
         lookups = runtime_variables['lookups']
         marine_mismatch_check = runtime_variables["marine_mismatch_check"]
         period_column = runtime_variables["period_column"]
         survey = runtime_variables['survey']
         survey_column = runtime_variables["survey_column"]
+        validate_only = runtime_variables["validate_only"]
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
-                                                           context=context)
-        return {"success": False, "error": error_message}
+                                                           context=context,
+                                                           bpm_queue_url=bpm_queue_url)
+        return fail_before_run(event, error_message, current_module, run_id,
+                               context, bpm_queue_url)
 
     try:
         logger = general_functions.get_logger(survey, current_module, environment,
                                               run_id)
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
-                                                           run_id, context=context)
-        return {"success": False, "error": error_message}
+                                                           run_id, context=context,
+                                                           bpm_queue_url=bpm_queue_url)
+        return fail_before_run(event, error_message, current_module, run_id,
+                               context, bpm_queue_url)
+
+    metrics_functions.start_run(metrics_enabled, current_module, run_id, survey)
 
     try:
         logger.info("Started - retrieved configuration variables.")
 
-        input_data = pd.read_json(data, dtype=False)
+        lookup_cache = lookup_functions.lookup_cache
+        lookup_cache.max_bytes = lookup_cache_max_bytes
+        lookup_cache.disk.max_bytes = lookup_disk_cache_max_bytes
+        lookup_cache.reset_stats()
+
+        with metrics_functions.stage("read_input") as stage:
+            if in_location and chunk_size:
+                chunks = io_functions.iter_dataframe_chunks(bucket_name, in_location,
+                                                            file_format, chunk_size)
+                # The first chunk gives the columns to plan the joins against.
+                # Rows are counted as stream_enrichment reads each chunk.
+                input_data = next(chunks, None)
+                logger.info("Streaming data from s3.")
+            elif in_location:
+                input_data = io_functions.read_dataframe(bucket_name, in_location,
+                                                         file_format)
+                stage["rows_out"] = len(input_data)
+                logger.info("Retrieved data from s3.")
+            else:
+                if isinstance(data, str):
+                    stage["bytes_read"] = len(data)
+                    data = compression_functions.decode_text(data)
+                input_data = json_functions.read_records(data)
+                logger.info("JSON converted to Pandas DF(s).")
+                stage["rows_out"] = len(input_data)
+
+        if input_data is not None:
+            memory_before = dtype_functions.memory_usage(input_data)
+            with metrics_functions.stage("compact_dtypes"):
+                input_data = dtype_functions.compact_dtypes(input_data, input_schema)
+            logger.info(f"Input memory: {memory_before} bytes as read, "
+                        f"{dtype_functions.memory_usage(input_data)} bytes compacted"
+                        f"{' for the first chunk' if chunk_size else ''}.")
+            if chunk_size:
+                chunks = itertools.chain([input_data], (
+                    dtype_functions.compact_dtypes(chunk, input_schema)
+                    for chunk in chunks))
+
+        input_columns = None if input_data is None else list(input_data.columns)
+        join_plan, lookup_tables = plan_enrichment(lookups, bucket_name, input_columns,
+                                                   composite_lookup)
+        plan_description = plan_functions.describe_join_plan(
+            join_plan, lookups, 0 if input_data is None else len(input_data))
+        logger.info(f"Join plan: {plan_description}")
+        if composite_lookup and not any(step["artefact"]
+                                        for step in join_plan["steps"]):
+            logger.warning(f"Composite lookup {composite_lookup} does not match the "
+                           f"lookups, joining them instead.")
+
+        rules = anomaly_functions.build_rules(lookups, marine_mismatch_check,
+                                              survey_column, period_column,
+                                              anomaly_rules)
+        codes = anomaly_functions.issue_codes(rules)
+
+        if dry_run:
+            logger.info("Dry run, no data enriched.")
+
+            final_output = {"plan": plan_description}
+        elif chunk_size:
+            rows, anomaly_count, summary = stream_enrichment(
+                chunks, lookup_tables, rules, identifier_column, period_column,
+                join_plan["columns"], bucket_name, out_location, anomalies_location,
+                file_format, compression, anomaly_format)
+
+            logger.info(f"Enrichment function ran successfully on {rows} rows in "
+                        f"chunks of {chunk_size}, data sent to s3.")
+
+            final_output = {"rows": rows, "anomaly_count": anomaly_count}
+            if anomaly_format == "compact":
+                final_output["anomaly_codes"] = anomaly_functions.code_table(
+                    codes, summary, period_column)
+                if anomaly_count > 0:
+                    write_code_table(bucket_name, anomalies_location,
+                                     final_output["anomaly_codes"])
+        else:
+            if validate_only:
+                enriched_df = None
+                anomalies = validate_data(input_data, lookup_tables, rules,
+                                          identifier_column, [period_column])
+
+                logger.info("Validation ran successfully, no data enriched.")
+            else:
+                if incremental:
+                    enriched_df, anomalies = incremental_enrichment(
+                        input_data, lookups, lookup_tables, rules, identifier_column,
+                        period_column, join_plan["columns"], bucket_name,
+                        out_location,
+                        io_functions.file_format_for(out_location, file_format),
+                        logger)
+                else:
+                    enriched_df, anomalies = enrich_data(
+                        input_data, lookup_tables, rules, identifier_column,
+                        join_plan["columns"], [period_column])
 
-        logger.info("JSON converted to Pandas DF(s).")
+                logger.info("Enrichment function ran successfully.")
+                logger.info(f"Enriched memory: "
+                            f"{dtype_functions.memory_usage(enriched_df)} bytes.")
 
-        enriched_df, anomalies = data_enrichment(input_data,
-                                                 marine_mismatch_check,
-                                                 survey_column,
-                                                 period_column,
-                                                 bucket_name,
-                                                 lookups,
-                                                 identifier_column)
+            anomaly_count = anomaly_functions.issue_count(anomalies, codes)
+            if anomaly_format == "compact":
+                anomaly_codes = anomaly_functions.code_table(
+                    codes, anomaly_functions.summarise_anomalies(
+                        anomalies, codes, period_column), period_column)
+            else:
+                with metrics_functions.stage("render_anomalies") as stage:
+                    stage["rows_in"] = len(anomalies)
+                    anomalies = anomaly_functions.render_anomalies(
+                        anomalies, codes, identifier_column)
+                    stage["rows_out"] = len(anomalies)
 
-        logger.info("Enrichment function ran successfully.")
+            if out_location:
+                # Columnar formats keep the compact types, so they are widened to
+                # write the same schema as before.
+                if io_functions.file_format_for(out_location, file_format) in \
+                        io_functions.COLUMNAR_FORMATS:
+                    if enriched_df is not None:
+                        enriched_df = dtype_functions.expand_dtypes(enriched_df)
+                    anomalies = dtype_functions.expand_dtypes(anomalies)
 
-        json_out = enriched_df.to_json(orient="records")
+                with metrics_functions.stage("write_output") as stage:
+                    stage["rows_in"] = len(anomalies)
+                    stage["bytes_written"] = 0
+                    if enriched_df is not None:
+                        stage["rows_in"] += len(enriched_df)
+                        stage["bytes_written"] += io_functions.write_dataframe(
+                            bucket_name, out_location, enriched_df, file_format,
+                            compression)
 
-        anomaly_out = anomalies.to_json(orient="records")
+                    if anomaly_count > 0:
+                        stage["bytes_written"] += io_functions.write_dataframe(
+                            bucket_name, anomalies_location, anomalies, file_format,
+                            compression)
+                        if anomaly_format == "compact":
+                            write_code_table(bucket_name, anomalies_location,
+                                             anomaly_codes)
 
-        logger.info("DF(s) converted back to JSON.")
+                logger.info("Successfully sent data to s3.")
 
-        final_output = {"data": json_out, "anomalies": anomaly_out}
+                final_output = {"rows": len(input_data),
+                                "anomaly_count": anomaly_count}
+            else:
+                with metrics_functions.stage("encode_output") as stage:
+                    final_output = {}
+                    stage["rows_in"] = len(anomalies)
+                    stage["bytes_written"] = 0
+                    if enriched_df is not None:
+                        json_out = compression_functions.encode_text(
+                            enriched_df.to_json(orient="records"), compression)
+                        final_output["data"] = json_out
+                        stage["rows_in"] += len(enriched_df)
+                        stage["bytes_written"] += len(json_out)
+
+                    anomaly_out = compression_functions.encode_text(
+                        anomalies.to_json(orient="records"), compression)
+                    final_output["anomalies"] = anomaly_out
+                    stage["bytes_written"] += len(anomaly_out)
+
+                logger.info("DF(s) converted back to JSON.")
+
+            if anomaly_format == "compact":
+                final_output["anomaly_count"] = anomaly_count
+                final_output["anomaly_codes"] = anomaly_codes
+
+        logger.info(f"Lookup cache: {lookup_cache.stats}")
+        for file_name, lookup_read in lookup_cache.stats["lookups"].items():
+            logger.info(f"Lookup {file_name}: read {lookup_read['bytes_read']} bytes, "
+                        f"kept {lookup_read['bytes_kept']} bytes.")
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
                                                            run_id, context=context,
                                                            bpm_queue_url=bpm_queue_url)
     finally:
+        metrics_functions.finish_run(success=len(error_message) == 0)
         if (len(error_message)) > 0:
             logger.error(error_message)
+            final_output = {"success": False, "error": error_message}
+        else:
+            logger.info("Successfully completed module: " + current_module)
+            final_output['success'] = True
+
+    if completion_location:
+        # Written last, as it triggers the finaliser. Without it the run is never
+        # completed, so a failure is reported to BPM rather than raised, which
+        # would have lambda run the whole enrichment again.
+        try:
+            aws_functions.save_to_s3(bucket_name, completion_location,
+                                     json_functions.dumps(dict(completion_context,
+                                                               **final_output)))
+        except Exception as e:
+            error_message = general_functions.handle_exception(
+                e, current_module, run_id, context=context,
+                bpm_queue_url=bpm_queue_url)
+            logger.error(error_message)
             return {"success": False, "error": error_message}
+        logger.info(f"Completion sent to {completion_location}.")
 
-    logger.info("Successfully completed module: " + current_module)
-    final_output['success'] = True
+    return final_output
+
+
+def fail_before_run(event, error_message, current_module, run_id, context,
+                    bpm_queue_url):
+    """
+    Ends a run that failed before its variables were validated. An asynchronous
+    run has its failure written to the completion_location in the event, so that
+    the finaliser ends the run rather than its caller waiting on it until it
+    times out. The bucket is taken from the environment as it is, as it may be
+    what failed validation.
+    :param event: event object.
+    :param error_message: Error the run failed with - String
+    :param current_module: Name of the module - String
+    :param run_id: Id of the run, if known - String
+    :param context: Context object.
+    :param bpm_queue_url: Queue to report errors to, if known - String
+    :return final_output: Dict with "success" and "error".
+    """
+    final_output = {"success": False, "error": error_message}
+
+    runtime_variables = event.get("RuntimeVariables") \
+        if isinstance(event, dict) else None
+    if not isinstance(runtime_variables, dict):
+        return final_output
+    completion_location = runtime_variables.get("completion_location")
+    completion_context = runtime_variables.get("completion_context")
+    bucket_name = os.environ.get("bucket_name")
+    if not isinstance(completion_location, str) or not bucket_name:
+        return final_output
+    if not isinstance(completion_context, dict):
+        completion_context = {}
+
+    try:
+        aws_functions.save_to_s3(bucket_name, completion_location,
+                                 json_functions.dumps(dict(completion_context,
+                                                           **final_output)))
+    except Exception as e:
+        error_message = general_functions.handle_exception(
+            e, current_module, run_id, context=context, bpm_queue_url=bpm_queue_url)
+        return {"success": False, "error": error_message}
     return final_output
 
 
@@ -148,20 +576,9 @@ def marine_mismatch_detector(data, survey_column, check_column,
     :return: bad_data_with_marine: Df containing information about any reference that is
     producing marine when it shouldn't - DataFrame
     """
-    bad_data = data.copy()
-    bad_data = bad_data[
-        (bad_data[survey_column] == "076")
-        & (bad_data[check_column] == "n")]
-    bad_data["issue"] = "Reference should not produce marine data."
-    return bad_data[
-        [
-            identifier_column,
-            "issue",
-            survey_column,
-            check_column,
-            period_column,
-        ]
-    ]
+    rule = anomaly_functions.marine_mismatch_rule(survey_column, check_column,
+                                                  period_column)
+    return anomaly_functions.detect_anomalies(data, [rule], identifier_column)
 
 
 def missing_column_detector(data, columns_to_check, identifier_column):
@@ -170,24 +587,15 @@ def missing_column_detector(data, columns_to_check, identifier_column):
     :param data: Input data after being combined with lookup(s) - DataFrame
     :param columns_to_check: List of columns to check for - list(String)
     :param identifier_column: Column that holds the unique id of a row(usually responder id) - String
-    :return: data_without_columns: DF containing information about any reference without the column. - DataFrame
+    :return: data_without_columns: DF containing information about any reference without the column,
+    one row per missing column. - DataFrame
     """
-    # Create a copy of the dataframe to hold output.
-    data_without_columns = data.copy()
-
-    # For each of the passed in columns to check(1 or more).
-    # Update rows where the column was null.
-    for column_to_check in columns_to_check:
-        data_without_columns.loc[
-            data_without_columns[column_to_check].isnull(), "issue"
-        ] = str(column_to_check) + " missing in lookup."
-
-    data_without_columns = data_without_columns[data_without_columns["issue"].notnull()]
-    return data_without_columns[[identifier_column, "issue"]]
+    rule = anomaly_functions.missing_rule(columns_to_check)
+    return anomaly_functions.detect_anomalies(data, [rule], identifier_column)
 
 
 def data_enrichment(data_df, marine_mismatch_check, survey_column, period_column,
-                    bucket_name, lookups, identifier_column):
+                    bucket_name, lookups, identifier_column, anomaly_rules=None):
     """
     Does the enrichment process by merging together several datasets. Checks for marine
     mismatch, unallocated county, and unallocated region are performed at this point.
@@ -198,6 +606,7 @@ def data_enrichment(data_df, marine_mismatch_check, survey_column, period_column
     :param bucket_name: Name of the s3 bucket - String
     :param lookups: Information about lookups required. - String(json)
     :param identifier_column: Column representing unique id (responder_id)
+    :param anomaly_rules: Extra anomaly rules from the runtime variables - Dict
 
 
     :return: Enriched_data - DataFrame:DataFrame of enriched data.
@@ -205,39 +614,418 @@ def data_enrichment(data_df, marine_mismatch_check, survey_column, period_column
                          about data anomalies detected in the process.
     """
 
-    required_columns = []
-    for lookup in lookups:
-        required_columns.append(lookups[lookup]['required'])
-        file_name = lookups[lookup]['file_name']
-        columns_to_keep = lookups[lookup]['columns_to_keep']
-        join_column = lookups[lookup]['join_column']
-        data_df = do_merge(data_df, file_name, columns_to_keep, join_column, bucket_name)
+    with metrics_functions.stage("data_enrichment") as stage:
+        stage["rows_in"] = len(data_df)
+        join_plan, lookup_tables = plan_enrichment(lookups, bucket_name,
+                                                   list(data_df.columns))
+
+        rules = anomaly_functions.build_rules(lookups, marine_mismatch_check,
+                                              survey_column, period_column,
+                                              anomaly_rules)
 
-    anomalies = pd.DataFrame()
+        enriched_df, anomalies = enrich_data(data_df, lookup_tables, rules,
+                                             identifier_column, join_plan["columns"])
+        anomalies = anomaly_functions.render_anomalies(
+            anomalies, anomaly_functions.issue_codes(rules), identifier_column)
+        stage["rows_out"] = len(enriched_df)
 
-    # Missing column detection.
-    for column in required_columns:
-        anomalies = pd.concat([anomalies,
-                               missing_column_detector(data_df,
-                                                       column,
-                                                       identifier_column)])
+    return enriched_df, anomalies
 
-    # Do Marine mismatch check here.
-    if marine_mismatch_check:
-        marine_anomalies = marine_mismatch_detector(
-            data_df,
-            survey_column,
-            "marine",
-            period_column,
-            identifier_column,
-        )
 
-        anomalies = pd.concat([marine_anomalies, anomalies])
+def stream_enrichment(chunks, lookup_tables, rules, identifier_column, period_column,
+                      column_order, bucket_name, out_location, anomalies_location,
+                      file_format, compression=None, anomaly_format="records"):
+    """
+    Does the enrichment process a chunk of rows at a time, appending each enriched
+    chunk and its anomalies to the output files in s3.
+    Memory use is bounded by the chunk size and lookups rather than the input size.
+    :param chunks: Chunks of the data to be enriched - Iterator(DataFrame)
+    :param lookup_tables: Tables in the order to join them - List(LookupTable)
+    :param rules: Anomaly rules - List(Dict)
+    :param identifier_column: Column representing unique id (responder_id)
+    :param period_column: Column that holds period. (period) - String
+    :param column_order: Order of the columns added by the lookups - List(String)
+    :param bucket_name: Name of the s3 bucket - String
+    :param out_location: Name of the enriched output file in s3 - String
+    :param anomalies_location: Name of the anomalies file in s3 - String
+    :param file_format: Format requested in the runtime variables - String
+    :param compression: Compression of the output files, if any - String
+    :param anomaly_format: One of anomaly_functions.ANOMALY_FORMATS - String
+    :return rows: Number of rows enriched - Int
+    :return anomaly_count: Number of anomalies found - Int
+    :return summary: Anomaly counts by period and code - DataFrame
+    """
+    codes = anomaly_functions.issue_codes(rules)
+    anomaly_count = 0
+    summaries = []
+
+    with io_functions.DataFrameStreamWriter(
+            bucket_name, out_location, file_format,
+            compression=compression) as data_writer, \
+            io_functions.DataFrameStreamWriter(
+                bucket_name, anomalies_location, file_format, skip_empty=True,
+                compression=compression) as anomaly_writer:
+        while True:
+            with metrics_functions.stage("read_input") as stage:
+                chunk = next(chunks, None)
+                stage["rows_out"] = 0 if chunk is None else len(chunk)
+            if chunk is None:
+                break
+
+            enriched_chunk, chunk_anomalies = enrich_data(chunk, lookup_tables, rules,
+                                                          identifier_column,
+                                                          column_order,
+                                                          [period_column])
+            anomaly_count += anomaly_functions.issue_count(chunk_anomalies, codes)
+            if anomaly_format == "compact":
+                summaries.append(anomaly_functions.summarise_anomalies(
+                    chunk_anomalies, codes, period_column))
+            else:
+                chunk_anomalies = anomaly_functions.render_anomalies(
+                    chunk_anomalies, codes, identifier_column)
+
+            with metrics_functions.stage("write_output") as stage:
+                bytes_written = data_writer.bytes_written + anomaly_writer.bytes_written
+                data_writer.write(enriched_chunk)
+                anomaly_writer.write(chunk_anomalies)
+                stage["rows_in"] = len(enriched_chunk) + len(chunk_anomalies)
+                stage["bytes_written"] = data_writer.bytes_written + \
+                    anomaly_writer.bytes_written - bytes_written
+
+    return data_writer.rows, anomaly_count, \
+        anomaly_functions.merge_summaries(summaries, period_column)
+
+
+def write_code_table(bucket_name, anomalies_location, table):
+    """
+    Writes the code table of a compact anomaly report beside it, as
+    <anomalies_location>_codes.
+    :param bucket_name: Name of the s3 bucket - String
+    :param anomalies_location: Name of the anomalies file in s3 - String
+    :param table: Code table from anomaly_functions.code_table - Dict
+    """
+    aws_functions.save_to_s3(bucket_name, anomaly_functions.code_table_location(
+        anomalies_location), json_functions.dumps(table))
+
+
+def plan_enrichment(lookups, bucket_name, input_columns=None, composite_lookup=None):
+    """
+    Plans the joins, checking every join column will exist before any lookup is
+    fetched, then gets the tables to join for each step. When a composite lookup
+    artefact is named and is current, the lookups it was built from are not
+    fetched.
+    :param lookups: Information about lookups required. - Dict
+    :param bucket_name: Name of the s3 bucket - String
+    :param input_columns: Columns of the data to be enriched - List(String)
+    :param composite_lookup: Name of a prebuilt composite artefact - String
+    :return join_plan: Steps of the plan - Dict
+    :return lookup_tables: Tables in the order to join them - List(LookupTable)
+    """
+    join_plan = plan_functions.build_join_plan(lookups, input_columns)
+
+    with metrics_functions.stage("fetch_lookups") as stage:
+        bytes_downloaded = lookup_functions.lookup_cache.stats["bytes_downloaded"]
+
+        artefact_tables = {}
+        if composite_lookup:
+            # Only needed by runs using an artefact, so not loaded at start up.
+            import composite_functions
+
+            artefact_tables = composite_functions.get_artefact_tables(
+                bucket_name, composite_lookup, lookups, join_plan)
+
+        covered = [lookup for step in join_plan["steps"]
+                   if step["join_column"] in artefact_tables
+                   for lookup in step["lookups"]]
+        lookup_tables = get_lookup_tables(
+            {lookup: lookups[lookup] for lookup in lookups if lookup not in covered},
+            bucket_name)
+
+        stage["bytes_read"] = lookup_functions.lookup_cache.stats["bytes_downloaded"] \
+            - bytes_downloaded
+
+    with metrics_functions.stage("plan_tables"):
+        return join_plan, plan_functions.plan_tables(join_plan, lookup_tables,
+                                                     artefact_tables)
+
+
+def get_lookup_tables(lookups, bucket_name):
+    """
+    Gets each lookup indexed on its join column.
+    The lookup files are fetched concurrently, the order only matters when they
+    are joined, as later lookups can join on columns added by earlier ones.
+    :param lookups: Information about lookups required. - Dict
+    :param bucket_name: Name of the s3 bucket - String
+    :return lookup_tables: Indexed lookup for each lookup key - Dict
+    """
+    tables = lookup_functions.lookup_cache.get_tables(
+        bucket_name, [lookups[lookup] for lookup in lookups])
+    return dict(zip(lookups, tables))
+
+
+def enrich_data(data_df, lookup_tables, rules, identifier_column, column_order=None,
+                keep_columns=()):
+    """
+    Joins the lookups onto the data and detects anomalies.
+    :param data_df: DataFrame of data to be enriched - DataFrame
+    :param lookup_tables: Tables in the order to join them - List(LookupTable)
+    :param rules: Anomaly rules - List(Dict)
+    :param identifier_column: Column representing unique id (responder_id)
+    :param column_order: Order of the columns added by the lookups, as if they had
+                         been joined in key order, or None to leave as joined
+                         - List(String)
+    :param keep_columns: Further columns to keep in the anomaly report, such as
+                         the period - List(String)
+    :return: Enriched_data - DataFrame:DataFrame of enriched data.
+    :return: Anomalies - DataFrame: Compact anomaly report, see
+                         anomaly_functions.compact_anomalies.
+    """
+    data_df = join_lookups(data_df, lookup_tables, column_order)
+
+    # Missing column detection, marine mismatch and any declared rules are
+    # evaluated together in one pass.
+    with metrics_functions.stage("detect_anomalies") as stage:
+        stage["rows_in"] = len(data_df)
+        anomalies = anomaly_functions.compact_anomalies(data_df, rules,
+                                                        identifier_column,
+                                                        keep_columns)
+        stage["rows_out"] = len(anomalies)
 
     return data_df, anomalies
 
 
-def do_merge(input_data, join_data, columns_to_keep, join_column, bucket_name):
+def validate_data(data_df, lookup_tables, rules, identifier_column, keep_columns=()):
+    """
+    Finds the anomalies enrich_data would, without building the enriched data.
+    Only the lookup columns the rules compare or report, and those later lookups
+    join on, are joined. Columns only checked for nulls are worked out from
+    which keys each lookup covers, and held as a float32 marker that is null
+    where the column would be.
+    :param data_df: DataFrame of data to be checked - DataFrame
+    :param lookup_tables: Tables in the order to join them - List(LookupTable)
+    :param rules: Anomaly rules - List(Dict)
+    :param identifier_column: Column representing unique id (responder_id)
+    :param keep_columns: Further columns to keep in the anomaly report, such as
+                         the period - List(String)
+    :return: Anomalies - DataFrame: Compact anomaly report, see
+                         anomaly_functions.compact_anomalies.
+    """
+    value_columns, null_columns = anomaly_functions.rule_columns(rules)
+    value_columns.update(table.join_column for table in lookup_tables)
+
+    with metrics_functions.stage("check_coverage") as stage:
+        stage["rows_in"] = len(data_df)
+        for lookup_table in lookup_tables:
+            if any(column in data_df.columns
+                   for column in lookup_table.value_columns):
+                # Joined in full, as clashing columns are renamed.
+                data_df = lookup_table.enrich(data_df)
+                continue
+
+            data_df = lookup_table.enrich(data_df, value_columns)
+            present = lookup_table.coverage(
+                data_df[lookup_table.join_column],
+                [column for column in lookup_table.value_columns
+                 if column in null_columns and column not in value_columns])
+            for column, column_present in present.items():
+                data_df[column] = np.where(column_present, np.float32(0),
+                                           np.float32(np.nan))
+        stage["rows_out"] = len(data_df)
+
+    with metrics_functions.stage("detect_anomalies") as stage:
+        stage["rows_in"] = len(data_df)
+        anomalies = anomaly_functions.compact_anomalies(data_df, rules,
+                                                        identifier_column,
+                                                        keep_columns)
+        stage["rows_out"] = len(anomalies)
+
+    return anomalies
+
+
+def join_lookups(data_df, lookup_tables, column_order=None):
+    """
+    Joins the lookups onto the data.
+    :param data_df: DataFrame of data to be enriched - DataFrame
+    :param lookup_tables: Tables in the order to join them - List(LookupTable)
+    :param column_order: Order of the columns added by the lookups, as if they had
+                         been joined in key order, or None to leave as joined
+                         - List(String)
+    :return: Enriched_data - DataFrame:DataFrame of enriched data.
+    """
+    input_columns = list(data_df.columns)
+    with metrics_functions.stage("join") as stage:
+        stage["rows_in"] = len(data_df)
+        for lookup_table in lookup_tables:
+            data_df = lookup_table.enrich(data_df)
+
+        # The plan may join lookups out of key order.
+        if column_order is not None and \
+                list(data_df.columns[len(input_columns):]) != column_order:
+            data_df = data_df[input_columns + column_order]
+        stage["rows_out"] = len(data_df)
+
+    return data_df
+
+
+def incremental_enrichment(data_df, lookups, lookup_tables, rules, identifier_column,
+                           period_column, column_order, bucket_name, out_location,
+                           file_format, logger):
+    """
+    Enriches only the rows that are new or changed since the last incremental run
+    for out_location, or that join to lookup keys whose values changed, taking
+    the other rows and their anomalies from the state kept by that run. Rows are
+    matched between runs on identifier_column and period_column. A full rebuild
+    is done when there is no state, the configuration or input columns changed,
+    or a changed lookup has different columns or types.
+    :param data_df: DataFrame of data to be enriched - DataFrame
+    :param lookups: Information about lookups required. - Dict
+    :param lookup_tables: Tables in the order to join them - List(LookupTable)
+    :param rules: Anomaly rules - List(Dict)
+    :param identifier_column: Column representing unique id (responder_id)
+    :param period_column: Column that holds period. (period) - String
+    :param column_order: Order of the columns added by the lookups - List(String)
+    :param bucket_name: Name of the s3 bucket - String
+    :param out_location: Name of the enriched output file in s3 - String
+    :param file_format: Format of the output - String
+    :param logger: Logger of the run.
+    :return: Enriched_data - DataFrame:DataFrame of enriched data.
+    :return: Anomalies - DataFrame: Compact anomaly report, keeping the period.
+    """
+    # Only needed by incremental runs, so not loaded at start up.
+    import incremental_functions
+
+    data_df = data_df.reset_index(drop=True)
+    keys = incremental_functions.row_keys(data_df, identifier_column, period_column)
+
+    # The rows could not be matched to those of the next run.
+    if column_order is None or keys.has_duplicates:
+        logger.warning("Enriching every row without keeping state, as the lookup "
+                       "columns clash with the input or the identifier and period "
+                       "do not identify each row.")
+        return enrich_data(data_df, lookup_tables, rules, identifier_column,
+                           column_order, [period_column])
+
+    with metrics_functions.stage("load_state") as stage:
+        previous_manifest = incremental_functions.load_manifest(bucket_name,
+                                                                out_location)
+        config_hash = incremental_functions.config_hash(
+            data_df, lookups, rules, identifier_column, period_column, file_format)
+        versions = incremental_functions.lookup_versions(bucket_name, lookups)
+        row_hashes = incremental_functions.row_hashes(data_df)
+
+        rebuild = None
+        if previous_manifest is None:
+            rebuild = "there is no state from a previous run"
+        elif previous_manifest["config_hash"] != config_hash:
+            rebuild = "the configuration or input columns changed"
+
+        # Lookups with a new file are compared with the last run key by key.
+        lookup_state = {} if rebuild else dict(previous_manifest["lookups"])
+        lookup_keys = {}
+        files = []
+        for lookup in lookups:
+            name = str(lookup)
+            if name in lookup_state and lookup_state[name]["etag"] == versions[name]:
+                continue
+
+            join_column = lookups[lookup]["join_column"]
+            lookup_data = incremental_functions.read_lookup(bucket_name,
+                                                            lookups[lookup])
+            schema = incremental_functions.lookup_schema(lookup_data)
+            key_hashes = incremental_functions.key_hashes(lookup_data, join_column)
+            if name in lookup_state:
+                if schema != lookup_state[name]["schema"]:
+                    rebuild = rebuild or f"the schema of lookup " \
+                                         f"{lookups[lookup]['file_name']} changed"
+                elif not rebuild:
+                    lookup_keys[lookup] = incremental_functions.changed_keys(
+                        incremental_functions.read_state(
+                            bucket_name, lookup_state[name]["hashes"]),
+                        key_hashes, join_column)
+
+            lookup_state[name] = {"etag": versions[name], "schema": schema}
+            files.append((["lookups", name, "hashes"], key_hashes))
+
+        if rebuild:
+            logger.info(f"Enriching every row, as {rebuild}.")
+            selected = np.ones(len(data_df), dtype=bool)
+        else:
+            previous_rows = incremental_functions.read_state(bucket_name,
+                                                             previous_manifest["rows"])
+            previous_positions = incremental_functions.row_keys(
+                previous_rows, identifier_column, period_column).get_indexer(keys)
+
+            known = previous_positions >= 0
+            selected = ~known
+            selected[known] = row_hashes[known] != previous_rows[
+                incremental_functions.ROW_HASH_COLUMN].to_numpy()[
+                previous_positions[known]]
+
+            for lookup, changed_keys in lookup_keys.items():
+                join_column = lookups[lookup]["join_column"]
+                # A column added by another lookup keeps its last value, unless
+                # the row is already selected because that lookup changed.
+                if join_column in data_df.columns:
+                    join_values = data_df[join_column]
+                else:
+                    join_values = pd.Series(lookup_functions.take_with_nulls(
+                        previous_rows[join_column], previous_positions))
+                selected |= changed_keys.positions(join_values) >= 0
+
+            logger.info(f"Enriching {selected.sum()} of {len(data_df)} rows, the "
+                        f"others are unchanged since the last run.")
+
+        stage["rows_in"] = len(data_df)
+        stage["rows_out"] = int(selected.sum())
+
+    if rebuild:
+        enriched_df = join_lookups(data_df, lookup_tables, column_order)
+        positions = slice(None)
+    else:
+        positions = np.flatnonzero(selected)
+        fresh_df = join_lookups(data_df.iloc[positions], lookup_tables, column_order)
+
+        # A shallow copy means only the added columns are allocated.
+        kept_positions = previous_positions[~selected]
+        enriched_df = data_df.copy(deep=False)
+        for column in column_order:
+            enriched_df[column] = incremental_functions.splice_column(
+                fresh_df[column], previous_rows[column].iloc[kept_positions],
+                selected)
+
+    # Detected on the spliced data, so that reported values have the types a
+    # full run would give them.
+    with metrics_functions.stage("detect_anomalies") as stage:
+        stage["rows_in"] = len(enriched_df.iloc[positions])
+        anomalies = anomaly_functions.compact_anomalies(enriched_df.iloc[positions],
+                                                        rules, identifier_column,
+                                                        [period_column])
+        if not rebuild:
+            current_rows = np.full(len(previous_rows), -1)
+            current_rows[kept_positions] = np.flatnonzero(~selected)
+            anomalies = incremental_functions.splice_anomalies(
+                anomalies, incremental_functions.read_state(
+                    bucket_name, previous_manifest["anomalies"]),
+                current_rows, enriched_df)
+        stage["rows_out"] = len(anomalies)
+
+    with metrics_functions.stage("save_state"):
+        row_state = enriched_df[[identifier_column, period_column] + column_order]
+        row_state = row_state.assign(
+            **{incremental_functions.ROW_HASH_COLUMN: row_hashes})
+        anomaly_state = anomalies.assign(
+            **{incremental_functions.ROW_COLUMN: anomalies.index.to_numpy()})
+        files += [(["rows"], row_state), (["anomalies"], anomaly_state)]
+
+        incremental_functions.save_state(
+            bucket_name, out_location, previous_manifest,
+            {"config_hash": config_hash, "lookups": lookup_state}, files)
+
+    return enriched_df, anomalies
+
+
+def do_merge(input_data, join_data, columns_to_keep, join_column, bucket_name,
+             file_format=None):
     """
     Generic merging function.
 
@@ -246,13 +1034,18 @@ def do_merge(input_data, join_data, columns_to_keep, join_column, bucket_name):
     :param columns_to_keep: List of columns from lookup to pick up - List(String)
     :param join_column: Column to join lookup on with - String
     :param bucket_name: Name of bucket to get file - String
+    :param file_format: Format of the lookup if not given by its extension - String
     :return outdata: Dataframe with lookup merged on.
     """
-    # Read the join data as a df.
-    join_dataframe = aws_functions.read_dataframe_from_s3(bucket_name, join_data)
+    with metrics_functions.stage("do_merge") as stage:
+        stage["rows_in"] = len(input_data)
+
+        # Get the join data indexed on the join column, reusing a cached copy if
+        # the file is unchanged.
+        lookup_table = lookup_functions.lookup_cache.get_table(
+            bucket_name, join_data, join_column, columns_to_keep, file_format)
 
-    # Merge join data onto main dataset using defined join column.
-    outdata = pd.merge(input_data,
-                       join_dataframe[columns_to_keep],
-                       on=join_column, how="left")
+        # Gather the join data onto the main dataset using the defined join column.
+        outdata = lookup_table.enrich(input_data)
+        stage["rows_out"] = len(outdata)
     return outdata
@@ -1,10 +1,40 @@
+import functools
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
+# Clients are made by startup_functions, the shared tests patch them through here.
+import boto3  # noqa: F401
 from es_aws_functions import aws_functions, exception_classes, general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from marshmallow import EXCLUDE, Schema, ValidationError, fields, validates_schema
+from marshmallow.validate import OneOf, Range
+
+import anomaly_functions
+import compression_functions
+import io_functions
+import json_functions
+import metrics_functions
+import partition_functions
+import startup_functions
+
+# Inputs larger than this are passed to the method by s3 location rather than in
+# the invoke payload, which lambda caps at 6 MB.
+INLINE_PAYLOAD_LIMIT = 4 * 1024 * 1024
+
+# Prefix of the objects the method writes when an asynchronous run finishes, which
+# trigger the finaliser.
+COMPLETION_PREFIX = "enrichment_completions/"
+
+# Prefix of the inputs and outputs of each partition of a partitioned run.
+PARTITION_PREFIX = "enrichment_partitions/"
+
+# Times a partition is invoked before the run fails.
+PARTITION_ATTEMPTS = 2
+
+# Outputs at least this long are uploaded in parts as they are encoded, so that
+# the whole of the encoded output is never held beside the text passed back.
+MULTIPART_THRESHOLD = io_functions.MIN_PART_SIZE
 
 
 class EnvironmentSchema(Schema):
@@ -17,7 +47,9 @@ class EnvironmentSchema(Schema):
 
     bucket_name = fields.Str(required=True)
     identifier_column = fields.Str(required=True)
+    inline_payload_limit = fields.Int(missing=INLINE_PAYLOAD_LIMIT)
     method_name = fields.Str(required=True)
+    metrics_enabled = fields.Boolean(missing=False)
 
 
 class RuntimeSchema(Schema):
@@ -28,17 +60,60 @@ class RuntimeSchema(Schema):
         logging.error(f"Error validating runtime params: {e}")
         raise ValueError(f"Error validating runtime params: {e}")
 
+    anomaly_format = fields.Str(validate=OneOf(anomaly_functions.ANOMALY_FORMATS),
+                                missing="records")
+    asynchronous = fields.Boolean(missing=False)
     bpm_queue_url = fields.Str(required=True)
+    chunk_size = fields.Int()
+    composite_lookup = fields.Str()
+    compression = fields.Str(validate=OneOf(compression_functions.COMPRESSIONS))
     environment = fields.Str(Required=True)
+    file_format = fields.Str(validate=OneOf(io_functions.FILE_FORMATS))
     in_file_name = fields.Str(required=True)
+    incremental = fields.Boolean(missing=False)
     lookups = fields.Dict(required=True)
     marine_mismatch_check = fields.Boolean(required=True)
     out_file_name = fields.Str(required=True)
+    partition_column = fields.Str()
+    partitions = fields.Int(validate=Range(min=1))
     period_column = fields.Str(required=True)
     sns_topic_arn = fields.Str(required=True)
     survey = fields.Str(required=True)
     survey_column = fields.Str(required=True)
     total_steps = fields.Int(required=True)
+    validate_only = fields.Boolean(missing=False)
+
+    @validates_schema
+    def validate_partitions(self, runtime_variables, **kwargs):
+        # Partitions are merged by the wrangler, so it has to wait for them.
+        if runtime_variables.get("asynchronous") and (
+                "partitions" in runtime_variables or
+                "partition_column" in runtime_variables):
+            raise ValidationError("A run cannot be both asynchronous and "
+                                  "partitioned.")
+
+        # Partitions are enriched with row numbers as their identifier, and the
+        # method cannot keep state while streaming.
+        if runtime_variables.get("incremental") and (
+                "partitions" in runtime_variables or
+                "partition_column" in runtime_variables or
+                "chunk_size" in runtime_variables):
+            raise ValidationError("An incremental run cannot be partitioned or "
+                                  "chunked.")
+
+        # Validation builds no enriched data to merge, stream or keep state for.
+        if runtime_variables.get("validate_only") and (
+                "partitions" in runtime_variables or
+                "partition_column" in runtime_variables or
+                "chunk_size" in runtime_variables or
+                runtime_variables.get("incremental")):
+            raise ValidationError("A validate_only run cannot be partitioned, "
+                                  "chunked or incremental.")
+
+
+# Schemas hold no state between loads, so one serves every invocation. The
+# environment is only loaded when it changes, see load_environment.
+runtime_schema = RuntimeSchema()
 
 
 def lambda_handler(event, context):
@@ -63,27 +138,41 @@ def lambda_handler(event, context):
         # Because it is used in exception handling
         run_id = event["RuntimeVariables"]["run_id"]
 
-        environment_variables = EnvironmentSchema().load(os.environ)
+        environment_variables = startup_functions.load_environment(
+            EnvironmentSchema, os.environ)
 
-        runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
+        runtime_variables = runtime_schema.load(event["RuntimeVariables"])
 
         # Environment Variables.
         bucket_name = environment_variables["bucket_name"]
         identifier_column = environment_variables["identifier_column"]
+        inline_payload_limit = environment_variables["inline_payload_limit"]
         method_name = environment_variables["method_name"]
+        metrics_enabled = environment_variables["metrics_enabled"]
 
         # Runtime Variables.
+        anomaly_format = runtime_variables["anomaly_format"]
+        asynchronous = runtime_variables["asynchronous"]
         bpm_queue_url = runtime_variables["bpm_queue_url"]
+        chunk_size = runtime_variables.get("chunk_size")
+        composite_lookup = runtime_variables.get("composite_lookup")
+        compression = runtime_variables.get("compression")
         environment = runtime_variables['environment']
         lookups = runtime_variables["lookups"]
         in_file_name = runtime_variables["in_file_name"]
+        incremental = runtime_variables["incremental"]
+        file_format = io_functions.file_format_for(in_file_name,
+                                                   runtime_variables.get("file_format"))
         out_file_name = runtime_variables["out_file_name"]
+        partition_column = runtime_variables.get("partition_column")
+        partitions = runtime_variables.get("partitions")
         marine_mismatch_check = runtime_variables["marine_mismatch_check"]
         period_column = runtime_variables["period_column"]
         sns_topic_arn = runtime_variables["sns_topic_arn"]
         survey = runtime_variables['survey']
         survey_column = runtime_variables["survey_column"]
         total_steps = runtime_variables["total_steps"]
+        validate_only = runtime_variables["validate_only"]
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
@@ -99,6 +188,8 @@ def lambda_handler(event, context):
 
         raise exception_classes.LambdaFailure(error_message)
 
+    metrics_functions.start_run(metrics_enabled, current_module, run_id, survey)
+
     try:
 
         # Send start of method status to BPM.
@@ -107,17 +198,30 @@ def lambda_handler(event, context):
                                       current_step_num, total_steps)
 
         # Set up client.
-        lambda_client = boto3.client("lambda", region_name="eu-west-2")
+        lambda_client = startup_functions.client("lambda")
+
+        # Small JSON inputs are passed by value, larger or columnar ones are left
+        # in s3 for the method to read and write itself. An asynchronous method
+        # cannot return its results, partitions are merged from their outputs
+        # and incremental runs keep their state alongside the output, so these
+        # always use s3. The size of a compressed input says little about the
+        # size of its records, so it is left for the method to read.
+        with metrics_functions.stage("check_input_size"):
+            s3 = startup_functions.resource("s3")
+            input_object = s3.Object(bucket_name,
+                                     io_functions.s3_key(in_file_name, file_format))
+            input_size = input_object.content_length
+            input_compressed = input_object.content_encoding in \
+                compression_functions.COMPRESSIONS
+        partitioned = partitions is not None or partition_column is not None
+        pass_by_reference = asynchronous or partitioned or incremental or \
+            input_compressed or input_size > inline_payload_limit or \
+            file_format != io_functions.DEFAULT_FILE_FORMAT
 
-        data_df = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
-
-        logger.info("Started - retrieved data from s3")
-        data_json = data_df.to_json(orient="records")
         json_payload = {
             "RuntimeVariables": {
                 "bpm_queue_url": bpm_queue_url,
                 "environment": environment,
-                "data": data_json,
                 "lookups": lookups,
                 "marine_mismatch_check": marine_mismatch_check,
                 "survey": survey,
@@ -127,34 +231,163 @@ def lambda_handler(event, context):
                 "run_id": run_id
             }
         }
-        response = lambda_client.invoke(
-            FunctionName=method_name,
-            Payload=json.dumps(json_payload)
-        )
-
-        logger.info("Successfully invoked method.")
-        json_response = json.loads(response.get("Payload").read().decode("utf-8"))
-        logger.info("JSON extracted from method response.")
 
-        if not json_response["success"]:
-            raise exception_classes.MethodFailure(json_response["error"])
+        if composite_lookup:
+            json_payload["RuntimeVariables"]["composite_lookup"] = composite_lookup
 
-        aws_functions.save_to_s3(bucket_name, out_file_name, json_response["data"])
+        if validate_only:
+            # Only the anomalies are found, the output file is not written.
+            json_payload["RuntimeVariables"]["validate_only"] = validate_only
 
-        logger.info("Successfully sent data to s3.")
+        if compression:
+            # The method compresses what it passes back or writes to s3.
+            json_payload["RuntimeVariables"]["compression"] = compression
 
-        anomalies = json_response["anomalies"]
-
-        if anomalies != "[]":
-            aws_functions.save_to_s3(bucket_name, "Enrichment_Anomalies", anomalies)
-            have_anomalies = True
+        # Anomalies the wrangler writes itself come back from the method compact,
+        # and are rendered here if records were asked for.
+        if pass_by_reference and not partitioned:
+            json_payload["RuntimeVariables"]["anomaly_format"] = anomaly_format
         else:
-            have_anomalies = False
-
-        aws_functions.send_sns_message_with_anomalies(have_anomalies,
-                                                      sns_topic_arn, "Enrichment.")
+            json_payload["RuntimeVariables"]["anomaly_format"] = "compact"
+
+        if asynchronous:
+            # Passed back by the method in the object it writes when finished, so
+            # that the finaliser can complete the step.
+            completion_location = COMPLETION_PREFIX + str(run_id)
+            json_payload["RuntimeVariables"]["completion_location"] = \
+                completion_location
+            json_payload["RuntimeVariables"]["completion_context"] = {
+                "bpm_queue_url": bpm_queue_url,
+                "current_step_num": current_step_num,
+                "environment": environment,
+                "run_id": run_id,
+                "sns_topic_arn": sns_topic_arn,
+                "survey": survey,
+                "total_steps": total_steps
+            }
 
-        logger.info("Successfully sent message to sns.")
+        records = None
+        if pass_by_reference:
+            json_payload["RuntimeVariables"]["file_format"] = file_format
+            json_payload["RuntimeVariables"]["in_location"] = in_file_name
+            json_payload["RuntimeVariables"]["out_location"] = out_file_name
+            json_payload["RuntimeVariables"]["anomalies_location"] = \
+                "Enrichment_Anomalies"
+            if chunk_size:
+                json_payload["RuntimeVariables"]["chunk_size"] = chunk_size
+            if incremental:
+                json_payload["RuntimeVariables"]["incremental"] = incremental
+            logger.info(f"Started - passing data by s3 location ({input_size} bytes)")
+        else:
+            with metrics_functions.stage("read_input") as stage:
+                data_df = aws_functions.read_dataframe_from_s3(bucket_name,
+                                                               in_file_name)
+                stage["bytes_read"] = input_size
+                stage["rows_out"] = len(data_df)
+
+            logger.info("Started - retrieved data from s3")
+            # Placed in the payload as records rather than as a string, so that
+            # the method does not have to parse them twice. Compressed records
+            # are passed as a base64 string instead.
+            with metrics_functions.stage("encode_payload") as stage:
+                stage["rows_in"] = len(data_df)
+                records = data_df.to_json(orient="records")
+                if compression:
+                    json_payload["RuntimeVariables"]["data"] = \
+                        compression_functions.encode_text(records, compression)
+                    records = None
+
+        if partitioned:
+            rows, anomaly_count = enrich_partitions(
+                lambda_client, method_name, json_payload, bucket_name,
+                identifier_column, partition_column, partitions, anomaly_format,
+                logger)
+            have_anomalies = anomaly_count > 0
+
+            logger.info(f"Successfully enriched {rows} rows, data sent to s3.")
+
+            with metrics_functions.stage("send_sns"):
+                aws_functions.send_sns_message_with_anomalies(
+                    have_anomalies, sns_topic_arn, "Enrichment.")
+
+            logger.info("Successfully sent message to sns.")
+        elif asynchronous:
+            with metrics_functions.stage("invoke_method") as stage:
+                payload = json_functions.dumps_payload(json_payload)
+                lambda_client.invoke(
+                    FunctionName=method_name,
+                    InvocationType="Event",
+                    Payload=payload
+                )
+                stage["bytes_written"] = len(payload)
+
+            logger.info(f"Successfully invoked method asynchronously, the finaliser "
+                        f"will complete the run when {completion_location} is "
+                        f"written.")
+        else:
+            with metrics_functions.stage("invoke_method") as stage:
+                payload = json_functions.dumps_payload(json_payload, records)
+                response = lambda_client.invoke(
+                    FunctionName=method_name,
+                    Payload=payload
+                )
+
+                logger.info("Successfully invoked method.")
+                response_payload = response.get("Payload").read().decode("utf-8")
+                json_response = json_functions.loads(response_payload)
+                logger.info("JSON extracted from method response.")
+                stage["bytes_written"] = len(payload)
+                stage["bytes_read"] = len(response_payload)
+
+            # Only the parsed response is needed from here, so the text of either
+            # payload is not held while the outputs are written.
+            del payload, response_payload
+            records = None
+
+            if not json_response["success"]:
+                raise exception_classes.MethodFailure(json_response["error"])
+
+            if pass_by_reference:
+                # The method has already written the data and anomalies to s3.
+                logger.info(f"Method enriched {json_response['rows']} rows.")
+                have_anomalies = json_response["anomaly_count"] > 0
+            else:
+                with metrics_functions.stage("write_output") as stage:
+                    writes = []
+                    if not validate_only:
+                        writes.append(functools.partial(
+                            write_output, bucket_name, out_file_name,
+                            json_response["data"]))
+
+                    anomalies = json_response["anomalies"]
+
+                    if "anomaly_codes" in json_response:
+                        have_anomalies = json_response["anomaly_count"] > 0
+                        if have_anomalies:
+                            writes.append(functools.partial(
+                                write_anomalies, bucket_name, "Enrichment_Anomalies",
+                                anomalies, json_response["anomaly_codes"],
+                                identifier_column, anomaly_format, compression))
+                    elif compression_functions.decode_text(anomalies) != "[]":
+                        writes.append(functools.partial(
+                            write_output, bucket_name, "Enrichment_Anomalies",
+                            anomalies))
+                        have_anomalies = True
+                    else:
+                        have_anomalies = False
+
+                    # The data and anomalies are uploaded at the same time, and
+                    # sns is only sent once both are written.
+                    stage["bytes_written"] = write_concurrently(writes)
+
+                if not validate_only:
+                    logger.info("Successfully sent data to s3.")
+
+            with metrics_functions.stage("send_sns"):
+                aws_functions.send_sns_message_with_anomalies(
+                    have_anomalies, sns_topic_arn, "Enrichment.")
+
+            logger.info("Successfully sent message to sns.")
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
@@ -162,15 +395,255 @@ def lambda_handler(event, context):
                                                            bpm_queue_url=bpm_queue_url)
 
     finally:
+        metrics_functions.finish_run(success=len(error_message) == 0)
         if (len(error_message)) > 0:
             logger.error(error_message)
             raise exception_classes.LambdaFailure(error_message)
 
     logger.info("Successfully completed module: " + current_module)
 
+    if asynchronous:
+        # The finaliser reports the end of the step once the method has finished.
+        return {"success": True, "completion_location": completion_location}
+
     # Send end of method status to BPM.
     status = "DONE"
     aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
                                   current_step_num, total_steps)
 
     return {"success": True}
+
+
+def write_output(bucket_name, file_name, text):
+    """
+    Writes JSON the method passed back to s3. Compressed JSON is written as the
+    method compressed it, rather than being decompressed first.
+    :param bucket_name: Name of the s3 bucket - String
+    :param file_name: Name of the file in s3 - String
+    :param text: JSON, or base64 of compressed JSON - String
+    :return: Number of bytes written - Int
+    """
+    key = io_functions.s3_key(file_name, "json")
+    body = compression_functions.decode_bytes(text)
+    if body is None:
+        if len(text) < MULTIPART_THRESHOLD:
+            aws_functions.save_to_s3(bucket_name, file_name, text)
+            return len(text)
+
+        # Encoded a part at a time, each slice of the text being valid on its own.
+        with io_functions.S3MultipartWriter(bucket_name, key) as writer:
+            for start in range(0, len(text), writer.part_size):
+                writer.write(text[start:start + writer.part_size].encode("utf-8"))
+        return writer.bytes_written
+
+    compression = compression_functions.detect(body)
+    if len(body) < MULTIPART_THRESHOLD:
+        return io_functions.write_bytes(bucket_name, key, body, compression)
+
+    body = memoryview(body)
+    with io_functions.S3MultipartWriter(bucket_name, key,
+                                        content_encoding=compression) as writer:
+        for start in range(0, len(body), writer.part_size):
+            writer.write(body[start:start + writer.part_size])
+    return writer.bytes_written
+
+
+def write_concurrently(writes):
+    """
+    Runs writes to s3 at the same time, each in its own thread. Every write is
+    waited for before the first error, if any, is raised, so nothing is reported
+    as written until all of them have succeeded.
+    :param writes: Functions that each write a file and return the number of bytes
+                   written - List(Callable)
+    :return: Number of bytes written - Int
+    """
+    if len(writes) < 2:
+        return sum(write() for write in writes)
+
+    # save_to_s3 makes a resource from the default session, which is not thread
+    # safe to do until the session has been made.
+    startup_functions.resource("s3")
+    with ThreadPoolExecutor(max_workers=len(writes)) as executor:
+        futures = [executor.submit(write) for write in writes]
+    return sum(future.result() for future in futures)
+
+
+def write_anomalies(bucket_name, file_name, anomalies, table, identifier_column,
+                    anomaly_format, compression=None):
+    """
+    Writes a compact anomaly report the method passed back to s3, either as it
+    is with its code table beside it, or rendered as one record per issue.
+    :param bucket_name: Name of the s3 bucket - String
+    :param file_name: Name of the file in s3 - String
+    :param anomalies: Compact report as JSON, or base64 of compressed JSON - String
+    :param table: Code table from anomaly_functions.code_table - Dict
+    :param identifier_column: Column that holds the unique id of a row - String
+    :param anomaly_format: One of anomaly_functions.ANOMALY_FORMATS - String
+    :param compression: Compression to write records with, if any - String
+    :return: Number of bytes written - Int
+    """
+    if anomaly_format == "compact":
+        aws_functions.save_to_s3(bucket_name,
+                                 anomaly_functions.code_table_location(file_name),
+                                 json_functions.dumps(table))
+        return write_output(bucket_name, file_name, anomalies)
+
+    records = anomaly_functions.render_anomalies(
+        json_functions.read_records(compression_functions.decode_text(anomalies)),
+        table["codes"], identifier_column)
+    return io_functions.write_dataframe(bucket_name, file_name, records,
+                                        io_functions.DEFAULT_FILE_FORMAT, compression)
+
+
+def enrich_partitions(lambda_client, method_name, json_payload, bucket_name,
+                      identifier_column, partition_column, partitions,
+                      anomaly_format, logger):
+    """
+    Splits the input into partitions and enriches each with its own invocation of
+    the method, in parallel, then writes the merged data and anomalies in the
+    order a single invocation would have. The partitions report their anomalies
+    compact, and they are rendered once merged if records were asked for.
+    :param lambda_client: Lambda client - botocore.client.Lambda
+    :param method_name: Name of the method lambda - String
+    :param json_payload: Payload for the whole input, by s3 location - Dict
+    :param bucket_name: Name of the s3 bucket - String
+    :param identifier_column: Column that holds the unique id of a row - String
+    :param partition_column: Column whose values are kept together, otherwise
+                             rows are split by their identifier - String
+    :param partitions: Number of partitions, otherwise from the rows - Int
+    :param anomaly_format: One of anomaly_functions.ANOMALY_FORMATS - String
+    :param logger: Logger for the run - Logger
+    :return rows: Number of rows enriched - Int
+    :return anomaly_count: Number of anomalies found - Int
+    """
+    runtime_variables = json_payload["RuntimeVariables"]
+    compression = runtime_variables.get("compression")
+    file_format = runtime_variables["file_format"]
+    prefix = f"{PARTITION_PREFIX}{runtime_variables['run_id']}/"
+
+    with metrics_functions.stage("split_partitions") as stage:
+        data = io_functions.read_dataframe(bucket_name,
+                                           runtime_variables["in_location"],
+                                           file_format)
+        stage["rows_in"] = len(data)
+
+        partitions = partition_functions.partition_count(len(data), partitions)
+        assignment = partition_functions.assign_partitions(
+            data, partitions, partition_column, identifier_column)
+
+        payloads = []
+        for number, partition in enumerate(
+                partition_functions.split_partitions(data, assignment)):
+            payload = json.loads(json.dumps(json_payload))
+            # Numbering the rows lets the anomalies be put back in order. A
+            # failed attempt is not reported to BPM, as it may be invoked again,
+            # and the wrangler reports the result of the whole run once.
+            payload["RuntimeVariables"].update({
+                "bpm_queue_url": None,
+                "in_location": f"{prefix}input-{number}",
+                "out_location": f"{prefix}output-{number}",
+                "anomalies_location": f"{prefix}anomalies-{number}",
+                "identifier_column": partition_functions.ROW_NUMBER_COLUMN})
+            stage["bytes_written"] = stage.get("bytes_written", 0) + \
+                io_functions.write_dataframe(bucket_name, f"{prefix}input-{number}",
+                                             partition, file_format, compression)
+            payloads.append(payload)
+
+    logger.info(f"Split {len(data)} rows into {len(payloads)} partitions.")
+
+    with metrics_functions.stage("invoke_method"):
+        responses = invoke_partitions(lambda_client, method_name, payloads, logger)
+
+    with metrics_functions.stage("merge_partitions") as stage:
+        data_partitions = []
+        anomaly_partitions = []
+        for payload, response in zip(payloads, responses):
+            data_partitions.append(io_functions.read_dataframe(
+                bucket_name, payload["RuntimeVariables"]["out_location"], file_format))
+            if response["anomaly_count"] > 0:
+                anomaly_partitions.append(io_functions.read_dataframe(
+                    bucket_name, payload["RuntimeVariables"]["anomalies_location"],
+                    file_format))
+
+        enriched, anomalies = partition_functions.merge_partitions(
+            data_partitions, anomaly_partitions, data[identifier_column].to_numpy(),
+            identifier_column)
+        # Every partition has the same rules, so the same codes.
+        codes = responses[0]["anomaly_codes"]["codes"]
+        anomaly_count = anomaly_functions.issue_count(anomalies, codes)
+        if anomaly_format == "compact":
+            period_column = runtime_variables["period_column"]
+            table = anomaly_functions.code_table(
+                codes, anomaly_functions.summarise_anomalies(anomalies, codes,
+                                                             period_column),
+                period_column)
+        elif anomaly_count > 0:
+            anomalies = anomaly_functions.render_anomalies(anomalies, codes,
+                                                           identifier_column)
+        stage["rows_out"] = len(enriched) + len(anomalies)
+
+    def write_anomaly_files():
+        bytes_written = io_functions.write_dataframe(
+            bucket_name, runtime_variables["anomalies_location"], anomalies,
+            file_format, compression)
+        if anomaly_format == "compact":
+            aws_functions.save_to_s3(bucket_name,
+                                     anomaly_functions.code_table_location(
+                                         runtime_variables["anomalies_location"]),
+                                     json_functions.dumps(table))
+        return bytes_written
+
+    with metrics_functions.stage("write_output") as stage:
+        writes = [functools.partial(io_functions.write_dataframe, bucket_name,
+                                    runtime_variables["out_location"], enriched,
+                                    file_format, compression)]
+        if anomaly_count > 0:
+            writes.append(write_anomaly_files)
+        stage["bytes_written"] = write_concurrently(writes)
+
+    keys = [io_functions.s3_key(payload["RuntimeVariables"][location], file_format)
+            for payload in payloads
+            for location in ["in_location", "out_location", "anomalies_location"]]
+    keys += [io_functions.s3_key(anomaly_functions.code_table_location(
+        payload["RuntimeVariables"]["anomalies_location"])) for payload in payloads]
+    startup_functions.client("s3").delete_objects(Bucket=bucket_name, Delete={
+        "Objects": [{"Key": key} for key in keys], "Quiet": True})
+
+    return len(enriched), anomaly_count
+
+
+def invoke_partitions(lambda_client, method_name, payloads, logger):
+    """
+    Invokes the method for every partition in parallel. Partitions that fail are
+    invoked again, leaving those that succeeded, up to PARTITION_ATTEMPTS times.
+    :param lambda_client: Lambda client - botocore.client.Lambda
+    :param method_name: Name of the method lambda - String
+    :param payloads: Payload for each partition - List(Dict)
+    :param logger: Logger for the run - Logger
+    :return responses: Method response for each partition - List(Dict)
+    """
+    def invoke(payload):
+        try:
+            response = lambda_client.invoke(FunctionName=method_name,
+                                            Payload=json_functions.dumps(payload))
+            return json_functions.loads(response.get("Payload").read())
+        except Exception as e:
+            return {"success": False, "error": f"{type(e).__name__}: {e}"}
+
+    responses = [None] * len(payloads)
+    pending = list(range(len(payloads)))
+    for attempt in range(PARTITION_ATTEMPTS):
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            for number, response in zip(pending, executor.map(
+                    invoke, [payloads[number] for number in pending])):
+                responses[number] = response
+
+        pending = [number for number in pending if not responses[number]["success"]]
+        if not pending:
+            return responses
+        logger.warning(f"Partitions {pending} failed on attempt {attempt + 1}: "
+                       f"{[responses[number]['error'] for number in pending]}")
+
+    raise exception_classes.MethodFailure(
+        "; ".join(f"Partition {number}: {responses[number]['error']}"
+                  for number in pending))
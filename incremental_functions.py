@@ -0,0 +1,300 @@
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+import dtype_functions
+import io_functions
+import lookup_functions
+import plan_functions
+import startup_functions
+
+# Prefix the state of incremental runs is kept under, followed by the out_location
+# of the run.
+STATE_PREFIX = "enrichment_state/"
+
+# Format of the state files, which keeps the column types.
+STATE_FORMAT = "arrow"
+
+# Changed whenever the state is laid out differently, forcing a full rebuild.
+STATE_VERSION = 2
+
+# Columns added to the state files.
+ROW_HASH_COLUMN = "_row_hash"
+ROW_COLUMN = "_row"
+KEY_HASH_COLUMN = "_key_hash"
+
+
+def state_location(out_location, name):
+    """
+    Gets the name in s3 of a file of the state kept for an output.
+    :param out_location: Name of the enriched output file in s3 - String
+    :param name: Name of the state file - String
+    :return file_name: Name of the state file in s3 - String
+    """
+    return f"{STATE_PREFIX}{out_location}/{name}"
+
+
+def load_manifest(bucket_name, out_location):
+    """
+    Reads the manifest of the state kept by the last incremental run.
+    :param bucket_name: Name of the s3 bucket - String
+    :param out_location: Name of the enriched output file in s3 - String
+    :return manifest: Details of the state, or None if there is none - Dict
+    """
+    client = startup_functions.client("s3")
+    try:
+        response = client.get_object(
+            Bucket=bucket_name, Key=state_location(out_location, "manifest.json"))
+    except client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response["Body"].read())
+
+
+def save_manifest(bucket_name, out_location, manifest):
+    """
+    Writes the manifest of the state, last so that it only names complete files.
+    :param bucket_name: Name of the s3 bucket - String
+    :param out_location: Name of the enriched output file in s3 - String
+    :param manifest: Details of the state - Dict
+    """
+    client = startup_functions.client("s3")
+    client.put_object(Bucket=bucket_name,
+                      Key=state_location(out_location, "manifest.json"),
+                      Body=json.dumps(manifest, indent=2))
+
+
+def config_hash(data, lookups, rules, identifier_column, period_column, file_format):
+    """
+    Hashes everything other than the rows and lookup contents that the output
+    depends on, so that state from a run configured differently is not reused.
+    :param data: Input data - DataFrame
+    :param lookups: Information about lookups required. - Dict
+    :param rules: Anomaly rules - List(Dict)
+    :param identifier_column: Column that holds the unique id of a row - String
+    :param period_column: Column that holds the period - String
+    :param file_format: Format of the output - String
+    :return config_hash: Hex digest - String
+    """
+    config = {
+        "version": STATE_VERSION,
+        "columns": [[column, str(dtype)] for column, dtype
+                    in dtype_functions.expand_dtypes(data).dtypes.items()],
+        "lookups": [[str(lookup), lookups[lookup]] for lookup in sorted(lookups)],
+        "rules": rules,
+        "identifier_column": identifier_column,
+        "period_column": period_column,
+        "file_format": file_format,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str)
+                          .encode("utf-8")).hexdigest()
+
+
+def lookup_versions(bucket_name, lookups):
+    """
+    Gets the current ETag of each lookup file.
+    :param bucket_name: Name of the s3 bucket - String
+    :param lookups: Information about lookups required. - Dict
+    :return versions: ETag of each lookup, by key - Dict
+    """
+    client = startup_functions.client("s3")
+    versions = {}
+    for lookup in lookups:
+        file_format = io_functions.file_format_for(lookups[lookup]["file_name"],
+                                                   lookups[lookup].get("file_format"))
+        versions[str(lookup)] = client.head_object(
+            Bucket=bucket_name, Key=io_functions.s3_key(lookups[lookup]["file_name"],
+                                                        file_format))["ETag"]
+    return versions
+
+
+def read_lookup(bucket_name, lookup):
+    """
+    Reads the kept columns of a lookup, through the lookup cache.
+    :param bucket_name: Name of the s3 bucket - String
+    :param lookup: Information about a lookup - Dict
+    :return data: The join column and added columns of the lookup - DataFrame
+    """
+    columns = [lookup["join_column"]] + plan_functions.added_columns(lookup)
+    return lookup_functions.lookup_cache.get(
+        bucket_name, lookup["file_name"], lookup.get("file_format"), columns)[columns]
+
+
+def lookup_schema(data):
+    """
+    Describes the columns of a lookup, a change to which forces a full rebuild.
+    :param data: Lookup data from read_lookup - DataFrame
+    :return schema: Type of each column, in order - List(List(String))
+    """
+    return [[column, str(dtype)] for column, dtype in data.dtypes.items()]
+
+
+def key_hashes(data, join_column):
+    """
+    Hashes the added values of each key of a lookup.
+    :param data: Lookup data from read_lookup - DataFrame
+    :param join_column: Column the lookup joins on - String
+    :return key_hashes: The join column and KEY_HASH_COLUMN - DataFrame
+    """
+    values = dtype_functions.expand_dtypes(data.drop(columns=join_column))
+    return pd.DataFrame({
+        join_column: data[join_column].to_numpy(),
+        KEY_HASH_COLUMN: pd.util.hash_pandas_object(values, index=False).to_numpy(),
+    })
+
+
+def changed_keys(old_hashes, new_hashes, join_column):
+    """
+    Finds the keys of a lookup that were added, removed or given different values.
+    :param old_hashes: Key hashes when the state was saved - DataFrame
+    :param new_hashes: Current key hashes - DataFrame
+    :param join_column: Column the lookup joins on - String
+    :return keys: Changed keys - LookupTable
+    """
+    old_keys = pd.Index(old_hashes[join_column])
+    new_keys = pd.Index(new_hashes[join_column])
+
+    # Lookup keys are unique, see LookupTable.
+    old_positions = old_keys.get_indexer(new_keys)
+    known = old_positions >= 0
+    changed = ~known
+    changed[known] = old_hashes[KEY_HASH_COLUMN].to_numpy()[old_positions[known]] != \
+        new_hashes[KEY_HASH_COLUMN].to_numpy()[known]
+    removed = new_keys.get_indexer(old_keys) < 0
+
+    keys = new_keys[changed].append(old_keys[removed])
+    return lookup_functions.LookupTable(pd.DataFrame({join_column: keys}),
+                                        join_column, [join_column])
+
+
+def row_hashes(data):
+    """
+    Hashes the values of each row, ignoring how the columns are stored.
+    :param data: Input data - DataFrame
+    :return hashes: Hash of each row - numpy.ndarray
+    """
+    return pd.util.hash_pandas_object(dtype_functions.expand_dtypes(data),
+                                      index=False).to_numpy()
+
+
+def row_keys(data, identifier_column, period_column):
+    """
+    Gets the key rows are matched between runs on.
+    :param data: Input data or row state - DataFrame
+    :param identifier_column: Column that holds the unique id of a row - String
+    :param period_column: Column that holds the period - String
+    :return keys: Identifier and period of each row - MultiIndex
+    """
+    return pd.MultiIndex.from_arrays(
+        [np.asarray(data[identifier_column]), np.asarray(data[period_column])])
+
+
+def splice_column(fresh, previous, selected):
+    """
+    Combines the values of a column for the rows enriched in this run with those
+    kept from the last run. A column that has no nulls once combined is given the
+    integer type it was enriched with, as a full run would.
+    :param fresh: Values of the selected rows - Series
+    :param previous: Values of the other rows - Series
+    :param selected: Whether each row was enriched in this run - numpy.ndarray(Bool)
+    :return values: Value of every row - Series
+    """
+    positions = np.arange(len(selected))
+    values = pd.concat([
+        pd.Series(previous.array, index=positions[~selected]),
+        pd.Series(fresh.array, index=positions[selected])]).sort_index()
+
+    if values.dtype != fresh.dtype and fresh.dtype.kind in "iu" and \
+            not values.isnull().any():
+        values = values.astype(fresh.dtype)
+    return values.reset_index(drop=True)
+
+
+def splice_anomalies(fresh, previous, current_rows, data):
+    """
+    Combines the anomalies of the rows enriched in this run with those kept from
+    the last run, ordered by row and, for rendered reports, then by rule.
+    Reported columns without nulls once combined are given the type they have in
+    the data, as a full run would.
+    :param fresh: Anomalies of the rows enriched in this run, indexed by row
+                  - DataFrame
+    :param previous: Anomalies saved by the last run, with ROW_COLUMN - DataFrame
+    :param current_rows: Row of this run each row of the last run was kept as, -1
+                         where it was enriched again or is gone - numpy.ndarray
+    :param data: Enriched data - DataFrame
+    :return anomalies: Anomalies of every row, indexed by row - DataFrame
+    """
+    rows = current_rows[previous[ROW_COLUMN].to_numpy()]
+    kept = previous[rows >= 0].drop(columns=ROW_COLUMN)
+    kept.index = rows[rows >= 0]
+
+    frames = [frame for frame in [fresh, kept] if len(frame) > 0]
+    if not frames:
+        return fresh
+
+    # Stable, so each row's anomalies stay in rule order.
+    anomalies = pd.concat(frames, sort=False).sort_index(kind="mergesort")
+    for column in anomalies.columns:
+        if column in data.columns and data[column].dtype.kind in "iu" and \
+                anomalies[column].dtype != data[column].dtype and \
+                not anomalies[column].isnull().any():
+            anomalies[column] = anomalies[column].astype(data[column].dtype)
+    return anomalies
+
+
+def read_state(bucket_name, file_name):
+    """
+    Reads a file of the state.
+    :param bucket_name: Name of the s3 bucket - String
+    :param file_name: Name of the state file in s3, from the manifest - String
+    :return data: Contents of the file - DataFrame
+    """
+    return io_functions.read_dataframe(bucket_name, file_name, STATE_FORMAT)
+
+
+def save_state(bucket_name, out_location, previous_manifest, manifest, files):
+    """
+    Writes the files of the state and then its manifest. Each save is a new
+    generation of files, so a run failing part way through leaves the last
+    manifest naming the files it was saved with. Files the new manifest no longer
+    names are deleted once it is written.
+    :param bucket_name: Name of the s3 bucket - String
+    :param out_location: Name of the enriched output file in s3 - String
+    :param previous_manifest: Manifest of the last saved state, if any - Dict
+    :param manifest: Manifest of the state, without its files - Dict
+    :param files: Data to write, with the path in the manifest to name it under
+                  - List(Tuple(List(String), DataFrame))
+    :return manifest: Manifest of the saved state - Dict
+    """
+    generation = 1 if previous_manifest is None else \
+        previous_manifest["generation"] + 1
+    manifest = dict(manifest, generation=generation)
+
+    for path, data in files:
+        file_name = state_location(out_location, f"{'-'.join(path)}-{generation}")
+        io_functions.write_dataframe(bucket_name, file_name,
+                                     dtype_functions.expand_dtypes(data),
+                                     STATE_FORMAT)
+        entry = manifest
+        for name in path[:-1]:
+            entry = entry[name]
+        entry[path[-1]] = file_name
+
+    save_manifest(bucket_name, out_location, manifest)
+
+    if previous_manifest is not None:
+        superseded = set(_state_files(previous_manifest)) - \
+            set(_state_files(manifest))
+        client = startup_functions.client("s3")
+        for file_name in sorted(superseded):
+            client.delete_object(Bucket=bucket_name,
+                                 Key=io_functions.s3_key(file_name, STATE_FORMAT))
+    return manifest
+
+
+def _state_files(manifest):
+    yield manifest["rows"]
+    yield manifest["anomalies"]
+    for lookup in manifest["lookups"].values():
+        yield lookup["hashes"]
@@ -0,0 +1,559 @@
+import codecs
+import io
+import json
+import os
+import re
+
+import pandas as pd
+from es_aws_functions import aws_functions
+
+import compression_functions
+import json_functions
+import startup_functions
+
+DEFAULT_FILE_FORMAT = "json"
+
+# Extension used for each supported file format.
+FILE_FORMATS = {
+    "json": ".json",
+    "jsonl": ".jsonl",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+}
+
+# Other extensions recognised when working out the format of a file.
+EXTENSION_ALIASES = {
+    ".feather": "arrow",
+}
+
+# Size of the chunks read from s3 when streaming a JSON file.
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# s3 rejects multipart uploads with parts, other than the last, below 5 MB.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Formats that can be written a chunk at a time.
+STREAMABLE_FORMATS = ["json", "jsonl"]
+
+# Formats that store the type of each column.
+COLUMNAR_FORMATS = ["parquet", "arrow"]
+
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def file_format_for(file_name, file_format=None):
+    """
+    Works out the format of a file, from the runtime flag if one is given or
+    otherwise from the file's extension, defaulting to JSON.
+    :param file_name: Name of the file in s3 - String
+    :param file_format: Format requested in the runtime variables - String
+    :return file_format: One of FILE_FORMATS - String
+    """
+    if file_format:
+        return file_format
+
+    extension = os.path.splitext(file_name)[1].lower()
+    for name, format_extension in FILE_FORMATS.items():
+        if extension == format_extension:
+            return name
+    return EXTENSION_ALIASES.get(extension, DEFAULT_FILE_FORMAT)
+
+
+def s3_key(file_name, file_format=None):
+    """
+    Returns the s3 key for a file. JSON files keep the existing convention of
+    always appending ".json", other formats only add their extension if the
+    file name does not already have one.
+    :param file_name: Name of the file in s3 - String
+    :param file_format: Format requested in the runtime variables - String
+    :return key: Key of the object in s3 - String
+    """
+    file_format = file_format_for(file_name, file_format)
+    if file_format == "json":
+        return file_name + FILE_FORMATS["json"]
+
+    if file_format_for(file_name) == file_format:
+        return file_name
+    return file_name + FILE_FORMATS[file_format]
+
+
+def dataframe_from_bytes(body, file_format, columns=None):
+    """
+    Parses the contents of a file into a DataFrame, decompressing it first if it
+    was compressed.
+    :param body: Contents of the file - Bytes
+    :param file_format: One of FILE_FORMATS - String
+    :param columns: Columns to keep, or None for all - List(String)
+    :return data: Parsed data - DataFrame
+    """
+    body = compression_functions.decompress(body)
+    if file_format == "parquet":
+        return pd.read_parquet(io.BytesIO(body), columns=columns)
+
+    if file_format == "arrow":
+        return pd.read_feather(io.BytesIO(body), columns=columns)
+
+    data = pd.read_json(body.decode("utf-8"), dtype=False,
+                        lines=file_format == "jsonl")
+    if columns is not None:
+        data = data[columns]
+    return data
+
+
+def dataframe_from_stream(stream, file_format, columns=None):
+    """
+    Parses a file object, such as an s3 response body, into a DataFrame. JSON
+    files read with a projection are streamed record by record so that columns
+    which are not needed are never materialised. Compressed files are
+    decompressed as they are read.
+    :param stream: File object with a read method - File
+    :param file_format: One of FILE_FORMATS - String
+    :param columns: Columns to keep, or None for all - List(String)
+    :return data: Parsed data - DataFrame
+    """
+    if file_format in STREAMABLE_FORMATS and columns is not None:
+        return read_json_columns(compression_functions.open_stream(stream), columns,
+                                 file_format)
+    return dataframe_from_bytes(stream.read(), file_format, columns)
+
+
+def read_json_columns(stream, columns, file_format="json"):
+    """
+    Builds a DataFrame of the given columns from a JSON array of records, or from
+    JSON Lines.
+    :param stream: File object with a read method - File
+    :param columns: Columns to keep - List(String)
+    :param file_format: Either "json" or "jsonl" - String
+    :return data: Projected data - DataFrame
+    """
+    if file_format == "jsonl":
+        records = iter_json_lines(stream)
+    else:
+        records = iter_json_records(stream)
+
+    rows = []
+    not_found = set(columns)
+    for record in records:
+        if not_found:
+            not_found.difference_update(record)
+        rows.append(tuple(record.get(column) for column in columns))
+
+    if rows and not_found:
+        raise KeyError(f"Columns not found in file: {sorted(not_found)}")
+
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+
+def iter_json_records(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields the records of a JSON array one at a time, reading the stream in chunks
+    so the whole file is never held in memory.
+    :param stream: File object with a read method - File
+    :param chunk_size: Number of bytes to read at a time - Int
+    :return record: Generator of records - Dict
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    end_of_stream = False
+
+    while True:
+        chunk = stream.read(chunk_size)
+        end_of_stream = not chunk
+        buffer = buffer[position:] + utf8.decode(chunk or b"", final=end_of_stream)
+        position = 0
+
+        while True:
+            position = _SEPARATORS.match(buffer, position).end()
+            if position == len(buffer):
+                break
+
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("Expected a JSON array of records.")
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == "]":
+                return
+
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The record continues in the next chunk.
+                if end_of_stream:
+                    raise
+                break
+            yield record
+
+        if end_of_stream:
+            raise ValueError("Unexpected end of JSON array.")
+
+
+def iter_json_lines(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields the records of a JSON Lines file one at a time, reading the stream in
+    chunks so the whole file is never held in memory.
+    :param stream: File object with a read method - File
+    :param chunk_size: Number of bytes to read at a time - Int
+    :return record: Generator of records - Dict
+    """
+    remainder = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+    if remainder.strip():
+        yield json.loads(remainder)
+
+
+def iter_dataframe_chunks(bucket_name, file_name, file_format, chunk_size):
+    """
+    Reads a file from s3 as DataFrames of at most chunk_size rows. JSON and JSON
+    Lines are streamed from s3, and decompressed as they are read if they were
+    compressed. They are streamed twice, first to find the columns of the whole
+    file and which of them reading it whole would make floats, so that every
+    chunk has the columns and types the whole file would. Parquet and Arrow files
+    are downloaded, but only decoded a row group or record batch at a time.
+    :param bucket_name: Name of the s3 bucket - String
+    :param file_name: Name of the file in s3 - String
+    :param file_format: Format requested in the runtime variables - String
+    :param chunk_size: Maximum number of rows in each chunk - Int
+    :return chunk: Generator of DataFrames - DataFrame
+    """
+    file_format = file_format_for(file_name, file_format)
+    client = startup_functions.client("s3")
+    response = client.get_object(Bucket=bucket_name, Key=s3_key(file_name, file_format))
+
+    if file_format in STREAMABLE_FORMATS:
+        columns, float_columns = scan_json_columns(
+            _iter_records(response["Body"], file_format))
+        response = client.get_object(Bucket=bucket_name,
+                                     Key=s3_key(file_name, file_format))
+
+        rows = []
+        for record in _iter_records(response["Body"], file_format):
+            rows.append(record)
+            if len(rows) == chunk_size:
+                yield _json_chunk(rows, columns, float_columns)
+                rows = []
+        if rows:
+            yield _json_chunk(rows, columns, float_columns)
+        return
+
+    # Imported here as pyarrow is only needed for columnar files.
+    import pyarrow
+
+    body = pyarrow.BufferReader(
+        compression_functions.decompress(response["Body"].read()))
+    if file_format == "parquet":
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(body)
+        batches = (parquet_file.read_row_group(group)
+                   for group in range(parquet_file.num_row_groups))
+    else:
+        import pyarrow.ipc
+        arrow_file = pyarrow.ipc.open_file(body)
+        batches = (arrow_file.get_batch(batch)
+                   for batch in range(arrow_file.num_record_batches))
+
+    for batch in batches:
+        data = batch.to_pandas()
+        for start in range(0, len(data), chunk_size):
+            yield data.iloc[start:start + chunk_size].reset_index(drop=True)
+
+
+def scan_json_columns(records):
+    """
+    Finds the columns of JSON records, in the order reading them whole gives, and
+    those that reading them whole would make floats. These are the columns that
+    only hold numbers and are somewhere null, missing or not a whole number.
+    :param records: Records to scan - Iterator(Dict)
+    :return columns: Every column, in order - List(String)
+    :return float_columns: Columns read as floats - Set(String)
+    """
+    counts = {}
+    numeric = set()
+    not_numeric = set()
+    promoted = set()
+    total = 0
+    for record in records:
+        total += 1
+        for column, value in record.items():
+            counts[column] = counts.get(column, 0) + 1
+            if value is None or isinstance(value, float):
+                promoted.add(column)
+            if isinstance(value, bool) or \
+                    value is not None and not isinstance(value, (int, float)):
+                not_numeric.add(column)
+            elif value is not None:
+                numeric.add(column)
+
+    promoted.update(column for column, count in counts.items() if count < total)
+    return list(counts), (numeric & promoted) - not_numeric
+
+
+def _iter_records(body, file_format):
+    stream = compression_functions.open_stream(body)
+    if file_format == "jsonl":
+        return iter_json_lines(stream)
+    return iter_json_records(stream)
+
+
+def _json_chunk(rows, columns, float_columns):
+    data = json_functions.read_records(rows).reindex(columns=columns)
+    for column in float_columns:
+        if data[column].dtype.kind != "f":
+            data[column] = data[column].astype("float64")
+    return data
+
+
+def dataframe_to_bytes(data, file_format):
+    """
+    Serialises a DataFrame in the given format. The index is not written.
+    :param data: Data to serialise - DataFrame
+    :param file_format: One of FILE_FORMATS - String
+    :return body: Contents of the file - Bytes
+    """
+    if file_format == "json":
+        return data.to_json(orient="records").encode("utf-8")
+
+    if file_format == "jsonl":
+        return data.to_json(orient="records", lines=True).encode("utf-8")
+
+    buffer = io.BytesIO()
+    if file_format == "parquet":
+        data.to_parquet(buffer, index=False)
+    else:
+        data.reset_index(drop=True).to_feather(buffer)
+    return buffer.getvalue()
+
+
+def read_dataframe(bucket_name, file_name, file_format=None, columns=None):
+    """
+    Reads a DataFrame from s3 in any supported format, compressed or not.
+    :param bucket_name: Name of the s3 bucket - String
+    :param file_name: Name of the file in s3 - String
+    :param file_format: Format requested in the runtime variables - String
+    :param columns: Columns to keep, or None for all - List(String)
+    :return data: Data read from s3 - DataFrame
+    """
+    file_format = file_format_for(file_name, file_format)
+    client = startup_functions.client("s3")
+    response = client.get_object(Bucket=bucket_name, Key=s3_key(file_name, file_format))
+    return dataframe_from_bytes(response["Body"].read(), file_format, columns)
+
+
+def write_dataframe(bucket_name, file_name, data, file_format=None, compression=None):
+    """
+    Writes a DataFrame to s3 in any supported format.
+    :param bucket_name: Name of the s3 bucket - String
+    :param file_name: Name of the file in s3 - String
+    :param data: Data to write - DataFrame
+    :param file_format: Format requested in the runtime variables - String
+    :param compression: One of compression_functions.COMPRESSIONS, or None - String
+    :return: Number of bytes written - Int
+    """
+    file_format = file_format_for(file_name, file_format)
+    if file_format == "json" and compression is None:
+        # to_json escapes anything outside ASCII, so characters are bytes.
+        body = data.to_json(orient="records")
+        aws_functions.save_to_s3(bucket_name, file_name, body)
+        return len(body)
+
+    return write_bytes(bucket_name, s3_key(file_name, file_format),
+                       compression_functions.compress(
+                           dataframe_to_bytes(data, file_format), compression),
+                       compression)
+
+
+def write_bytes(bucket_name, key, body, compression=None):
+    """
+    Writes the contents of a file to s3, marking how it was compressed.
+    :param bucket_name: Name of the s3 bucket - String
+    :param key: Key of the object in s3 - String
+    :param body: Contents of the file, already compressed - Bytes
+    :param compression: One of compression_functions.COMPRESSIONS, or None - String
+    :return: Number of bytes written - Int
+    """
+    client = startup_functions.client("s3")
+    if compression is None:
+        client.put_object(Bucket=bucket_name, Key=key, Body=body)
+    else:
+        client.put_object(Bucket=bucket_name, Key=key, Body=body,
+                          ContentEncoding=compression)
+    return len(body)
+
+
+class S3MultipartWriter:
+    """
+    File object that uploads to s3 as it is written to. Data is sent in parts of
+    part_size bytes, so no more than one part is held in memory. Writes smaller
+    than one part in total are sent with a single PUT.
+    """
+
+    def __init__(self, bucket_name, key, part_size=MIN_PART_SIZE,
+                 content_encoding=None):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self._object_args = {} if content_encoding is None else \
+            {"ContentEncoding": content_encoding}
+        self.bytes_written = 0
+        self._client = startup_functions.client("s3")
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        """
+        Buffers data, uploading a part each time part_size bytes are buffered.
+        :param data: Data to upload - Bytes
+        :return: Number of bytes written - Int
+        """
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def close(self):
+        """
+        Uploads anything still buffered and completes the upload.
+        """
+        if self._upload_id is None:
+            self._client.put_object(Bucket=self.bucket_name, Key=self.key,
+                                    Body=bytes(self._buffer), **self._object_args)
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self._client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts})
+        self._buffer = bytearray()
+
+    def abort(self):
+        """
+        Abandons the upload, leaving nothing in s3.
+        """
+        if self._upload_id is not None:
+            self._client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id)
+        self._buffer = bytearray()
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self._client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key,
+                **self._object_args)["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self._client.upload_part(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=body)
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+
+class DataFrameStreamWriter:
+    """
+    Writes DataFrames to one JSON or JSON Lines file in s3 a chunk at a time, in
+    the same layout as writing them all at once.
+    """
+
+    def __init__(self, bucket_name, file_name, file_format=None, skip_empty=False,
+                 compression=None):
+        """
+        :param bucket_name: Name of the s3 bucket - String
+        :param file_name: Name of the file in s3 - String
+        :param file_format: Format requested in the runtime variables - String
+        :param skip_empty: Do not create the file if no rows are written - Boolean
+        :param compression: One of compression_functions.COMPRESSIONS to compress
+                            the file as it is written, or None - String
+        """
+        self.file_format = file_format_for(file_name, file_format)
+        if self.file_format not in STREAMABLE_FORMATS:
+            raise ValueError(f"Cannot stream output as {self.file_format}, "
+                             f"use one of {STREAMABLE_FORMATS}.")
+        self.skip_empty = skip_empty
+        self.rows = 0
+        self._line_ended = True
+        self._writer = S3MultipartWriter(bucket_name, s3_key(file_name, file_format),
+                                         content_encoding=compression)
+        self._compressor = None if compression is None else \
+            compression_functions.compressor(compression)
+
+    @property
+    def bytes_written(self):
+        """
+        Number of bytes written to the file so far - Int
+        """
+        return self._writer.bytes_written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._writer.abort()
+
+    def write(self, data):
+        """
+        Appends the records of a DataFrame to the file.
+        :param data: Records to append - DataFrame
+        :return: None
+        """
+        if len(data) == 0:
+            return
+
+        if self.file_format == "jsonl":
+            # Lines are only separated, as some versions of pandas end the last
+            # line and others do not, so the file ends as writing it whole would.
+            body = dataframe_to_bytes(data, "jsonl")
+            self._write(body if self._line_ended else b"\n" + body)
+            self._line_ended = body.endswith(b"\n")
+        else:
+            # Strip the brackets from each chunk's array to join them into one.
+            records = dataframe_to_bytes(data, "json")[1:-1]
+            self._write((b"," if self.rows else b"[") + records)
+        self.rows += len(data)
+
+    def close(self):
+        """
+        Finishes the file, or abandons it if it is empty and skip_empty is set.
+        """
+        if self.rows == 0:
+            if self.skip_empty:
+                self._writer.abort()
+                return
+            if self.file_format == "json":
+                self._write(b"[")
+        if self.file_format == "json":
+            self._write(b"]")
+        if self._compressor is not None:
+            self._writer.write(self._compressor.flush())
+        self._writer.close()
+
+    def _write(self, body):
+        if self._compressor is not None:
+            body = self._compressor.compress(body)
+        self._writer.write(body)
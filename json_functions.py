@@ -0,0 +1,91 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    # Not in every layer, the standard library is used without it.
+    orjson = None
+
+# Column names pd.read_json converts to dates, see _is_date_column.
+DATE_COLUMN_NAMES = ["modified", "date", "datetime"]
+DATE_COLUMN_SUFFIXES = ("_at", "_time")
+DATE_COLUMN_PREFIXES = ("timestamp",)
+
+
+def loads(text):
+    """
+    Parses JSON, with orjson when it is installed.
+    :param text: JSON document - String or Bytes
+    :return value: Parsed value - Object
+    """
+    if orjson is None:
+        return json.loads(text)
+    return orjson.loads(text)
+
+
+def dumps(value):
+    """
+    Serialises a value as JSON, with orjson when it is installed. Keys that are
+    not strings are converted to strings, as json.dumps does.
+    :param value: Value to serialise - Object
+    :return text: JSON document - String
+    """
+    if orjson is None:
+        return json.dumps(value)
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS |
+                        orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+
+
+def dumps_payload(payload, records=None):
+    """
+    Serialises a method payload, with the data given as JSON records placed in
+    the RuntimeVariables as they are. The records are not parsed and are not
+    encoded again as a string, which would escape every quote in them.
+    :param payload: Payload holding only RuntimeVariables - Dict
+    :param records: Data as a JSON array of records, or None - String
+    :return text: JSON document - String
+    """
+    runtime_variables = dumps(payload["RuntimeVariables"])
+    if records is not None:
+        separator = "," if len(payload["RuntimeVariables"]) > 0 else ""
+        runtime_variables = f'{runtime_variables[:-1]}{separator}"data":{records}}}'
+    return f'{{"RuntimeVariables":{runtime_variables}}}'
+
+
+def read_records(data):
+    """
+    Builds a DataFrame from JSON records, as pd.read_json(data, dtype=False) does
+    but with a faster parser. Nulls in object columns are NaN, and frames with
+    columns that pd.read_json would convert to dates are read by it instead.
+    :param data: JSON array of records, or the records already parsed
+                 - String or List(Dict)
+    :return data: Parsed data - DataFrame
+    """
+    records = loads(data) if isinstance(data, (str, bytes)) else data
+    data_df = pd.DataFrame(records)
+
+    if any(_is_date_column(column) for column in data_df.columns):
+        if not isinstance(data, (str, bytes)):
+            data = dumps(data)
+        return pd.read_json(data, dtype=False)
+
+    for column in data_df.columns:
+        values = data_df[column]
+        if values.dtype == object:
+            nulls = values.isnull().to_numpy()
+            if nulls.any():
+                values = values.to_numpy(copy=True)
+                values[nulls] = np.nan
+                data_df[column] = values
+    return data_df
+
+
+def _is_date_column(column):
+    if not isinstance(column, str):
+        return False
+    column = column.lower()
+    return column in DATE_COLUMN_NAMES or column.endswith(DATE_COLUMN_SUFFIXES) or \
+        column.startswith(DATE_COLUMN_PREFIXES)
@@ -0,0 +1,592 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_categorical_dtype, is_numeric_dtype, is_object_dtype
+
+import disk_cache_functions
+import dtype_functions
+import io_functions
+import startup_functions
+
+# Default upper bound on the memory held by cached lookups (128 MB).
+DEFAULT_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# Default number of lookup files fetched at once.
+DEFAULT_FETCH_WORKERS = 8
+
+# Integer keys spanning at most this many values per key are found with a
+# direct-address table, others by hashing.
+DIRECT_ADDRESS_MAX_SPAN = 4
+
+
+class LookupCache:
+    """
+    Holds lookup DataFrames in memory between warm invocations of a lambda.
+    Entries are keyed by (bucket, file_name) and revalidated against the S3 ETag
+    with a HEAD request before reuse, so a full download only happens when the
+    file has changed. Least recently used entries are evicted once the cached
+    frames exceed max_bytes. When given a DiskCache, lookups are also kept on
+    disk and memory-mapped back, so a lookup evicted from memory is not
+    downloaded and parsed again while it is current.
+
+    Cached frames are shared between callers and must be treated as read-only.
+    The cache may be used from several threads, S3 requests are made outside of
+    its lock.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_MAX_BYTES, disk=None):
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        # ETag each lookup was last seen with during a batch, see batch.
+        self._validated = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Resets the hit/miss/bytes counters, called at the start of each run.
+        """
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "disk_hits": 0,
+            "evictions": 0,
+            "bytes_downloaded": 0,
+            "bytes_saved": 0,
+            "lookups": {},
+        }
+
+    def clear(self):
+        """
+        Drops every cached lookup, including those kept on disk.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+        if self.disk is not None:
+            self.disk.clear()
+
+    @contextmanager
+    def batch(self):
+        """
+        Treats the runs of a batch as one, checking the ETag of each lookup once
+        rather than on every get, so the lookups are the same for every run.
+        :return: Context manager
+        """
+        with self._lock:
+            self._validated = {}
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._validated = None
+
+    def get(self, bucket_name, file_name, file_format=None, columns=None):
+        """
+        Returns the lookup as a DataFrame, from memory if the cached copy is current.
+        When columns are given only those are read from the file, although a cached
+        frame may also hold columns requested by earlier callers.
+        :param bucket_name: Name of the s3 bucket - String
+        :param file_name: Name of the lookup file in s3 - String
+        :param file_format: Format of the lookup if not given by its extension - String
+        :param columns: Columns needed from the lookup, or None for all - List(String)
+        :return data: Lookup data - DataFrame
+        """
+        cache_key = (bucket_name, file_name)
+        file_format = io_functions.file_format_for(file_name, file_format)
+        s3_key = io_functions.s3_key(file_name, file_format)
+
+        client = startup_functions.client("s3")
+        with self._lock:
+            entry = self._entries.get(cache_key)
+
+        etag = None
+        if entry is not None:
+            with self._lock:
+                etag = None if self._validated is None else \
+                    self._validated.get(cache_key)
+            if etag != entry["etag"]:
+                etag = client.head_object(Bucket=bucket_name, Key=s3_key)["ETag"]
+            with self._lock:
+                if etag == entry["etag"]:
+                    self._validate(cache_key, etag)
+                    if _covers(entry["columns"], columns):
+                        if cache_key in self._entries:
+                            self._entries.move_to_end(cache_key)
+                        self.stats["hits"] += 1
+                        self.stats["bytes_saved"] += entry["content_length"]
+                        return entry["data"]
+
+                    # Re-read with the extra columns so both callers can share it.
+                    if columns is not None and entry["columns"] is not None:
+                        columns = entry["columns"] + [
+                            column for column in columns
+                            if column not in entry["columns"]]
+                self._discard(cache_key)
+
+        if self.disk is not None and self.disk.enabled and \
+                self.disk.holds(bucket_name, file_name):
+            data = self._get_from_disk(client, bucket_name, file_name, s3_key, etag,
+                                       columns)
+            if data is not None:
+                return data
+
+        response = client.get_object(Bucket=bucket_name, Key=s3_key)
+        data = io_functions.dataframe_from_stream(response["Body"], file_format,
+                                                  columns)
+        content_length = response["ContentLength"]
+        if self.disk is not None and self.disk.enabled:
+            data = self.disk.store(bucket_name, file_name, response["ETag"], data,
+                                   columns, content_length)
+        size = int(data.memory_usage(index=True, deep=True).sum())
+
+        with self._lock:
+            self.stats["misses"] += 1
+            self.stats["bytes_downloaded"] += content_length
+            self.stats["lookups"][file_name] = {"bytes_read": content_length,
+                                                "bytes_kept": size}
+            self._validate(cache_key, response["ETag"])
+            self._store(cache_key, {
+                "etag": response["ETag"],
+                "content_length": content_length,
+                "columns": columns,
+                "data": data,
+                "size": size,
+                "tables": {},
+            })
+        return data
+
+    def _get_from_disk(self, client, bucket_name, file_name, s3_key, etag, columns):
+        cache_key = (bucket_name, file_name)
+        if etag is None:
+            with self._lock:
+                etag = None if self._validated is None else \
+                    self._validated.get(cache_key)
+        if etag is None:
+            etag = client.head_object(Bucket=bucket_name, Key=s3_key)["ETag"]
+
+        data, details = self.disk.load(bucket_name, file_name, etag, columns)
+        if data is None:
+            return None
+        size = int(data.memory_usage(index=True, deep=True).sum())
+
+        with self._lock:
+            self.stats["disk_hits"] += 1
+            self.stats["bytes_saved"] += details["content_length"]
+            self.stats["lookups"][file_name] = {"bytes_read": 0, "bytes_kept": size}
+            self._validate(cache_key, etag)
+            self._store(cache_key, {
+                "etag": etag,
+                "content_length": details["content_length"],
+                "columns": columns,
+                "data": data,
+                "size": size,
+                "tables": {},
+            })
+        return data
+
+    def get_table(self, bucket_name, file_name, join_column, columns_to_keep,
+                  file_format=None, dtypes=None):
+        """
+        Returns the lookup as a LookupTable indexed on join_column. The index is
+        built once and cached alongside the lookup data.
+        :param bucket_name: Name of the s3 bucket - String
+        :param file_name: Name of the lookup file in s3 - String
+        :param join_column: Column to index the lookup on - String
+        :param columns_to_keep: Columns from the lookup to keep - List(String)
+        :param file_format: Format of the lookup if not given by its extension - String
+        :param dtypes: Types to give gathered columns without nulls - Dict
+        :return table: Indexed lookup - LookupTable
+        """
+        columns = [join_column] + [column for column in columns_to_keep
+                                   if column != join_column]
+        data = self.get(bucket_name, file_name, file_format, columns)
+        return self._table(bucket_name, file_name, data, join_column, columns_to_keep,
+                           dtypes)
+
+    def get_tables(self, bucket_name, lookups, max_workers=DEFAULT_FETCH_WORKERS):
+        """
+        Returns several lookups as LookupTables, fetching the files concurrently so
+        the time taken is that of the slowest lookup rather than the sum of them.
+        Lookups of the same file share a single read of the columns they need.
+        :param bucket_name: Name of the s3 bucket - String
+        :param lookups: The 'file_name', 'join_column', 'columns_to_keep' and
+                        optional 'file_format' of each lookup - List(Dict)
+        :param max_workers: Most lookup files to fetch at once - Int
+        :return tables: Indexed lookups, in the order given - List(LookupTable)
+        """
+        by_file = OrderedDict()
+        for position, lookup in enumerate(lookups):
+            by_file.setdefault(lookup["file_name"], []).append(position)
+
+        def fetch(file_name, positions):
+            columns = _lookup_columns([lookups[position] for position in positions])
+            data = self.get(bucket_name, file_name,
+                            lookups[positions[0]].get("file_format"), columns)
+            return [self._table(bucket_name, file_name, data,
+                                lookups[position]["join_column"],
+                                lookups[position]["columns_to_keep"])
+                    for position in positions]
+
+        tables = [None] * len(lookups)
+        if not by_file:
+            return tables
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(by_file))) as pool:
+            futures = [(positions, pool.submit(fetch, file_name, positions))
+                       for file_name, positions in by_file.items()]
+            for positions, future in futures:
+                for position, table in zip(positions, future.result()):
+                    tables[position] = table
+        return tables
+
+    def prefetch(self, bucket_name, lookups, max_workers=DEFAULT_FETCH_WORKERS):
+        """
+        Reads lookups into the cache ahead of the runs that need them, each file
+        once with every column the lookups need from it. A file that cannot be
+        read is left for the runs that need it to fail on.
+        :param bucket_name: Name of the s3 bucket - String
+        :param lookups: The 'file_name', 'join_column', 'columns_to_keep' and
+                        optional 'file_format' of each lookup - List(Dict)
+        :param max_workers: Most lookup files to fetch at once - Int
+        :return failed: Files that could not be read - List(String)
+        """
+        by_file = OrderedDict()
+        for lookup in lookups:
+            by_file.setdefault(lookup["file_name"], []).append(lookup)
+
+        def fetch(file_name, file_lookups):
+            try:
+                self.get(bucket_name, file_name, file_lookups[0].get("file_format"),
+                         _lookup_columns(file_lookups))
+            except Exception:
+                return False
+            return True
+
+        if not by_file:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(by_file))) as pool:
+            futures = [(file_name, pool.submit(fetch, file_name, file_lookups))
+                       for file_name, file_lookups in by_file.items()]
+            return [file_name for file_name, future in futures
+                    if not future.result()]
+
+    def _table(self, bucket_name, file_name, data, join_column, columns_to_keep,
+               dtypes=None):
+        table_key = (join_column, tuple(columns_to_keep))
+        with self._lock:
+            entry = self._entries.get((bucket_name, file_name))
+            if entry is not None and entry["data"] is data and \
+                    table_key in entry["tables"]:
+                return entry["tables"][table_key]
+
+        table = LookupTable(data, join_column, columns_to_keep, file_name, dtypes)
+
+        with self._lock:
+            # The entry is only missing if the lookup was too large to cache, or
+            # has been replaced since it was read.
+            entry = self._entries.get((bucket_name, file_name))
+            if entry is not None and entry["data"] is data:
+                if table_key in entry["tables"]:
+                    return entry["tables"][table_key]
+                entry["tables"][table_key] = table
+                entry["size"] += table.nbytes
+                self.current_bytes += table.nbytes
+                self._evict()
+        return table
+
+    def _store(self, cache_key, entry):
+        # A lookup larger than the whole budget is used once and not kept.
+        if entry["size"] > self.max_bytes:
+            return
+        # Another thread may have stored the same lookup in the meantime.
+        self._discard(cache_key)
+        self._entries[cache_key] = entry
+        self.current_bytes += entry["size"]
+        self._evict()
+
+    def _validate(self, cache_key, etag):
+        if self._validated is not None:
+            self._validated[cache_key] = etag
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._discard(oldest_key)
+            self.stats["evictions"] += 1
+
+    def _discard(self, cache_key):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self.current_bytes -= entry["size"]
+
+
+def _lookup_columns(lookups):
+    # Join and kept columns of lookups of the same file, each once.
+    columns = []
+    for lookup in lookups:
+        for column in [lookup["join_column"]] + lookup["columns_to_keep"]:
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+def _covers(cached_columns, columns):
+    if cached_columns is None:
+        return True
+    return columns is not None and set(columns).issubset(cached_columns)
+
+
+class LookupTable:
+    """
+    A lookup indexed once on its join column. Enriching data gathers the kept
+    lookup columns by position onto the input, which avoids re-hashing the
+    lookup and copying the existing input columns as pd.merge does.
+    Columns given in dtypes are converted back to that type after gathering when
+    they have no nulls, for lookups whose columns were widened to hold nulls.
+    The kept columns are stored compactly, see dtype_functions. String keys are
+    matched to numeric keys by value, so "076" finds 76. Dense integer keys
+    matched to integers are found with a DirectIndex rather than by hashing.
+    """
+
+    def __init__(self, data, join_column, columns_to_keep, file_name="", dtypes=None):
+        keys = data[join_column]
+        self._direct_index = DirectIndex.build(keys.to_numpy()) \
+            if _is_integer(keys.dtype) else None
+        if self._direct_index is not None:
+            duplicate_keys = sorted(
+                self._direct_index.duplicates(keys.to_numpy()).tolist(), key=str)
+        else:
+            duplicate_keys = sorted(set(keys[keys.duplicated()].tolist()), key=str)
+        if duplicate_keys:
+            raise ValueError(f"Lookup {file_name} has duplicate values in join column "
+                             f"{join_column}: {duplicate_keys[:10]}")
+
+        self.join_column = join_column
+        self.dtypes = dtypes or {}
+        self.value_columns = [column for column in columns_to_keep
+                              if column != join_column]
+        self.index = pd.Index(keys)
+        self.data = dtype_functions.compact_dtypes(
+            data[[join_column] + self.value_columns], exclude=[join_column])
+        self.nbytes = int(self.index.memory_usage(deep=True) +
+                          self.data.memory_usage(index=True, deep=True).sum())
+        if self._direct_index is not None:
+            self.nbytes += self._direct_index.nbytes
+        self._composite = None
+        self._numeric_index = None
+
+    def enrich(self, input_data, columns=None):
+        """
+        Left joins the lookup columns onto input_data. Rows without a match are
+        given nulls, as with a left merge.
+        :param input_data: Data to enrich, must contain the join column - DataFrame
+        :param columns: Kept columns to join, or None for all of them. All are
+                        joined if any clashes with a column of the data
+                        - List(String)
+        :return outdata: input_data with the lookup columns appended - DataFrame
+        """
+        # Fall back to a merge so clashing column names get the usual suffixes.
+        if any(column in input_data.columns for column in self.value_columns):
+            return pd.merge(input_data, self.data, on=self.join_column, how="left")
+
+        positions = self.positions(input_data[self.join_column])
+
+        # A shallow copy means only the new columns are allocated.
+        outdata = input_data.copy(deep=False)
+        for column in self.value_columns:
+            if columns is not None and column not in columns:
+                continue
+            outdata[column] = take_with_nulls(self.data[column], positions)
+            if column in self.dtypes and outdata[column].dtype != self.dtypes[column] \
+                    and not outdata[column].isnull().any():
+                outdata[column] = outdata[column].astype(self.dtypes[column])
+        return outdata
+
+    def coverage(self, keys, columns):
+        """
+        Finds which keys the lookup holds a value for in each of the given
+        columns, without gathering the values.
+        :param keys: Keys to look up - Series
+        :param columns: Kept columns to check - List(String)
+        :return present: Whether each key has a value, by column
+                         - Dict(numpy.ndarray(Bool))
+        """
+        positions = self.positions(keys)
+        present = {}
+        for column in columns:
+            # The extra False is what keys missing from the lookup, at -1, find.
+            held = np.append(self.data[column].notnull().to_numpy(), False)
+            present[column] = held[positions]
+        return present
+
+    def positions(self, keys):
+        """
+        Finds the position of each key in the lookup. Keys held as strings are
+        compared by value with numeric lookup keys, and the other way around.
+        :param keys: Keys to look up - Series
+        :return positions: Position of each key, -1 where missing - numpy.ndarray
+        """
+        if is_categorical_dtype(keys.dtype):
+            keys = np.asarray(keys)
+
+        if self._direct_index is not None and _is_integer(keys.dtype):
+            return self._direct_index.positions(np.asarray(keys))
+
+        if is_numeric_dtype(self.index.dtype) and is_object_dtype(keys.dtype):
+            return self.index.get_indexer(pd.to_numeric(keys, errors="coerce"))
+
+        if is_object_dtype(self.index.dtype) and is_numeric_dtype(keys.dtype):
+            if self._numeric_index is None:
+                self._numeric_index = self._build_numeric_index()
+            index, index_positions = self._numeric_index
+            positions = index.get_indexer(keys)
+            return np.where(positions >= 0, index_positions[positions], -1)
+
+        return self.index.get_indexer(keys)
+
+    def _build_numeric_index(self):
+        numeric_keys = pd.to_numeric(pd.Series(self.index), errors="coerce")
+        valid = numeric_keys.notnull().to_numpy()
+        index = pd.Index(numeric_keys[valid])
+        if index.has_duplicates:
+            raise ValueError(f"Lookup keys in {self.join_column} are ambiguous as "
+                             f"numbers: {sorted(set(index[index.duplicated()]))[:10]}")
+        return index, np.flatnonzero(valid)
+
+
+class DirectIndex:
+    """
+    Finds integer keys in a lookup without hashing them, by reading a table that
+    holds the position of every value from the smallest key to the largest. Only
+    built for dense keys, see build.
+    """
+
+    def __init__(self, low, table):
+        self.low = low
+        self.table = table
+        self.nbytes = table.nbytes
+
+    @classmethod
+    def build(cls, keys):
+        """
+        Builds the table for keys spanning at most DIRECT_ADDRESS_MAX_SPAN values
+        per key.
+        :param keys: Keys of the lookup - numpy.ndarray(Int)
+        :return index: Index of the keys, or None if they are too sparse or there
+                       are none - DirectIndex
+        """
+        if len(keys) == 0:
+            return None
+        low = int(keys.min())
+        span = int(keys.max()) - low + 1
+        if span > DIRECT_ADDRESS_MAX_SPAN * len(keys):
+            return None
+
+        # Positions fit in 32 bits for any lookup a lambda can hold.
+        table = np.full(span, -1, dtype=np.int32 if len(keys) < 2 ** 31 else np.int64)
+        table[keys.astype(np.int64) - low] = np.arange(len(keys))
+        return cls(low, table)
+
+    def duplicates(self, keys):
+        """
+        Finds the keys the table was built from that appear more than once.
+        :param keys: Keys the table was built from - numpy.ndarray(Int)
+        :return duplicates: Repeated keys, in order - numpy.ndarray(Int)
+        """
+        # A repeated key is held once, so fewer positions are held than keys.
+        if np.count_nonzero(self.table >= 0) == len(keys):
+            return keys[:0]
+        counts = np.bincount(keys.astype(np.int64) - self.low)
+        return np.flatnonzero(counts > 1) + self.low
+
+    def positions(self, keys):
+        """
+        Finds the position of each key in the lookup.
+        :param keys: Keys to look up - numpy.ndarray(Int)
+        :return positions: Position of each key, -1 where missing - numpy.ndarray
+        """
+        # Keys far out of range wrap around, but never into the table.
+        offsets = keys.astype(np.int64) - self.low
+        found = (offsets >= 0) & (offsets < len(self.table))
+        positions = np.full(len(keys), -1, dtype=np.intp)
+        positions[found] = self.table[offsets[found]]
+        return positions
+
+
+class CompositeTable(LookupTable):
+    """
+    Several lookups joined together ahead of time and keyed on the column at the
+    root of their chain, so that enriching data takes one probe of the index
+    rather than one per lookup. The keys are those of every lookup joining on the
+    root column.
+    Building the composite can leave nulls in columns that had none, changing
+    integers to floats, so gathered columns without nulls are given back the
+    type they had in their lookup.
+    """
+
+    def __init__(self, tables, join_column):
+        keys = None
+        for table in tables:
+            if table.join_column == join_column:
+                keys = table.index if keys is None else \
+                    keys.append(table.index).drop_duplicates()
+
+        data = pd.DataFrame({join_column: keys})
+        dtypes = {}
+        for table in tables:
+            data = table.enrich(data)
+            for column in table.value_columns:
+                dtypes[column] = table.dtypes.get(column, table.data[column].dtype)
+
+        super().__init__(data, join_column, list(data.columns), dtypes=dtypes)
+
+
+def composite_table(tables, join_column):
+    """
+    Returns the composite of the given tables, reusing the one built last time if
+    the tables are the same cached objects.
+    :param tables: Tables in the order they are joined - List(LookupTable)
+    :param join_column: Column at the root of the chain - String
+    :return table: Joined lookups - CompositeTable
+    """
+    # Kept on the first table so it goes when that lookup leaves the cache.
+    cached = tables[0]._composite
+    if cached is not None and len(cached[0]) == len(tables) and \
+            all(old is new for old, new in zip(cached[0], tables)):
+        return cached[1]
+
+    table = CompositeTable(tables, join_column)
+    tables[0]._composite = (tuple(tables), table)
+    return table
+
+
+def _is_integer(dtype):
+    # Integers that fit in an int64, but not nullable integers.
+    return isinstance(dtype, np.dtype) and \
+        (dtype.kind == "i" or dtype.kind == "u" and dtype.itemsize < 8)
+
+
+def take_with_nulls(series, positions):
+    """
+    Gathers values from a Series by position, giving nulls where position is -1.
+    :param series: Values to gather from - Series
+    :param positions: Positions to gather, -1 for no match - numpy.ndarray
+    :return values: Gathered values - numpy.ndarray or ExtensionArray
+    """
+    if pd.api.types.is_extension_array_dtype(series.dtype):
+        values = series.array
+    else:
+        values = series.to_numpy()
+    return pd.api.extensions.take(values, positions, allow_fill=True)
+
+
+# Module level so that it survives between warm invocations.
+lookup_cache = LookupCache(disk=disk_cache_functions.DiskCache())
@@ -0,0 +1,228 @@
+import json
+import time
+from collections import OrderedDict
+
+# CloudWatch namespace the metrics are published under.
+NAMESPACE = "ES/Enrichment"
+
+# Values a stage can record, and the CloudWatch unit of each.
+UNITS = OrderedDict([
+    ("duration_ms", "Milliseconds"),
+    ("rows_in", "Count"),
+    ("rows_out", "Count"),
+    ("bytes_read", "Bytes"),
+    ("bytes_written", "Bytes"),
+    ("peak_rss_mb", "Megabytes"),
+])
+
+
+class RunMetrics:
+    """
+    Collects the wall time, rows, bytes and peak memory of each stage of a run,
+    and writes them as one CloudWatch embedded metric format (EMF) log line.
+    A stage entered more than once, such as for each chunk of a streamed input,
+    adds up its time, rows and bytes and keeps the largest peak.
+    The peak is the most memory resident while the stage ran, found by resetting
+    the process's peak RSS as each stage starts, so a warm container does not
+    report the peak of an earlier run. It is not recorded where the peak cannot
+    be reset, outside Linux.
+    """
+
+    def __init__(self, module, run_id, survey):
+        self.module = module
+        self.run_id = run_id
+        self.survey = survey
+        self.stages = OrderedDict()
+        # Peak RSS in kilobytes of each stage that has not finished, outermost
+        # first, or None where the peak cannot be reset.
+        self._open_peaks = []
+
+    def stage(self, name):
+        """
+        Times a stage of the run. Rows and bytes are recorded by setting
+        'rows_in', 'rows_out', 'bytes_read' or 'bytes_written' on the dict the
+        context manager returns.
+        :param name: Name of the stage - String
+        :return: Context manager - _Stage
+        """
+        return _Stage(self, name)
+
+    def add(self, name, duration, values, peak_rss_kb=None):
+        """
+        Adds a finished stage to the run.
+        :param name: Name of the stage - String
+        :param duration: Wall time of the stage in seconds - Float
+        :param values: Rows and bytes recorded by the stage - Dict
+        :param peak_rss_kb: Peak RSS while the stage ran, if known - Int
+        """
+        stage = self.stages.setdefault(name, {"duration_ms": 0.0})
+        stage["duration_ms"] += duration * 1000
+        for key, value in values.items():
+            if key in UNITS and key != "peak_rss_mb":
+                stage[key] = stage.get(key, 0) + value
+        if peak_rss_kb is not None:
+            stage["peak_rss_mb"] = max(stage.get("peak_rss_mb", 0),
+                                       peak_rss_kb / 1024)
+
+    def start_peak(self):
+        """
+        Starts measuring the peak RSS of a stage. The peak so far is kept for the
+        stages it is inside, as the process's peak is reset.
+        """
+        self._fold_peak()
+        self._open_peaks.append(0 if _reset_peak_rss() else None)
+
+    def end_peak(self):
+        """
+        Stops measuring the peak RSS of the innermost stage.
+        :return peak_rss_kb: Peak RSS while the stage ran, if known - Int
+        """
+        self._fold_peak()
+        return self._open_peaks.pop()
+
+    def _fold_peak(self):
+        if not self._open_peaks:
+            return
+        peak = _peak_rss_kb()
+        self._open_peaks = [None if open_peak is None or peak is None
+                            else max(open_peak, peak)
+                            for open_peak in self._open_peaks]
+
+    def record(self, success=True):
+        """
+        Builds the EMF record for the run, with one metric per stage and value.
+        :param success: Whether the run succeeded - Boolean
+        :return record: EMF record - Dict
+        """
+        record = OrderedDict([
+            ("_aws", {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["module", "survey"]],
+                    "Metrics": [{"Name": f"{name}.{key}", "Unit": UNITS[key]}
+                                for name, stage in self.stages.items()
+                                for key in UNITS if key in stage],
+                }],
+            }),
+            ("module", self.module),
+            ("survey", self.survey),
+            ("run_id", self.run_id),
+            ("success", success),
+        ])
+        for name, stage in self.stages.items():
+            for key in UNITS:
+                if key in stage:
+                    record[f"{name}.{key}"] = round(stage[key], 3)
+        return record
+
+    def emit(self, success=True):
+        """
+        Writes the EMF record for the run to stdout, where lambda passes it on to
+        CloudWatch Logs.
+        :param success: Whether the run succeeded - Boolean
+        """
+        print(json.dumps(self.record(success)), flush=True)
+
+
+class _Stage:
+    __slots__ = ("metrics", "name", "values", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.values = {}
+        self.metrics.start_peak()
+        self.start = time.perf_counter()
+        return self.values
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        self.metrics.add(self.name, duration, self.values, self.metrics.end_peak())
+        return False
+
+
+class NullMetrics:
+    """
+    Stands in for RunMetrics when metrics are disabled, doing nothing.
+    """
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def emit(self, success=True):
+        pass
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+# Metrics of the run in progress, so that functions below the handlers can add
+# stages without having the metrics passed to them.
+_current = NullMetrics()
+
+
+def start_run(enabled, module, run_id, survey):
+    """
+    Starts collecting metrics for a run.
+    :param enabled: Whether to collect metrics - Boolean
+    :param module: Name of the lambda - String
+    :param run_id: Id of the run - String
+    :param survey: Survey being run - String
+    :return metrics: Metrics of the run - RunMetrics or NullMetrics
+    """
+    global _current
+    _current = RunMetrics(module, run_id, survey) if enabled else NullMetrics()
+    return _current
+
+
+def finish_run(success=True):
+    """
+    Emits the metrics of the run in progress and stops collecting.
+    :param success: Whether the run succeeded - Boolean
+    """
+    global _current
+    metrics, _current = _current, NullMetrics()
+    metrics.emit(success)
+
+
+def stage(name):
+    """
+    Times a stage of the run in progress, see RunMetrics.stage.
+    :param name: Name of the stage - String
+    :return: Context manager
+    """
+    return _current.stage(name)
+
+
+def _peak_rss_kb():
+    # VmHWM is the peak RSS since the process started or the peak was reset.
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM to the current RSS, on Linux 4.0 on.
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return _peak_rss_kb() is not None
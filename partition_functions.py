@@ -0,0 +1,109 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+# Rows each method invocation is aimed at when the number of partitions is not
+# given.
+PARTITION_ROWS = 100000
+
+# Most method invocations a run is split into.
+MAX_PARTITIONS = 16
+
+# Column holding each row's position in the input, added to the partitions so
+# that their outputs can be put back in the same order.
+ROW_NUMBER_COLUMN = "_row_number"
+
+
+def partition_count(rows, partitions=None):
+    """
+    Works out how many partitions to split the input into, aiming for
+    PARTITION_ROWS rows in each, up to MAX_PARTITIONS.
+    :param rows: Number of rows in the input - Int
+    :param partitions: Number of partitions requested, if any - Int
+    :return partitions: Number of partitions - Int
+    """
+    if partitions is None:
+        partitions = math.ceil(rows / PARTITION_ROWS)
+    return max(1, min(partitions, MAX_PARTITIONS, rows))
+
+
+def assign_partitions(data, partitions, partition_column=None, identifier_column=None):
+    """
+    Assigns each row to a partition. Rows with the same value in partition_column
+    are kept together, with the values spread so that the partitions are of
+    similar size. Without a partition_column the rows are spread by a hash of
+    their identifier, which gives the same partitions on every run.
+    :param data: Input data - DataFrame
+    :param partitions: Number of partitions - Int
+    :param partition_column: Column whose values are kept together - String
+    :param identifier_column: Column that holds the unique id of a row - String
+    :return assignment: Partition of each row - Numpy Array(Int)
+    """
+    if partition_column is None:
+        hashes = pd.util.hash_pandas_object(data[identifier_column], index=False)
+        return (hashes.to_numpy() % np.uint64(partitions)).astype(np.int64)
+
+    codes, values = pd.factorize(data[partition_column])
+    sizes = np.bincount(codes[codes >= 0], minlength=len(values))
+
+    # Largest values first, each to the smallest partition so far. Nulls are one
+    # more value, placed last.
+    loads = [0] * partitions
+    value_partition = np.zeros(len(values) + 1, dtype=np.int64)
+    for value in sorted(range(len(values)), key=lambda value: (-sizes[value], value)):
+        smallest = loads.index(min(loads))
+        value_partition[value] = smallest
+        loads[smallest] += sizes[value]
+    value_partition[-1] = loads.index(min(loads))
+
+    return value_partition[codes]
+
+
+def split_partitions(data, assignment):
+    """
+    Splits the data into its partitions, adding ROW_NUMBER_COLUMN. Each partition
+    keeps the input order and empty partitions are left out.
+    :param data: Input data - DataFrame
+    :param assignment: Partition of each row - Numpy Array(Int)
+    :return partitions: Data of each partition - List(DataFrame)
+    """
+    numbered = data.copy(deep=False)
+    numbered[ROW_NUMBER_COLUMN] = np.arange(len(data))
+
+    return [numbered[assignment == partition].reset_index(drop=True)
+            for partition in np.unique(assignment)]
+
+
+def merge_partitions(data_partitions, anomaly_partitions, identifier_values,
+                     identifier_column):
+    """
+    Puts the enriched partitions and their anomalies back together, in the order
+    one invocation would have produced. The partitions were enriched with
+    ROW_NUMBER_COLUMN as their identifier, so the anomalies are ordered by it and
+    then given the identifier of their row.
+    :param data_partitions: Enriched data of each partition - List(DataFrame)
+    :param anomaly_partitions: Anomalies of each partition - List(DataFrame)
+    :param identifier_values: Identifier of each input row - Numpy Array
+    :param identifier_column: Column that holds the unique id of a row - String
+    :return data: Enriched data - DataFrame
+    :return anomalies: Anomalies - DataFrame
+    """
+    data = pd.concat(data_partitions, ignore_index=True, sort=False)
+    data = data.sort_values(ROW_NUMBER_COLUMN, kind="mergesort")\
+        .drop(columns=ROW_NUMBER_COLUMN).reset_index(drop=True)
+
+    anomaly_partitions = [anomalies for anomalies in anomaly_partitions
+                          if len(anomalies) > 0]
+    if not anomaly_partitions:
+        return data, pd.DataFrame(columns=[identifier_column, "issue"])
+
+    # Stable, so each row's anomalies stay in rule order.
+    anomalies = pd.concat(anomaly_partitions, ignore_index=True, sort=False)
+    anomalies = anomalies.sort_values(ROW_NUMBER_COLUMN, kind="mergesort")\
+        .reset_index(drop=True)
+    anomalies[ROW_NUMBER_COLUMN] = \
+        identifier_values[anomalies[ROW_NUMBER_COLUMN].to_numpy()]
+    anomalies = anomalies.rename(columns={ROW_NUMBER_COLUMN: identifier_column})
+
+    return data, anomalies
@@ -0,0 +1,169 @@
+import lookup_functions
+
+
+def build_join_plan(lookups, input_columns=None):
+    """
+    Works out how the lookups should be joined onto the data. A lookup depends on
+    another when its join column is one of the columns the other adds. Lookups
+    are grouped by the input column at the root of their chain, and each group is
+    joined as one step.
+    When no two lookups add the same column, and none add a column already in the
+    input, the lookups of a step can be fused into one composite lookup keyed by
+    the root column. Otherwise every lookup is joined on its own in key order, so
+    clashing columns get the usual merge suffixes.
+    :param lookups: Information about lookups required. - Dict
+    :param input_columns: Columns of the data, if known they are used to check that
+                          every join column will exist - List(String)
+    :return join_plan: 'steps', each with the 'join_column', 'lookups' in the order
+                       they are joined and whether they are 'fused', and the
+                       'columns' added in key order, None when they clash - Dict
+    """
+    produced_by = {}
+    clash = False
+    for lookup in lookups:
+        for column in added_columns(lookups[lookup]):
+            if column in produced_by or \
+                    (input_columns is not None and column in input_columns):
+                clash = True
+            produced_by.setdefault(column, lookup)
+
+    for lookup in lookups:
+        join_column = lookups[lookup]["join_column"]
+        if input_columns is not None and join_column not in input_columns and \
+                join_column not in produced_by:
+            raise ValueError(f"Lookup {lookup} joins on {join_column} which is not in "
+                             f"the input data or added by another lookup.")
+
+    if clash:
+        return {"steps": [{"join_column": lookups[lookup]["join_column"],
+                           "lookups": [lookup], "fused": False}
+                          for lookup in lookups],
+                "columns": None}
+
+    columns = [column for lookup in lookups
+               for column in added_columns(lookups[lookup])]
+
+    # Follow each lookup back to the lookup at the root of its chain.
+    parents = {}
+    for lookup in lookups:
+        parent = produced_by.get(lookups[lookup]["join_column"])
+        if parent is not None:
+            parents[lookup] = parent
+
+    steps = {}
+    for lookup in lookups:
+        chain = [lookup]
+        while chain[-1] in parents:
+            if parents[chain[-1]] in chain:
+                raise ValueError(f"Lookups {sorted(chain, key=str)} depend on each "
+                                 f"other.")
+            chain.append(parents[chain[-1]])
+        root_column = lookups[chain[-1]]["join_column"]
+        steps.setdefault(root_column, {"join_column": root_column, "lookups": []})
+
+    for lookup in _dependency_order(lookups, parents):
+        root = lookup
+        while root in parents:
+            root = parents[root]
+        steps[lookups[root]["join_column"]]["lookups"].append(lookup)
+
+    for step in steps.values():
+        step["fused"] = len(step["lookups"]) > 1
+
+    return {"steps": list(steps.values()), "columns": columns}
+
+
+def added_columns(lookup):
+    """
+    Gets the columns a lookup adds to the data.
+    :param lookup: Information about a lookup - Dict
+    :return columns: Kept columns other than the join column - List(String)
+    """
+    return [column for column in lookup["columns_to_keep"]
+            if column != lookup["join_column"]]
+
+
+def _dependency_order(lookups, parents):
+    # Key order, except that a lookup always comes after the one it joins on.
+    ordered = []
+
+    def visit(lookup):
+        if lookup in ordered:
+            return
+        if lookup in parents:
+            visit(parents[lookup])
+        ordered.append(lookup)
+
+    for lookup in lookups:
+        visit(lookup)
+    return ordered
+
+
+def plan_tables(join_plan, lookup_tables, artefact_tables=None):
+    """
+    Gets the tables to join for each step of the plan. A fused step becomes a single
+    composite table, unless a lookup it depends on has a null key, as a left merge
+    would match nulls produced by the earlier join to it. A step with a prebuilt
+    composite artefact uses that instead.
+    :param join_plan: Plan from build_join_plan - Dict
+    :param lookup_tables: Indexed lookup for each lookup key not covered by an
+                          artefact - Dict
+    :param artefact_tables: Prebuilt composite for the join column of a step - Dict
+    :return tables: Tables in the order to join them - List(LookupTable)
+    """
+    artefact_tables = artefact_tables or {}
+
+    tables = []
+    for step in join_plan["steps"]:
+        step["artefact"] = step["join_column"] in artefact_tables
+        if step["artefact"]:
+            table = artefact_tables[step["join_column"]]
+            step["lookup_rows"] = len(table.index)
+            tables.append(table)
+            continue
+
+        step_tables = [lookup_tables[lookup] for lookup in step["lookups"]]
+        step["lookup_rows"] = sum(len(table.index) for table in step_tables)
+
+        if step["fused"] and not any(table.index.hasnans for table in step_tables
+                                     if table.join_column != step["join_column"]):
+            tables.append(lookup_functions.composite_table(step_tables,
+                                                           step["join_column"]))
+        else:
+            step["fused"] = False
+            tables.extend(step_tables)
+    return tables
+
+
+def describe_join_plan(join_plan, lookups, rows):
+    """
+    Describes each step of the plan with a rough cost, counted in values touched:
+    one index probe per row and one gathered value per row and added column, plus
+    building the composite table for a fused step, which is skipped when the
+    composite is already cached or comes from an artefact.
+    :param join_plan: Plan from build_join_plan, after plan_tables - Dict
+    :param lookups: Information about lookups required. - Dict
+    :param rows: Number of rows in the data - Int
+    :return description: 'steps' and the 'estimated_cost' of the plan - Dict
+    """
+    steps = []
+    for step in join_plan["steps"]:
+        columns = [column for lookup in step["lookups"]
+                   for column in added_columns(lookups[lookup])]
+        probes = 1 if step["fused"] or step.get("artefact") else len(step["lookups"])
+        cost = rows * (probes + len(columns))
+        if step["fused"] and not step.get("artefact"):
+            cost += step.get("lookup_rows", 0) * len(columns)
+
+        steps.append({
+            "join_column": step["join_column"],
+            "lookups": [lookups[lookup]["file_name"] for lookup in step["lookups"]],
+            "fused": step["fused"],
+            "artefact": step.get("artefact", False),
+            "columns": columns,
+            "lookup_rows": step.get("lookup_rows"),
+            "estimated_cost": cost,
+        })
+
+    return {"steps": steps, "rows": rows,
+            "estimated_cost": sum(step["estimated_cost"] for step in steps)}
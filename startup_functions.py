@@ -0,0 +1,86 @@
+import functools
+import threading
+
+import boto3
+from botocore.config import Config
+
+# Region of every client and resource the lambdas use.
+REGION = "eu-west-2"
+
+# Settings of the clients that need them, by service. Synchronous invocations of
+# the method wait for it to finish, which may take up to its timeout, far longer
+# than botocore's default read timeout of 60 seconds.
+CLIENT_CONFIGS = {
+    "lambda": Config(read_timeout=900),
+}
+
+# Clients and resources made by this container, by service.
+_clients = {}
+_resources = {}
+
+# Creating clients from the default session is not thread safe.
+_lock = threading.Lock()
+
+
+def client(service):
+    """
+    Gets a client for service, made once per container and reused by later
+    invocations. Clients are thread safe, so one is shared by all threads.
+    :param service: Name of the AWS service - String
+    :return client: boto3 client
+    """
+    with _lock:
+        if service not in _clients:
+            _clients[service] = boto3.client(service, region_name=REGION,
+                                             config=CLIENT_CONFIGS.get(service))
+        return _clients[service]
+
+
+def resource(service):
+    """
+    Gets a resource for service, made once per container. Unlike clients,
+    resources are not thread safe and should only be used by the handler thread.
+    :param service: Name of the AWS service - String
+    :return resource: boto3 resource
+    """
+    with _lock:
+        if service not in _resources:
+            _resources[service] = boto3.resource(service, region_name=REGION)
+        return _resources[service]
+
+
+def load_environment(schema, environ):
+    """
+    Validates the environment variables with the schema, only once per container
+    unless those the schema declares change. Others, such as the trace id lambda
+    sets on every invocation, are ignored.
+    :param schema: Schema of the environment variables - Type(Schema)
+    :param environ: Environment variables, usually os.environ - Dict
+    :return environment_variables: Loaded environment variables - Dict
+    """
+    declared = tuple(sorted((name, environ[name]) for name in _declared_names(schema)
+                            if name in environ))
+    # Copied so that a caller changing it does not change the cached copy.
+    return dict(_load_environment(schema, declared))
+
+
+@functools.lru_cache(maxsize=8)
+def _declared_names(schema):
+    return tuple(field.data_key or name for name, field in schema().fields.items())
+
+
+@functools.lru_cache(maxsize=8)
+def _load_environment(schema, environ):
+    return schema().load(dict(environ))
+
+
+def reset():
+    """
+    Forgets the clients, resources and environment of the container, as if the
+    lambda had been started again.
+    """
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+    _declared_names.cache_clear()
+    _load_environment.cache_clear()
@@ -0,0 +1,17 @@
+import pytest
+
+import lookup_functions
+import startup_functions
+
+
+@pytest.fixture(autouse=True)
+def new_container(tmp_path, monkeypatch):
+    """
+    Runs each test as if in a new lambda container, so clients made against an
+    earlier test's mocks are not reused, and with its own ephemeral storage.
+    """
+    startup_functions.reset()
+    monkeypatch.setattr(lookup_functions.lookup_cache.disk, "directory",
+                        str(tmp_path / "enrichment_lookups"))
+    yield
+    startup_functions.reset()
@@ -0,0 +1,142 @@
+import pandas as pd
+
+import anomaly_functions
+
+lookups = {
+    "0": {"file_name": "responder_county_lookup",
+          "columns_to_keep": ["responder_id", "county"],
+          "join_column": "responder_id",
+          "required": ["county"]
+          },
+    "1": {"file_name": "county_marine_lookup",
+          "columns_to_keep": ["county_name",
+                              "region", "county",
+                              "marine"],
+          "join_column": "county",
+          "required": ["region", "marine"]
+          }
+}
+
+data = pd.DataFrame({
+    "responder_id": [666, 667, 668, 669],
+    "survey": ["076", "076", "066", "076"],
+    "period": [201809, 201809, 201809, 201809],
+    "county": [12, None, 5, 7],
+    "region": [6, None, 1, None],
+    "marine": ["n", None, "y", "y"],
+})
+
+
+def test_detect_anomalies_reports_every_missing_column():
+    """
+    Runs detect_anomalies where one reference is missing several columns.
+    :param None
+    :return Test Pass/Fail
+    """
+    rules = anomaly_functions.build_rules(lookups, False, "survey", "period")
+
+    output = anomaly_functions.detect_anomalies(data, rules, "responder_id")
+
+    assert output["responder_id"].tolist() == [667, 667, 667, 669]
+    assert output["issue"].tolist() == ["county missing in lookup.",
+                                        "region missing in lookup.",
+                                        "marine missing in lookup.",
+                                        "region missing in lookup."]
+    assert output.index.tolist() == [1, 1, 1, 3]
+
+
+def test_detect_anomalies_with_marine_mismatch():
+    """
+    Runs detect_anomalies with the marine mismatch and missing column rules.
+    :param None
+    :return Test Pass/Fail
+    """
+    rules = anomaly_functions.build_rules(lookups, True, "survey", "period")
+
+    output = anomaly_functions.detect_anomalies(data, rules, "responder_id")
+
+    assert list(output.columns) == ["responder_id", "issue", "survey", "marine",
+                                    "period"]
+    marine_rows = output[output["issue"] == anomaly_functions.MARINE_MISMATCH_ISSUE]
+    assert marine_rows["responder_id"].tolist() == [666]
+    assert marine_rows["period"].tolist() == [201809]
+    assert output[output["responder_id"] == 667]["survey"].isnull().all()
+
+
+def test_detect_anomalies_declared_rule():
+    """
+    Runs detect_anomalies with a rule declared in the runtime variables.
+    :param None
+    :return Test Pass/Fail
+    """
+    anomaly_rules = {
+        0: {"rule_type": "match",
+            "conditions": {"survey": "066", "marine": "y"},
+            "issue": "Reference should not produce marine data for 066.",
+            "report_columns": ["period"]}
+    }
+    rules = anomaly_functions.build_rules({}, False, "survey", "period",
+                                          anomaly_rules)
+
+    output = anomaly_functions.detect_anomalies(data, rules, "responder_id")
+
+    assert output["responder_id"].tolist() == [668]
+    assert list(output.columns) == ["responder_id", "issue", "period"]
+
+
+def test_detect_anomalies_no_rules():
+    """
+    Runs detect_anomalies without any rules.
+    :param None
+    :return Test Pass/Fail
+    """
+    output = anomaly_functions.detect_anomalies(data, [], "responder_id")
+
+    assert output.to_json(orient="records") == "[]"
+
+
+def test_compact_anomalies():
+    """
+    Builds the compact anomaly report, with more checks than fit in one bitmask,
+    and checks it counts, summarises and renders as detect_anomalies reports.
+    :param None
+    :return Test Pass/Fail
+    """
+    rules = anomaly_functions.build_rules(lookups, True, "survey", "period") + \
+        [anomaly_functions.missing_rule(["county"])] * 70
+    codes = anomaly_functions.issue_codes(rules)
+
+    output = anomaly_functions.compact_anomalies(data, rules, "responder_id",
+                                                 ["period"])
+
+    assert len(codes) == 74
+    assert list(output.columns) == ["responder_id", "survey", "marine", "period",
+                                    "checks", "checks_1"]
+    assert output["responder_id"].tolist() == [666, 667, 669]
+    # Marine mismatch is code 0, then county, region and marine missing.
+    assert output["checks"].tolist() == [1, 2 ** 64 - 2, 4]
+    assert output["checks_1"].tolist() == [0, 2 ** 10 - 1, 0]
+
+    records = anomaly_functions.render_anomalies(output, codes, "responder_id")
+    assert anomaly_functions.issue_count(output, codes) == len(records)
+    pd.testing.assert_frame_equal(
+        records, anomaly_functions.detect_anomalies(data, rules, "responder_id"))
+
+    summary = anomaly_functions.summarise_anomalies(output, codes, "period")
+    assert summary["count"].sum() == len(records)
+    assert summary[summary["code"] == 2]["count"].tolist() == [2]
+
+
+def test_missing_rule_issue_with_braces():
+    """
+    Runs detect_anomalies with a declared missing rule whose issue holds braces
+    other than the column placeholder.
+    :param None
+    :return Test Pass/Fail
+    """
+    rules = [{"rule_type": "missing", "columns": ["county"],
+              "issue": "{column} missing, see {docs}.", "report_columns": []}]
+
+    output = anomaly_functions.detect_anomalies(data, rules, "responder_id")
+
+    assert set(output["issue"]) == {"county missing, see {docs}."}
@@ -0,0 +1,127 @@
+import json
+from unittest import mock
+
+from es_aws_functions import test_generic_library
+from moto import mock_s3
+
+import build_composite
+import enrichment_method as lambda_method_function
+import lookup_functions
+
+bucket_name = "test_bucket"
+
+method_runtime_variables = {
+    "RuntimeVariables": {
+        "bpm_queue_url": "fake_queue_url",
+        "environment": "sandbox",
+        "marine_mismatch_check": True,
+        "period_column": "period",
+        "survey": "BMI_SG",
+        "survey_column": "survey",
+        "identifier_column": "responder_id",
+        "run_id": "bob"
+    }
+}
+
+
+def run_method(composite_lookup=None, dry_run=False):
+    """
+    Runs the method function on the test input.
+    :param composite_lookup: Name of the composite artefact to use - Type: String
+    :param dry_run: Only plan the joins - Type: Boolean
+    :return output: Output of the method - Type: Dict
+    """
+    with open("tests/fixtures/test_wrangler_to_method_runtime.json", "r") as file:
+        lookups = json.load(file)["lookups"]
+    with open("tests/fixtures/test_method_input.json", "r") as file:
+        test_data = file.read()
+
+    runtime_variables = json.loads(json.dumps(method_runtime_variables))
+    runtime_variables["RuntimeVariables"].update({"data": test_data,
+                                                  "dry_run": dry_run,
+                                                  "lookups": lookups})
+    if composite_lookup:
+        runtime_variables["RuntimeVariables"]["composite_lookup"] = composite_lookup
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         {"bucket_name": bucket_name}):
+        return lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+
+def build(name):
+    """
+    Runs the build_composite command line for the test lookups.
+    :param name: Name of the artefact - Type: String
+    :return manifest: Details of the stored artefact - Type: Dict
+    """
+    return build_composite.main(["tests/fixtures/test_wrangler_to_method_runtime.json",
+                                 "--bucket", bucket_name, "--name", name])
+
+
+@mock_s3
+def test_build_composite():
+    """
+    Runs the build_composite command line.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["responder_county_lookup.json",
+                                       "county_marine_lookup.json"])
+
+    manifest = build("sand_gravel_composite")
+
+    stored = json.loads(client.get_object(
+        Bucket=bucket_name, Key="sand_gravel_composite.json")["Body"].read())
+    assert stored == manifest
+    assert manifest["file_name"] == \
+        f"sand_gravel_composite-{manifest['hash'][:16]}.arrow"
+    assert manifest["lookups"] == ["responder_county_lookup", "county_marine_lookup"]
+    assert manifest["columns"] == ["county", "county_name", "region", "marine"]
+    client.head_object(Bucket=bucket_name, Key=manifest["file_name"])
+
+
+@mock_s3
+def test_method_with_composite_artefact():
+    """
+    Runs the method function with and without a current composite artefact.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["responder_county_lookup.json",
+                                       "county_marine_lookup.json"])
+    manifest = build("sand_gravel_composite")
+    lookup_functions.lookup_cache.clear()
+
+    output = run_method("sand_gravel_composite")
+
+    assert output["success"]
+    assert list(lookup_functions.lookup_cache.stats["lookups"]) == \
+        [manifest["file_name"]]
+    assert output == run_method()
+
+
+@mock_s3
+def test_method_with_stale_composite_artefact():
+    """
+    Runs the method function after a lookup has changed since the artefact was built.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["responder_county_lookup.json",
+                                       "county_marine_lookup.json"])
+    build("sand_gravel_composite")
+
+    client.put_object(Bucket=bucket_name, Key="responder_county_lookup.json",
+                      Body='[{"responder_id": 77700000000, "county": 2}]')
+
+    output = run_method("sand_gravel_composite", dry_run=True)
+
+    assert output["success"]
+    assert not output["plan"]["steps"][0]["artefact"]
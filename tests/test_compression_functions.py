@@ -0,0 +1,52 @@
+import io
+
+import pytest
+
+import compression_functions
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_round_trip(compression):
+    """
+    Compresses data whole, a piece at a time and as base64 text, and checks each
+    is recognised and decompressed, and that uncompressed data is left alone.
+    :param compression: One of COMPRESSIONS - Type: String
+    :return Test Pass/Fail
+    """
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    text = '[{"responder_id":1,"county":"x"}]' * 1000
+    body = text.encode("utf-8")
+
+    compressed = compression_functions.compress(body, compression)
+    compressor = compression_functions.compressor(compression)
+    pieces = b"".join(compressor.compress(body[start:start + 7])
+                      for start in range(0, len(body), 7)) + compressor.flush()
+
+    assert len(compressed) < len(body)
+    assert compression_functions.detect(compressed) == compression
+    assert compression_functions.decompress(compressed) == body
+    assert compression_functions.decompress(pieces) == body
+    assert compression_functions.decompress(body) == body
+    assert compression_functions.decode_text(
+        compression_functions.encode_text(text, compression)) == text
+    assert compression_functions.decode_text(text) == text
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_open_stream(compression):
+    """
+    Reads compressed and uncompressed streams a few bytes at a time.
+    :param compression: One of COMPRESSIONS, or None - Type: String
+    :return Test Pass/Fail
+    """
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    body = b"0123456789" * 1000
+
+    stream = compression_functions.open_stream(
+        io.BytesIO(compression_functions.compress(body, compression)))
+    chunks = iter(lambda: stream.read(3), b"")
+
+    assert b"".join(chunks) == body
+    assert compression_functions.open_stream(io.BytesIO(b"")).read() == b""
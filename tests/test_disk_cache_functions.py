@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from es_aws_functions import test_generic_library
+from moto import mock_s3
+from pandas.testing import assert_frame_equal
+
+import disk_cache_functions
+import lookup_functions
+
+pyarrow = pytest.importorskip("pyarrow")
+
+bucket_name = "test_bucket"
+
+
+def test_store_and_load(tmp_path):
+    """
+    Stores a lookup and loads it back memory-mapped, checking the values and
+    nulls are unchanged, numeric columns are not copied onto the heap, and
+    columns the file does not hold are not loaded.
+    :param tmp_path: Temporary directory - Path
+    :return Test Pass/Fail
+    """
+    cache = disk_cache_functions.DiskCache(str(tmp_path))
+    data = pd.DataFrame({"responder_id": np.arange(10000),
+                         "county_name": ["DURHAM", np.nan] * 5000,
+                         "marine": pd.Categorical(["y", "n"] * 5000)})
+
+    stored = cache.store(bucket_name, "lookup", '"1"', data,
+                         ["responder_id", "county_name", "marine"], 123)
+    assert_frame_equal(stored, data)
+
+    allocated = pyarrow.total_allocated_bytes()
+    loaded, details = cache.load(bucket_name, "lookup", '"1"', ["responder_id"])
+    assert pyarrow.total_allocated_bytes() == allocated
+    assert_frame_equal(loaded, data[["responder_id"]])
+    assert details["content_length"] == 123
+
+    assert cache.load(bucket_name, "lookup", '"1"', ["region"]) == (None, None)
+    assert cache.load(bucket_name, "lookup", '"1"') == (None, None)
+
+
+def test_stale_and_evicted_files(tmp_path):
+    """
+    Stores lookups past the size budget and at a new ETag, checking the least
+    recently used and the stale files are removed.
+    :param tmp_path: Temporary directory - Path
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"responder_id": np.arange(10000)})
+    cache = disk_cache_functions.DiskCache(str(tmp_path), max_bytes=150000)
+
+    cache.store(bucket_name, "first", '"1"', data, None, 1)
+    os.utime(cache._path(bucket_name, "first", '"1"'), (0, 0))
+    cache.store(bucket_name, "second", '"1"', data, None, 1)
+
+    assert not cache.holds(bucket_name, "first")
+    assert cache.holds(bucket_name, "second")
+
+    assert cache.load(bucket_name, "second", '"2"') == (None, None)
+    assert not cache.holds(bucket_name, "second")
+
+
+@mock_s3
+def test_lookup_cache_reads_from_disk(tmp_path):
+    """
+    Runs LookupCache.get in two caches sharing a disk, as in two warm invocations
+    that evicted the lookup from memory, and checks the second only downloads it
+    once the file in s3 is replaced.
+    :param tmp_path: Temporary directory - Path
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["county_marine_lookup.json"])
+    disk = disk_cache_functions.DiskCache(str(tmp_path))
+    columns = ["county", "marine"]
+
+    first = lookup_functions.LookupCache(disk=disk).get(
+        bucket_name, "county_marine_lookup", columns=columns)
+
+    cache = lookup_functions.LookupCache(disk=disk)
+    assert_frame_equal(cache.get(bucket_name, "county_marine_lookup",
+                                 columns=columns), first)
+    assert cache.stats["disk_hits"] == 1
+    assert cache.stats["misses"] == 0
+    assert cache.stats["bytes_saved"] > 0
+
+    client.put_object(Bucket=bucket_name, Key="county_marine_lookup.json",
+                      Body='[{"county": 1, "marine": "y"}]')
+    cache = lookup_functions.LookupCache(disk=disk)
+    assert cache.get(bucket_name, "county_marine_lookup",
+                     columns=columns)["county"].tolist() == [1]
+    assert cache.stats["misses"] == 1
+    assert len(disk._files()) == 1
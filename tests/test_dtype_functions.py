@@ -0,0 +1,70 @@
+import json
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import dtype_functions
+
+
+def test_plan_dtypes():
+    """
+    Runs plan_dtypes on the test input with and without a declared schema.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file:
+        test_data = pd.read_json(file.read(), dtype=False)
+
+    dtype_plan = dtype_functions.plan_dtypes(test_data)
+
+    assert dtype_plan["survey"] == "category"
+    assert dtype_plan["Q608_total"] == "integer"
+    assert dtype_plan["responder_id"] == "integer"
+    assert "name" not in dtype_plan
+
+    dtype_plan = dtype_functions.plan_dtypes(test_data, {"survey": "string",
+                                                         "name": "category"},
+                                             exclude=["responder_id"])
+
+    assert dtype_plan["survey"] == "string"
+    assert dtype_plan["name"] == "category"
+    assert "responder_id" not in dtype_plan
+
+
+def test_compact_dtypes():
+    """
+    Runs compact_dtypes and checks the data is smaller but writes the same JSON.
+    :param None
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"survey": ["076", "066", None] * 100,
+                         "Q601_asphalting_sand": list(range(300)),
+                         "ratio": [0.5, 1.25, 3.0] * 100,
+                         "declared": ["1", "2", "3"] * 100})
+
+    compacted = dtype_functions.compact_dtypes(data, {"declared": "integer"})
+
+    assert compacted["survey"].dtype == "category"
+    assert compacted["Q601_asphalting_sand"].dtype == "int16"
+    assert compacted["ratio"].dtype == "float64"
+    assert compacted["declared"].dtype == "object"
+    assert dtype_functions.memory_usage(compacted) < \
+        dtype_functions.memory_usage(data)
+    assert compacted.to_json(orient="records") == data.to_json(orient="records")
+    assert data["survey"].dtype == "object"
+
+
+def test_expand_dtypes():
+    """
+    Runs expand_dtypes on compacted data.
+    :param None
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"survey": ["076", "066", "076", "076"],
+                         "period": [201809] * 4})
+
+    expanded = dtype_functions.expand_dtypes(dtype_functions.compact_dtypes(data))
+
+    assert_frame_equal(expanded, data)
+    assert json.loads(expanded.to_json(orient="records")) == \
+        json.loads(data.to_json(orient="records"))
@@ -1,14 +1,23 @@
+import io
 import json
+import uuid
 from unittest import mock
 
 import pandas as pd
 import pytest
+from botocore.exceptions import ClientError
 from es_aws_functions import exception_classes, test_generic_library
 from moto import mock_s3
 from pandas.testing import assert_frame_equal
 
+import anomaly_functions
+import compression_functions
+import enrichment_finaliser as lambda_finaliser_function
 import enrichment_method as lambda_method_function
 import enrichment_wrangler as lambda_wrangler_function
+import io_functions
+import lookup_functions
+import startup_functions
 
 lookups = {
     "0": {"file_name": "responder_county_lookup",
@@ -312,6 +321,142 @@ def test_method_success():
     assert_frame_equal(produced_data_anomalies, prepared_data_anomalies)
 
 
+@mock_s3
+def test_method_success_records():
+    """
+    Runs the method function with the data as records in the payload, as the
+    wrangler sends it, and as a string, and checks the output is the same.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        bucket_name = method_environment_variables["bucket_name"]
+        client = test_generic_library.create_bucket(bucket_name)
+
+        test_generic_library.upload_files(client, bucket_name,
+                                          ["responder_county_lookup.json",
+                                           "county_marine_lookup.json"])
+
+        with open("tests/fixtures/test_method_input.json", "r") as file:
+            test_data = file.read()
+
+        outputs = []
+        for data in [test_data, json.loads(test_data)]:
+            runtime_variables = json.loads(json.dumps(method_runtime_variables))
+            runtime_variables["RuntimeVariables"]["data"] = data
+            outputs.append(lambda_method_function.lambda_handler(
+                runtime_variables, test_generic_library.context_object))
+
+    with open("tests/fixtures/test_method_output.json", "r") as file:
+        prepared_data = json.load(file)
+
+    assert outputs[0]["success"]
+    assert outputs[1] == outputs[0]
+    assert json.loads(outputs[0]["data"]) == prepared_data
+
+
+@mock_s3
+def test_method_compact_anomalies():
+    """
+    Runs the method function with compact anomalies, and checks they count and
+    render as the anomalies of a run without.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        bucket_name = method_environment_variables["bucket_name"]
+        client = test_generic_library.create_bucket(bucket_name)
+
+        test_generic_library.upload_files(client, bucket_name,
+                                          ["responder_county_lookup.json",
+                                           "county_marine_lookup.json"])
+
+        with open("tests/fixtures/test_method_input.json", "r") as file:
+            test_data = file.read()
+
+        outputs = []
+        for anomaly_format in ["records", "compact"]:
+            runtime_variables = json.loads(json.dumps(method_runtime_variables))
+            runtime_variables["RuntimeVariables"]["data"] = test_data
+            runtime_variables["RuntimeVariables"]["anomaly_format"] = anomaly_format
+            outputs.append(lambda_method_function.lambda_handler(
+                runtime_variables, test_generic_library.context_object))
+
+    records, compact = outputs
+    table = compact["anomaly_codes"]
+    rendered = anomaly_functions.render_anomalies(
+        pd.read_json(compact["anomalies"], dtype=False), table["codes"],
+        "responder_id")
+
+    assert compact["success"]
+    assert compact["data"] == records["data"]
+    assert compact["anomaly_count"] == len(json.loads(records["anomalies"]))
+    assert json.loads(rendered.to_json(orient="records")) == \
+        json.loads(records["anomalies"])
+    assert sum(count["count"] for count in table["counts"]) == \
+        compact["anomaly_count"]
+    assert len(json.loads(compact["anomalies"])) <= compact["anomaly_count"]
+
+
+@mock_s3
+def test_method_batch():
+    """
+    Runs the method function with a batch of jobs, one of which fails, and checks
+    the others give the output of a run on their own, the error is handled for
+    the failing job's run and each lookup file is read once.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        bucket_name = method_environment_variables["bucket_name"]
+        client = test_generic_library.create_bucket(bucket_name)
+
+        test_generic_library.upload_files(client, bucket_name,
+                                          ["responder_county_lookup.json",
+                                           "county_marine_lookup.json"])
+
+        with open("tests/fixtures/test_method_input.json", "r") as file:
+            test_data = file.read()
+
+        jobs = []
+        for run_id, marine_mismatch_check in [("first", True), ("second", False),
+                                              ("third", True)]:
+            job = json.loads(json.dumps(method_runtime_variables))
+            job["RuntimeVariables"]["data"] = test_data
+            job["RuntimeVariables"]["marine_mismatch_check"] = marine_mismatch_check
+            job["RuntimeVariables"]["run_id"] = run_id
+            jobs.append(job)
+        jobs[1]["RuntimeVariables"]["lookups"]["1"]["file_name"] = "missing_lookup"
+
+        lookup_functions.lookup_cache.clear()
+        with mock.patch.object(io_functions, "dataframe_from_stream",
+                               wraps=io_functions.dataframe_from_stream) as reads, \
+                mock.patch.object(lambda_method_function.general_functions,
+                                  "handle_exception",
+                                  wraps=lambda_method_function.general_functions
+                                  .handle_exception) as handle_exception:
+            output = lambda_method_function.lambda_handler(
+                {"Jobs": jobs}, test_generic_library.context_object)
+
+        lookup_functions.lookup_cache.clear()
+        expected = lambda_method_function.lambda_handler(
+            jobs[0], test_generic_library.context_object)
+
+    first, second, third = output["results"]
+
+    assert not output["success"]
+    assert first == expected
+    assert third == expected
+    assert not second["success"]
+    assert handle_exception.call_count == 1
+    assert handle_exception.call_args[0][2] == "second"
+    assert handle_exception.call_args[1]["bpm_queue_url"] == "fake_queue_url"
+    assert reads.call_count == 2
+
+
 def test_missing_column_detector():
     """
     Runs missing_column_detector function.
@@ -346,10 +491,15 @@ def test_wrangler_success_passed():
             mock_client_object = mock.Mock()
             mock_client.return_value = mock_client_object
 
-            # Rather than mock the get/decode we tell the code that when the invoke is
-            # called pass the variables to this replacement function instead.
-            mock_client_object.invoke.side_effect =\
-                test_generic_library.replacement_invoke
+            # The data is placed in the payload as records rather than as a string,
+            # so the payload is kept by this replacement function instead.
+            payloads = []
+
+            def replacement_invoke(FunctionName, Payload):
+                payloads.append(json.loads(Payload))
+                raise Exception("Stopped after the invoke.")
+
+            mock_client_object.invoke.side_effect = replacement_invoke
 
             # This stops the Error caused by the replacement function from stopping
             # the test.
@@ -362,20 +512,24 @@ def test_wrangler_success_passed():
         test_data_prepared = file_2.read()
     prepared_data = pd.DataFrame(json.loads(test_data_prepared))
 
-    with open("tests/fixtures/test_wrangler_to_method_input.json", "r") as file_3:
-        test_data_produced = file_3.read()
-    produced_data = pd.DataFrame(json.loads(test_data_produced))
+    produced_dict = payloads[0]["RuntimeVariables"]
+    produced_data = pd.DataFrame(produced_dict["data"])
 
     # Compares the data.
-    assert_frame_equal(produced_data, prepared_data)
+    assert_frame_equal(produced_data.sort_index(axis=1),
+                       prepared_data.sort_index(axis=1))
 
     with open("tests/fixtures/test_wrangler_to_method_runtime.json", "r") as file_4:
-        test_dict_prepared = file_4.read()
-    produced_dict = json.loads(test_dict_prepared)
+        test_dict_prepared = json.loads(file_4.read())
+
+    # Anomalies passed back to the wrangler are rendered there.
+    assert produced_dict.pop("anomaly_format") == "compact"
 
     # Ensures data is not in the RuntimeVariables and then compares.
+    produced_dict["data"] = None
     method_runtime_variables["RuntimeVariables"]["data"] = None
     assert produced_dict == method_runtime_variables["RuntimeVariables"]
+    assert produced_dict == test_dict_prepared
 
 
 @mock_s3
@@ -426,3 +580,962 @@ def test_wrangler_success_returned(mock_s3_put):
 
     assert output
     assert_frame_equal(produced_data, prepared_data)
+
+
+@mock_s3
+def test_method_success_by_reference():
+    """
+    Runs the method function with the data passed by s3 location.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        bucket_name = method_environment_variables["bucket_name"]
+        client = test_generic_library.create_bucket(bucket_name)
+
+        file_list = ["responder_county_lookup.json",
+                     "county_marine_lookup.json",
+                     "test_method_input.json"]
+
+        test_generic_library.upload_files(client, bucket_name, file_list)
+
+        runtime_variables = json.loads(json.dumps(method_runtime_variables))
+        runtime_variables["RuntimeVariables"].pop("data")
+        runtime_variables["RuntimeVariables"]["in_location"] = "test_method_input"
+        runtime_variables["RuntimeVariables"]["out_location"] = "enriched_output"
+        runtime_variables["RuntimeVariables"]["anomalies_location"] = \
+            "Enrichment_Anomalies"
+
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+        produced_data_main = pd.read_json(client.get_object(
+            Bucket=bucket_name, Key="enriched_output.json")["Body"].read().decode(
+            "utf-8"), dtype=False).sort_index(axis=1)
+        produced_data_anomalies = pd.read_json(client.get_object(
+            Bucket=bucket_name, Key="Enrichment_Anomalies.json")["Body"].read().decode(
+            "utf-8"), dtype=False)
+
+    with open("tests/fixtures/test_method_prepared_output.json", "r") as file_1:
+        prepared_data_main = pd.DataFrame(json.loads(file_1.read()))
+
+    with open("tests/fixtures/test_method_anomalies_prepared_output.json", "r")\
+            as file_2:
+        prepared_data_anomalies = pd.DataFrame(json.loads(file_2.read()))
+
+    assert output == {"success": True, "rows": len(prepared_data_main),
+                      "anomaly_count": len(prepared_data_anomalies)}
+    assert_frame_equal(produced_data_main, prepared_data_main)
+    assert_frame_equal(produced_data_anomalies, prepared_data_anomalies)
+
+
+@mock_s3
+@mock.patch('enrichment_wrangler.aws_functions.send_bpm_status')
+@mock.patch('enrichment_wrangler.aws_functions.send_sns_message_with_anomalies')
+@mock.patch('enrichment_wrangler.aws_functions.save_to_s3')
+def test_wrangler_success_by_reference(mock_save_to_s3, mock_send_sns,
+                                       mock_send_bpm_status):
+    """
+    Runs the wrangler function with an input too large to pass by value.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    environment_variables = dict(wrangler_environment_variables,
+                                 inline_payload_limit="0")
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         environment_variables):
+        with mock.patch("enrichment_wrangler.boto3.client") as mock_client:
+            mock_client_object = mock.Mock()
+            mock_client.return_value = mock_client_object
+
+            mock_client_object.invoke.return_value.get.return_value.read \
+                .return_value.decode.return_value = json.dumps({
+                 "success": True,
+                 "rows": 5,
+                 "anomaly_count": 1
+                })
+
+            output = lambda_wrangler_function.lambda_handler(
+                wrangler_runtime_variables, test_generic_library.context_object
+            )
+
+    payload = json.loads(mock_client_object.invoke.call_args[1]["Payload"])
+
+    assert output
+    assert "data" not in payload["RuntimeVariables"]
+    assert payload["RuntimeVariables"]["in_location"] == "test_wrangler_input"
+    assert payload["RuntimeVariables"]["out_location"] == \
+        wrangler_runtime_variables["RuntimeVariables"]["out_file_name"]
+    mock_save_to_s3.assert_not_called()
+    mock_send_sns.assert_called_once_with(True, "fake_sns_arn", "Enrichment.")
+
+
+@pytest.mark.parametrize("file_format", ["json", "jsonl"])
+@pytest.mark.parametrize("chunk_size", [1, 2, 1000])
+@mock_s3
+def test_method_streaming_matches_batch(chunk_size, file_format):
+    """
+    Runs the method function by s3 location with and without chunking, on an input
+    with a column of whole numbers that is null in one row and missing in another,
+    and checks the files written are byte for byte the same.
+    :param chunk_size: Rows to enrich at a time - Type: Int
+    :param file_format: Format of the input and output - Type: String
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        bucket_name = method_environment_variables["bucket_name"]
+        client = test_generic_library.create_bucket(bucket_name)
+
+        file_list = ["responder_county_lookup.json",
+                     "county_marine_lookup.json"]
+
+        test_generic_library.upload_files(client, bucket_name, file_list)
+
+        with open("tests/fixtures/test_method_input.json", "r") as file:
+            test_data = pd.DataFrame(json.loads(file.read()))
+        test_data["Q601_asphalting_sand"] = \
+            test_data["Q601_asphalting_sand"].astype(object)
+        test_data.loc[1, "Q601_asphalting_sand"] = None
+        records = json.loads(test_data.to_json(orient="records"))
+        del records[5]["Q601_asphalting_sand"]
+        if file_format == "jsonl":
+            body = "\n".join(json.dumps(record) for record in records)
+        else:
+            body = json.dumps(records)
+        client.put_object(Bucket=bucket_name,
+                          Key=io_functions.s3_key("test_method_input", file_format),
+                          Body=body)
+
+        outputs = {}
+        for mode in ["batch", "stream"]:
+            runtime_variables = json.loads(json.dumps(method_runtime_variables))
+            runtime_variables["RuntimeVariables"].pop("data")
+            runtime_variables["RuntimeVariables"].update({
+                "in_location": "test_method_input",
+                "out_location": mode + "_output",
+                "anomalies_location": mode + "_anomalies",
+                "file_format": file_format
+            })
+            if mode == "stream":
+                runtime_variables["RuntimeVariables"]["chunk_size"] = chunk_size
+
+            summary = lambda_method_function.lambda_handler(
+                runtime_variables, test_generic_library.context_object)
+
+            outputs[mode] = [summary] + [
+                client.get_object(Bucket=bucket_name, Key=io_functions.s3_key(
+                    mode + file_name, file_format))["Body"].read()
+                for file_name in ["_output", "_anomalies"]]
+
+    assert outputs["stream"] == outputs["batch"]
+    assert b"null" in outputs["batch"][1]
+
+
+@mock_s3
+def test_method_dry_run():
+    """
+    Runs the method function as a dry run, which only plans the joins.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        bucket_name = method_environment_variables["bucket_name"]
+        client = test_generic_library.create_bucket(bucket_name)
+
+        test_generic_library.upload_files(client, bucket_name,
+                                          ["responder_county_lookup.json",
+                                           "county_marine_lookup.json"])
+
+        with open("tests/fixtures/test_method_input.json", "r") as file:
+            test_data = file.read()
+
+        runtime_variables = json.loads(json.dumps(method_runtime_variables))
+        runtime_variables["RuntimeVariables"]["data"] = test_data
+        runtime_variables["RuntimeVariables"]["dry_run"] = True
+
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+    assert output["success"]
+    assert "data" not in output
+    assert output["plan"]["rows"] == 8
+    assert output["plan"]["steps"] == [{
+        "join_column": "responder_id",
+        "lookups": ["responder_county_lookup", "county_marine_lookup"],
+        "fused": True,
+        "artefact": False,
+        "columns": ["county", "county_name", "region", "marine"],
+        "lookup_rows": 78,
+        "estimated_cost": 8 * 5 + 78 * 4}]
+
+
+@mock_s3
+def test_method_output_unchanged_by_compact_dtypes():
+    """
+    Runs the method function with and without compact column types and checks the
+    JSON written is the same.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        bucket_name = method_environment_variables["bucket_name"]
+        client = test_generic_library.create_bucket(bucket_name)
+
+        test_generic_library.upload_files(client, bucket_name,
+                                          ["responder_county_lookup.json",
+                                           "county_marine_lookup.json"])
+
+        with open("tests/fixtures/test_method_input.json", "r") as file:
+            test_data = file.read()
+
+        runtime_variables = json.loads(json.dumps(method_runtime_variables))
+        runtime_variables["RuntimeVariables"]["data"] = test_data
+
+        lookup_functions.lookup_cache.clear()
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+
+        lookup_functions.lookup_cache.clear()
+        with mock.patch("dtype_functions.compact_dtypes",
+                        side_effect=lambda data, *args, **kwargs: data):
+            uncompacted_output = lambda_method_function.lambda_handler(
+                runtime_variables, test_generic_library.context_object)
+        lookup_functions.lookup_cache.clear()
+
+    assert output == uncompacted_output
+
+
+@mock_s3
+def test_method_metrics(capsys):
+    """
+    Runs the method function with metrics enabled and checks a stage record is
+    written for the run.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         dict(method_environment_variables, metrics_enabled="true")):
+        bucket_name = method_environment_variables["bucket_name"]
+        client = test_generic_library.create_bucket(bucket_name)
+
+        test_generic_library.upload_files(client, bucket_name,
+                                          ["responder_county_lookup.json",
+                                           "county_marine_lookup.json"])
+
+        with open("tests/fixtures/test_method_input.json", "r") as file:
+            test_data = file.read()
+
+        runtime_variables = json.loads(json.dumps(method_runtime_variables))
+        runtime_variables["RuntimeVariables"]["data"] = test_data
+
+        lookup_functions.lookup_cache.clear()
+        output = lambda_method_function.lambda_handler(
+            runtime_variables, test_generic_library.context_object)
+        lookup_functions.lookup_cache.clear()
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()
+               if line.startswith('{"_aws"')]
+
+    assert output["success"]
+    assert len(records) == 1
+    assert records[0]["module"] == "Enrichment - Method"
+    assert records[0]["success"]
+    assert records[0]["read_input.rows_out"] == len(json.loads(test_data))
+    assert records[0]["fetch_lookups.bytes_read"] > 0
+    assert "join.duration_ms" in records[0]
+
+
+@mock_s3
+def test_method_incremental_matches_full():
+    """
+    Reruns the method incrementally after changing the input and each lookup, and
+    checks the output matches a full run while only the affected rows are
+    enriched, and that a lookup schema change rebuilds every row.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        bucket_name = method_environment_variables["bucket_name"]
+        client = test_generic_library.create_bucket(bucket_name)
+
+        test_generic_library.upload_files(client, bucket_name,
+                                          ["responder_county_lookup.json",
+                                           "county_marine_lookup.json",
+                                           "test_method_input.json"])
+
+        files = {name: pd.read_json(f"tests/fixtures/{name}.json", dtype=False)
+                 for name in ["responder_county_lookup", "county_marine_lookup",
+                              "test_method_input"]}
+
+        def upload(name):
+            client.put_object(Bucket=bucket_name, Key=name + ".json",
+                              Body=files[name].to_json(orient="records"))
+
+        def run():
+            outputs = {}
+            for mode in ["full", "incremental"]:
+                runtime_variables = json.loads(json.dumps(method_runtime_variables))
+                runtime_variables["RuntimeVariables"].pop("data")
+                runtime_variables["RuntimeVariables"].update({
+                    "in_location": "test_method_input",
+                    "out_location": mode + "_output",
+                    "anomalies_location": mode + "_anomalies",
+                    "incremental": mode == "incremental"
+                })
+
+                with mock.patch.object(lambda_method_function, "join_lookups",
+                                       wraps=lambda_method_function.join_lookups) \
+                        as join_lookups:
+                    summary = lambda_method_function.lambda_handler(
+                        runtime_variables, test_generic_library.context_object)
+
+                outputs[mode] = [summary] + [
+                    json.loads(client.get_object(
+                        Bucket=bucket_name,
+                        Key=mode + file_name + ".json")["Body"].read())
+                    for file_name in ["_output", "_anomalies"]]
+
+            assert outputs["incremental"] == outputs["full"]
+            return len(join_lookups.call_args[0][0])
+
+        # The first run has no state.
+        assert run() == 8
+        assert run() == 0
+
+        # A changed row and a new row.
+        data = files["test_method_input"]
+        data.loc[3, "Q601_asphalting_sand"] = 7
+        files["test_method_input"] = pd.concat(
+            [data, data.loc[[0]].assign(responder_id=674)], ignore_index=True)
+        upload("test_method_input")
+        assert run() == 2
+
+        # Responder 670 moves from Kent to Surrey.
+        county = files["responder_county_lookup"]
+        county.loc[county["responder_id"] == 670, "county"] = 23
+        upload("responder_county_lookup")
+        assert run() == 1
+
+        # Only 672 is still in Kent, joined by the county added by the first lookup.
+        marine = files["county_marine_lookup"]
+        marine.loc[marine["county"] == 22, "marine"] = "n"
+        upload("county_marine_lookup")
+        assert run() == 1
+
+        # Regions as strings are a different schema.
+        marine["region"] = marine["region"].astype(str)
+        upload("county_marine_lookup")
+        assert run() == 9
+
+        lookup_functions.lookup_cache.clear()
+
+
+@mock_s3
+@mock.patch('enrichment_wrangler.aws_functions.send_bpm_status')
+@mock.patch('enrichment_wrangler.aws_functions.send_sns_message_with_anomalies')
+def test_wrangler_success_asynchronous(mock_send_sns, mock_send_bpm_status):
+    """
+    Runs the wrangler function asynchronously, then the method on the payload it
+    was invoked with, then the finaliser on the completion the method writes.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    file_list = ["responder_county_lookup.json",
+                 "county_marine_lookup.json",
+                 "test_wrangler_input.json"]
+
+    test_generic_library.upload_files(client, bucket_name, file_list)
+
+    runtime_variables = json.loads(json.dumps(wrangler_runtime_variables))
+    runtime_variables["RuntimeVariables"]["asynchronous"] = True
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         wrangler_environment_variables):
+        with mock.patch("enrichment_wrangler.boto3.client") as mock_client:
+            mock_client_object = mock.Mock()
+            mock_client.return_value = mock_client_object
+
+            output = lambda_wrangler_function.lambda_handler(
+                runtime_variables, test_generic_library.context_object)
+
+    assert output == {"success": True,
+                      "completion_location": "enrichment_completions/bob"}
+    assert mock_client_object.invoke.call_args[1]["InvocationType"] == "Event"
+    mock_send_sns.assert_not_called()
+    assert mock_send_bpm_status.call_count == 1
+
+    # The method runs in its own container.
+    startup_functions.reset()
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        lambda_method_function.lambda_handler(
+            json.loads(mock_client_object.invoke.call_args[1]["Payload"]),
+            test_generic_library.context_object)
+
+    completion = json.loads(client.get_object(
+        Bucket=bucket_name, Key="enrichment_completions/bob.json")["Body"].read())
+
+    assert completion["success"]
+    assert completion["sns_topic_arn"] == "fake_sns_arn"
+    assert completion["rows"] > 0
+
+    event = {"Records": [{"s3": {"bucket": {"name": bucket_name},
+                                 "object": {"key": "enrichment_completions/bob.json"}}}]}
+    output = lambda_finaliser_function.lambda_handler(
+        event, test_generic_library.context_object)
+
+    assert output == {"success": True}
+    mock_send_sns.assert_called_once_with(completion["anomaly_count"] > 0,
+                                          "fake_sns_arn", "Enrichment.")
+    assert mock_send_bpm_status.call_args[0][2] == "DONE"
+
+
+@mock_s3
+@mock.patch('enrichment_finaliser.aws_functions.send_sns_message_with_anomalies')
+def test_finaliser_method_error(mock_send_sns):
+    """
+    Runs the finaliser function on the completion of a failed method run.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    client.put_object(Bucket=bucket_name, Key="enrichment_completions/bob.json",
+                      Body=json.dumps({
+                          "bpm_queue_url": "fake_queue_url",
+                          "current_step_num": 2,
+                          "environment": "sandbox",
+                          "error": "KeyError in Enrichment - Method: 'county'",
+                          "run_id": "bob",
+                          "sns_topic_arn": "fake_sns_arn",
+                          "success": False,
+                          "survey": "BMI_SG",
+                          "total_steps": 6}))
+
+    event = {"Records": [{"s3": {"bucket": {"name": bucket_name},
+                                 "object": {"key": "enrichment_completions/bob.json"}}}]}
+
+    with pytest.raises(exception_classes.LambdaFailure) as exc_info:
+        lambda_finaliser_function.lambda_handler(event,
+                                                 test_generic_library.context_object)
+
+    assert "'county'" in str(exc_info.value)
+    mock_send_sns.assert_not_called()
+
+
+@mock_s3
+def test_method_completion_write_error():
+    """
+    Runs the method function asynchronously with the completion failing to be
+    written, and checks the error is returned rather than raised, so lambda does
+    not run the enrichment again.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = method_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["responder_county_lookup.json",
+                                       "county_marine_lookup.json",
+                                       "test_method_input.json"])
+
+    runtime_variables = json.loads(json.dumps(method_runtime_variables))
+    runtime_variables["RuntimeVariables"].pop("data")
+    runtime_variables["RuntimeVariables"].update({
+        "in_location": "test_method_input",
+        "out_location": "enriched_output",
+        "anomalies_location": "Enrichment_Anomalies",
+        "completion_location": "enrichment_completions/bob",
+        "completion_context": {"run_id": "bob"}})
+
+    save_to_s3 = lambda_method_function.aws_functions.save_to_s3
+
+    def fail_completion(bucket_name, file_name, *args, **kwargs):
+        if file_name == "enrichment_completions/bob":
+            raise ClientError({"Error": {"Code": "SlowDown",
+                                         "Message": "Please reduce your request rate."}},
+                              "PutObject")
+        return save_to_s3(bucket_name, file_name, *args, **kwargs)
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        with mock.patch("enrichment_method.aws_functions.save_to_s3",
+                        side_effect=fail_completion):
+            output = lambda_method_function.lambda_handler(
+                runtime_variables, test_generic_library.context_object)
+
+    assert output["success"] is False
+    assert "SlowDown" in output["error"]
+    client.head_object(Bucket=bucket_name, Key="enriched_output.json")
+    assert "Contents" not in client.list_objects_v2(
+        Bucket=bucket_name, Prefix="enrichment_completions/")
+
+
+@mock_s3
+def test_method_validation_error_asynchronous():
+    """
+    Runs the method function asynchronously with an invalid runtime variable, and
+    checks the error is reported to BPM and written to the completion location,
+    so the finaliser ends the run.
+    :param None
+    :return Test Pass/Fail
+    """
+    bucket_name = method_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+
+    runtime_variables = json.loads(json.dumps(method_runtime_variables))
+    runtime_variables["RuntimeVariables"].pop("data")
+    runtime_variables["RuntimeVariables"].update({
+        "in_location": "test_method_input",
+        "out_location": "enriched_output",
+        "anomalies_location": "Enrichment_Anomalies",
+        "chunk_size": "ten",
+        "completion_location": "enrichment_completions/bob",
+        "completion_context": {"run_id": "bob", "sns_topic_arn": "fake_sns_arn"}})
+
+    with mock.patch.dict(lambda_method_function.os.environ,
+                         method_environment_variables):
+        with mock.patch("enrichment_method.general_functions.handle_exception",
+                        wraps=lambda_method_function.general_functions
+                        .handle_exception) as mock_handle_exception:
+            output = lambda_method_function.lambda_handler(
+                runtime_variables, test_generic_library.context_object)
+
+    assert output["success"] is False
+    assert "chunk_size" in output["error"]
+    assert mock_handle_exception.call_args[1]["bpm_queue_url"] == "fake_queue_url"
+
+    completion = json.loads(client.get_object(
+        Bucket=bucket_name, Key="enrichment_completions/bob.json")["Body"].read())
+    assert completion == {"run_id": "bob", "sns_topic_arn": "fake_sns_arn",
+                          "success": False, "error": output["error"]}
+
+
+def invoke_in_process(FunctionName, Payload):
+    """
+    Stands in for the lambda client's invoke, running the method in this process.
+    :param FunctionName: Name of the method lambda - String
+    :param Payload: Payload for the method - String
+    :return response: Response holding the method's output - Dict
+    """
+    output = lambda_method_function.lambda_handler(json.loads(Payload),
+                                                   test_generic_library.context_object)
+    return {"Payload": io.BytesIO(json.dumps(output).encode("utf-8"))}
+
+
+def run_wrangler_in_process(runtime_variables, invoke=invoke_in_process,
+                            inline_payload_limit="0"):
+    """
+    Runs the wrangler function with the method run in process, and reads back the
+    data and anomalies it wrote.
+    :param runtime_variables: Runtime variables for the wrangler - Dict
+    :param invoke: Stand in for the lambda client's invoke - Function
+    :param inline_payload_limit: Largest input passed by value, by default none
+                                 are - String
+    :return data: Data written, or None - Bytes
+    :return anomalies: Anomalies written, or None - Bytes
+    :return mock_invoke: The stand in invoke - Mock
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["responder_county_lookup.json",
+                                       "county_marine_lookup.json",
+                                       "test_wrangler_input.json"])
+
+    stand_in = mock.Mock()
+    stand_in.invoke.side_effect = invoke
+    real_client = startup_functions.client
+
+    with mock.patch.dict(lambda_wrangler_function.os.environ,
+                         dict(wrangler_environment_variables,
+                              inline_payload_limit=inline_payload_limit)):
+        with mock.patch("startup_functions.client",
+                        side_effect=lambda service: stand_in
+                        if service == "lambda" else real_client(service)):
+            output = lambda_wrangler_function.lambda_handler(
+                runtime_variables, test_generic_library.context_object)
+
+    assert output == {"success": True}
+
+    written = []
+    for key in [io_functions.s3_key(wrangler_runtime_variables[
+            "RuntimeVariables"]["out_file_name"]), "Enrichment_Anomalies.json"]:
+        try:
+            written.append(client.get_object(Bucket=bucket_name, Key=key)["Body"]
+                           .read())
+        except client.exceptions.NoSuchKey:
+            written.append(None)
+    assert "Contents" not in client.list_objects_v2(
+        Bucket=bucket_name, Prefix=lambda_wrangler_function.PARTITION_PREFIX)
+
+    return written[0], written[1], stand_in.invoke
+
+
+# Hashing 8 rows into 8 partitions leaves some empty, and there is only one period.
+@pytest.mark.parametrize("partition_column,partitions,invocations",
+                         [(None, 3, 3), (None, 8, 4), ("survey", 2, 2),
+                          ("period", 2, 1), ("survey", None, 1)])
+@mock.patch('enrichment_wrangler.aws_functions.send_bpm_status')
+@mock.patch('enrichment_wrangler.aws_functions.send_sns_message_with_anomalies')
+def test_wrangler_partitioned_matches_single(mock_send_sns, mock_send_bpm_status,
+                                             partition_column, partitions,
+                                             invocations):
+    """
+    Runs the wrangler function with the input split into partitions, and checks
+    it writes the same data and anomalies as a single invocation of the method.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock_s3():
+        data, anomalies, _ = run_wrangler_in_process(wrangler_runtime_variables)
+
+    runtime_variables = json.loads(json.dumps(wrangler_runtime_variables))
+    if partition_column:
+        runtime_variables["RuntimeVariables"]["partition_column"] = partition_column
+    if partitions:
+        runtime_variables["RuntimeVariables"]["partitions"] = partitions
+
+    lookup_functions.lookup_cache.clear()
+    startup_functions.reset()
+    with mock_s3():
+        partitioned_data, partitioned_anomalies, mock_invoke = \
+            run_wrangler_in_process(runtime_variables)
+
+    assert len(json.loads(anomalies)) > 0
+    assert partitioned_data == data
+    assert partitioned_anomalies == anomalies
+    assert mock_invoke.call_count == invocations
+    assert mock_send_sns.call_args_list[0] == mock_send_sns.call_args_list[1]
+
+
+@mock.patch('enrichment_wrangler.aws_functions.send_bpm_status')
+@mock.patch('enrichment_wrangler.aws_functions.send_sns_message_with_anomalies')
+def test_wrangler_partitioned_retry(mock_send_sns, mock_send_bpm_status):
+    """
+    Runs the wrangler function with one partition failing on its first invoke,
+    and checks only that partition is invoked again.
+    :param None
+    :return Test Pass/Fail
+    """
+    failed = []
+
+    def invoke_failing_once(FunctionName, Payload):
+        in_location = json.loads(Payload)["RuntimeVariables"]["in_location"]
+        if in_location.endswith("input-1") and not failed:
+            failed.append(in_location)
+            raise Exception("Rate exceeded")
+        return invoke_in_process(FunctionName, Payload)
+
+    runtime_variables = json.loads(json.dumps(wrangler_runtime_variables))
+    runtime_variables["RuntimeVariables"]["partitions"] = 3
+
+    with mock_s3():
+        data, anomalies, mock_invoke = run_wrangler_in_process(
+            runtime_variables, invoke_failing_once)
+
+    in_locations = [json.loads(call[1]["Payload"])["RuntimeVariables"]["in_location"]
+                    for call in mock_invoke.call_args_list]
+
+    assert mock_invoke.call_count == 4
+    assert in_locations[3] == failed[0]
+    assert len(json.loads(data)) == 8
+
+
+@mock.patch('enrichment_wrangler.aws_functions.send_bpm_status')
+@mock.patch('enrichment_wrangler.aws_functions.send_sns_message_with_anomalies')
+def test_wrangler_partition_failure_not_reported(mock_send_sns, mock_send_bpm_status):
+    """
+    Runs the wrangler function with one partition failing inside the method on
+    its first invoke, and checks the method does not report the failed attempt
+    to BPM, leaving the wrangler to report the run once.
+    :param None
+    :return Test Pass/Fail
+    """
+    failed = []
+
+    def invoke_failing_once(FunctionName, Payload):
+        payload = json.loads(Payload)
+        in_location = payload["RuntimeVariables"]["in_location"]
+        if in_location.endswith("input-1") and not failed:
+            failed.append(in_location)
+            payload["RuntimeVariables"]["in_location"] = "missing_input"
+        return invoke_in_process(FunctionName, json.dumps(payload))
+
+    runtime_variables = json.loads(json.dumps(wrangler_runtime_variables))
+    runtime_variables["RuntimeVariables"]["partitions"] = 3
+
+    with mock_s3():
+        with mock.patch("enrichment_method.general_functions.handle_exception",
+                        wraps=lambda_method_function.general_functions
+                        .handle_exception) as mock_handle_exception:
+            data, _, mock_invoke = run_wrangler_in_process(runtime_variables,
+                                                           invoke_failing_once)
+
+    assert mock_invoke.call_count == 4
+    assert all(json.loads(call[1]["Payload"])["RuntimeVariables"]["bpm_queue_url"]
+               is None for call in mock_invoke.call_args_list)
+    assert mock_handle_exception.call_count == 1
+    assert mock_handle_exception.call_args[1]["bpm_queue_url"] is None
+    assert [call[0][2] for call in mock_send_bpm_status.call_args_list] == \
+        ["IN PROGRESS", "DONE"]
+    assert len(json.loads(data)) == 8
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+@pytest.mark.parametrize("inline_payload_limit,partitions",
+                         [("0", None), ("0", 2), ("4194304", None)])
+@mock.patch('enrichment_wrangler.aws_functions.send_bpm_status')
+@mock.patch('enrichment_wrangler.aws_functions.send_sns_message_with_anomalies')
+def test_wrangler_compressed_matches_uncompressed(mock_send_sns, mock_send_bpm_status,
+                                                  compression, inline_payload_limit,
+                                                  partitions):
+    """
+    Runs the wrangler function with compression, passing the data by value, by
+    s3 location and in partitions, and checks the data and anomalies written are
+    compressed and otherwise the same as without compression.
+    :param None
+    :return Test Pass/Fail
+    """
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+
+    runtime_variables = json.loads(json.dumps(wrangler_runtime_variables))
+    if partitions:
+        runtime_variables["RuntimeVariables"]["partitions"] = partitions
+
+    with mock_s3():
+        data, anomalies, _ = run_wrangler_in_process(
+            runtime_variables, inline_payload_limit=inline_payload_limit)
+
+    runtime_variables["RuntimeVariables"]["compression"] = compression
+    lookup_functions.lookup_cache.clear()
+    startup_functions.reset()
+    with mock_s3():
+        compressed_data, compressed_anomalies, mock_invoke = run_wrangler_in_process(
+            runtime_variables, inline_payload_limit=inline_payload_limit)
+
+    payload = json.loads(mock_invoke.call_args[1]["Payload"])["RuntimeVariables"]
+    assert payload["compression"] == compression
+    if inline_payload_limit != "0":
+        assert compression_functions.decode_bytes(payload["data"]) is not None
+
+    assert compression_functions.detect(compressed_data) == compression
+    assert compression_functions.detect(compressed_anomalies) == compression
+    assert compression_functions.decompress(compressed_data) == data
+    assert compression_functions.decompress(compressed_anomalies) == anomalies
+
+
+@pytest.mark.parametrize("anomaly_format", ["records", "compact"])
+@mock.patch('enrichment_wrangler.aws_functions.send_bpm_status')
+@mock.patch('enrichment_wrangler.aws_functions.send_sns_message_with_anomalies')
+def test_wrangler_anomaly_format(mock_send_sns, mock_send_bpm_status, anomaly_format):
+    """
+    Runs the wrangler function with the data passed by value, by s3 location and
+    in partitions, and checks the same anomalies are written each way. Passed by
+    value or partitioned, the method's anomalies come back compact.
+    :param anomaly_format: One of ANOMALY_FORMATS - Type: String
+    :return Test Pass/Fail
+    """
+    runtime_variables = json.loads(json.dumps(wrangler_runtime_variables))
+    runtime_variables["RuntimeVariables"]["anomaly_format"] = anomaly_format
+
+    outputs = []
+    for inline_payload_limit, partitions in [("0", None), ("4194304", None),
+                                             ("0", 2)]:
+        runtime_variables["RuntimeVariables"].pop("partitions", None)
+        if partitions:
+            runtime_variables["RuntimeVariables"]["partitions"] = partitions
+        lookup_functions.lookup_cache.clear()
+        startup_functions.reset()
+        with mock_s3():
+            data, anomalies, mock_invoke = run_wrangler_in_process(
+                runtime_variables, inline_payload_limit=inline_payload_limit)
+            table = json.loads(startup_functions.client("s3").get_object(
+                Bucket=wrangler_environment_variables["bucket_name"],
+                Key="Enrichment_Anomalies_codes.json")["Body"].read()) \
+                if anomaly_format == "compact" else None
+        outputs.append((data, json.loads(anomalies), table))
+
+        payload = json.loads(mock_invoke.call_args[1]["Payload"])["RuntimeVariables"]
+        assert payload["anomaly_format"] == \
+            (anomaly_format if inline_payload_limit == "0" and not partitions
+             else "compact")
+
+    for data, anomalies, table in outputs[1:]:
+        assert data == outputs[0][0]
+        assert anomalies == outputs[0][1]
+        assert table == outputs[0][2]
+
+    if anomaly_format == "compact":
+        assert "checks" in outputs[0][1][0]
+        assert "issue" not in outputs[0][1][0]
+        assert sum(count["count"] for count in outputs[0][2]["counts"]) >= \
+            len(outputs[0][1])
+    else:
+        assert "issue" in outputs[0][1][0]
+
+
+@pytest.mark.parametrize("inline_payload_limit", ["0", "4194304"])
+@mock.patch('enrichment_wrangler.aws_functions.send_bpm_status')
+@mock.patch('enrichment_wrangler.aws_functions.send_sns_message_with_anomalies')
+def test_wrangler_validate_only(mock_send_sns, mock_send_bpm_status,
+                                inline_payload_limit):
+    """
+    Runs the wrangler function with validate_only, with the data passed by value
+    and by s3 location, and checks the anomalies are those of a full run and no
+    output is written.
+    :param inline_payload_limit: Largest input passed by value - Type: String
+    :return Test Pass/Fail
+    """
+    outputs = []
+    for validate_only in [False, True]:
+        runtime_variables = json.loads(json.dumps(wrangler_runtime_variables))
+        runtime_variables["RuntimeVariables"]["validate_only"] = validate_only
+        lookup_functions.lookup_cache.clear()
+        startup_functions.reset()
+        with mock_s3():
+            outputs.append(run_wrangler_in_process(
+                runtime_variables, inline_payload_limit=inline_payload_limit)[:2])
+
+    (data, anomalies), (validated_data, validated_anomalies) = outputs
+
+    assert data is not None
+    assert validated_data is None
+    assert json.loads(validated_anomalies) == json.loads(anomalies)
+    assert mock_send_sns.call_args_list[0] == mock_send_sns.call_args_list[1]
+
+
+def test_validate_data_matches_enrich_data():
+    """
+    Runs validate_data and enrich_data over chained lookups with keys missing at
+    each step, nulls held in the lookups and a declared rule, and checks the
+    anomalies are the same.
+    :param None
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"responder_id": [1, 2, 3, 4, 5, 6],
+                         "survey": ["076", "066", "076", "076", "066", "076"],
+                         "period": [201809] * 6})
+    responders = pd.DataFrame({"responder_id": [1, 2, 3, 4, 6],
+                               "county": [10, 11, 12, 99, None]})
+    counties = pd.DataFrame({"county": [10, 11, 12],
+                             "county_name": ["DURHAM", None, "KENT"],
+                             "region": ["a", "b", None],
+                             "marine": ["n", "y", "n"]})
+    lookup_tables = [
+        lookup_functions.LookupTable(responders, "responder_id",
+                                     ["responder_id", "county"]),
+        lookup_functions.LookupTable(counties, "county",
+                                     ["county", "county_name", "region", "marine"])]
+
+    test_lookups = json.loads(json.dumps(lookups))
+    test_lookups["1"]["required"] = ["region", "marine", "county_name"]
+    rules = anomaly_functions.build_rules(
+        test_lookups, True, "survey", "period",
+        {0: {"rule_type": "match", "conditions": {"county_name": "KENT"},
+             "issue": "Kent.", "report_columns": ["county"]}})
+
+    _, anomalies = lambda_method_function.enrich_data(
+        data, lookup_tables, rules, "responder_id", keep_columns=["period"])
+    validated = lambda_method_function.validate_data(
+        data, lookup_tables, rules, "responder_id", keep_columns=["period"])
+
+    assert_frame_equal(validated, anomalies)
+    assert len(anomalies) == 6
+    assert list(data.columns) == ["responder_id", "survey", "period"]
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+@mock_s3
+def test_write_output_in_parts(monkeypatch, compression):
+    """
+    Runs write_output with text past MULTIPART_THRESHOLD, with characters that
+    take more than one byte, and checks it is uploaded in parts with the same
+    contents and encoding as a single PUT.
+    :param compression: Compression the text was encoded with - Type: String
+    :return Test Pass/Fail
+    """
+    bucket_name = wrangler_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    monkeypatch.setattr(lambda_wrangler_function, "MULTIPART_THRESHOLD", 1024)
+
+    # Random ids, so that the compressed text is still more than one part.
+    text = json.dumps([{"responder_id": uuid.uuid4().hex, "county_name": "Ynys Môn"}
+                       for _ in range(400000)], ensure_ascii=False)
+    encoded = compression_functions.encode_text(text, compression)
+
+    bytes_written = lambda_wrangler_function.write_output(bucket_name, "output",
+                                                          encoded)
+
+    response = client.get_object(Bucket=bucket_name, Key="output.json")
+    body = response["Body"].read()
+    assert bytes_written == len(body)
+    parts = -(-len(body) // io_functions.MIN_PART_SIZE)
+    assert parts > 1
+    assert response["ETag"].endswith(f'-{parts}"')
+    assert response.get("ContentEncoding") == compression
+    assert compression_functions.decompress(body).decode("utf-8") == text
+
+
+@mock.patch('enrichment_wrangler.aws_functions.send_bpm_status')
+@mock.patch('enrichment_wrangler.aws_functions.send_sns_message_with_anomalies')
+@mock.patch('enrichment_wrangler.write_anomalies', side_effect=OSError("Slow down"))
+def test_wrangler_sns_after_writes(mock_write_anomalies, mock_send_sns,
+                                   mock_send_bpm_status):
+    """
+    Runs the wrangler function with the data passed by value and the anomalies
+    failing to be written, and checks the data is still written alongside them
+    but sns is not sent.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock_s3():
+        with pytest.raises(exception_classes.LambdaFailure):
+            run_wrangler_in_process(wrangler_runtime_variables,
+                                    inline_payload_limit="4194304")
+
+        client = startup_functions.client("s3")
+        client.head_object(Bucket=wrangler_environment_variables["bucket_name"],
+                           Key=io_functions.s3_key(wrangler_runtime_variables[
+                               "RuntimeVariables"]["out_file_name"]))
+
+    mock_write_anomalies.assert_called_once()
+    mock_send_sns.assert_not_called()
+
+
+@pytest.mark.parametrize("rule,valid", [
+    ({"rule_type": "missing", "columns": ["county"]}, True),
+    ({"rule_type": "missing"}, False),
+    ({"rule_type": "missing", "columns": []}, False),
+    ({"rule_type": "match", "conditions": {"marine": "n"}, "issue": "Marine."}, True),
+    ({"rule_type": "match", "issue": "Marine."}, False),
+    ({"rule_type": "match", "conditions": {"marine": "n"}}, False)])
+def test_anomaly_rule_schema(rule, valid):
+    """
+    Validates declared anomaly rules, checking those without the fields their
+    rule type needs are rejected.
+    :param rule: Declared rule - Type: Dict
+    :param valid: Whether the rule should be accepted - Type: Boolean
+    :return Test Pass/Fail
+    """
+    errors = lambda_method_function.AnomalyRuleSchema().validate(rule)
+
+    assert not errors if valid else "_schema" in errors
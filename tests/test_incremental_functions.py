@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+from es_aws_functions import test_generic_library
+from moto import mock_s3
+from pandas.testing import assert_frame_equal, assert_series_equal
+
+import incremental_functions
+
+bucket_name = "test_bucket"
+
+
+def test_changed_keys():
+    """
+    Compares two versions of a lookup and checks added, removed and changed keys
+    are found, and that the row hashes ignore compact types.
+    :param None
+    :return Test Pass/Fail
+    """
+    old = pd.DataFrame({"county": [1, 2, 3], "marine": ["y", "n", "n"]})
+    new = pd.DataFrame({"county": [1, 2, 4], "marine": ["y", "y", "n"]})
+
+    keys = incremental_functions.changed_keys(
+        incremental_functions.key_hashes(old, "county"),
+        incremental_functions.key_hashes(new, "county"), "county")
+
+    positions = keys.positions(pd.Series([1, 2, 3, 4, 5]))
+    assert (positions >= 0).tolist() == [False, True, True, True, False]
+
+    data = pd.DataFrame({"responder_id": [1, 2], "survey": ["076", "066"]})
+    compacted = data.assign(responder_id=data["responder_id"].astype(np.int8),
+                            survey=data["survey"].astype("category"))
+    assert (incremental_functions.row_hashes(data) ==
+            incremental_functions.row_hashes(compacted)).all()
+
+
+def test_splice():
+    """
+    Splices a column and anomalies from a run with those kept from the last run,
+    and checks integers lose the nulls they had in the state.
+    :param None
+    :return Test Pass/Fail
+    """
+    selected = np.array([False, True, False])
+    fresh = pd.Series([5], index=[1], dtype=np.int16)
+    previous = pd.Series([1.0, np.nan, 3.0]).iloc[[0, 2]]
+
+    assert_series_equal(incremental_functions.splice_column(fresh, previous, selected),
+                        pd.Series([1, 5, 3], dtype=np.int16))
+
+    data = pd.DataFrame({"responder_id": [7, 8, 9], "county": [1, 5, 3]})
+    fresh = pd.DataFrame({"responder_id": [8], "issue": ["b"]}, index=[1])
+    previous = pd.DataFrame({"responder_id": [9, 9, 6, 7],
+                             "issue": ["a", "c", "d", "e"],
+                             incremental_functions.ROW_COLUMN: [0, 0, 1, 2]})
+    # The last run had 9 first and 7 last, 6 has gone.
+    current_rows = np.array([2, -1, 0])
+
+    anomalies = incremental_functions.splice_anomalies(fresh, previous, current_rows,
+                                                       data)
+
+    assert_frame_equal(anomalies, pd.DataFrame(
+        {"responder_id": [7, 8, 9, 9], "issue": ["e", "b", "a", "c"]},
+        index=[0, 1, 2, 2]))
+
+
+@mock_s3
+def test_save_state():
+    """
+    Saves two generations of state and checks the manifest names the latest files
+    and the superseded ones are deleted.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    rows = pd.DataFrame({"responder_id": [1, 2], "county": [3, 4]})
+    anomalies = pd.DataFrame({"responder_id": [1], "issue": ["a"]})
+
+    assert incremental_functions.load_manifest(bucket_name, "output") is None
+
+    manifest = None
+    for _ in range(2):
+        previous_manifest = incremental_functions.load_manifest(bucket_name,
+                                                                "output")
+        manifest = incremental_functions.save_state(
+            bucket_name, "output", previous_manifest,
+            {"config_hash": "abc", "lookups": {"0": {"etag": "1"}}},
+            [(["lookups", "0", "hashes"], rows), (["rows"], rows),
+             (["anomalies"], anomalies)])
+
+    assert incremental_functions.load_manifest(bucket_name, "output") == manifest
+    assert manifest["generation"] == 2
+    assert manifest["rows"] == "enrichment_state/output/rows-2"
+    assert_frame_equal(incremental_functions.read_state(bucket_name,
+                                                        manifest["rows"]), rows)
+
+    keys = sorted(item["Key"] for item in client.list_objects_v2(
+        Bucket=bucket_name)["Contents"])
+    assert keys == ["enrichment_state/output/anomalies-2.arrow",
+                    "enrichment_state/output/lookups-0-hashes-2.arrow",
+                    "enrichment_state/output/manifest.json",
+                    "enrichment_state/output/rows-2.arrow"]
@@ -0,0 +1,184 @@
+import io
+import json
+
+import pandas as pd
+import pytest
+from es_aws_functions import test_generic_library
+from moto import mock_s3
+from pandas.testing import assert_frame_equal
+
+import compression_functions
+import io_functions
+import lookup_functions
+
+bucket_name = "test_bucket"
+
+
+@pytest.mark.parametrize(
+    "file_name,file_format,expected_format,expected_key",
+    [
+        ("test_wrangler_input", None, "json", "test_wrangler_input.json"),
+        ("test_wrangler_output.json", None, "json", "test_wrangler_output.json.json"),
+        ("region_lookup.parquet", None, "parquet", "region_lookup.parquet"),
+        ("region_lookup.feather", None, "arrow", "region_lookup.feather"),
+        ("enriched", "parquet", "parquet", "enriched.parquet"),
+        ("enriched", "arrow", "arrow", "enriched.arrow")
+    ])
+def test_file_format_and_key(file_name, file_format, expected_format, expected_key):
+    """
+    Runs file_format_for and s3_key.
+    :param file_name: Name of the file - Type: String
+    :param file_format: Format from the runtime variables - Type: String
+    :param expected_format: Format that should be picked - Type: String
+    :param expected_key: Key that should be used in s3 - Type: String
+    :return Test Pass/Fail
+    """
+    assert io_functions.file_format_for(file_name, file_format) == expected_format
+    assert io_functions.s3_key(file_name, file_format) == expected_key
+
+
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+@mock_s3
+def test_columnar_round_trip(file_format):
+    """
+    Runs write_dataframe then read_dataframe with a columnar format.
+    :param file_format: Format to write - Type: String
+    :return Test Pass/Fail
+    """
+    pytest.importorskip("pyarrow")
+    test_generic_library.create_bucket(bucket_name)
+
+    with open("tests/fixtures/test_method_output.json", "r") as file:
+        test_data = pd.DataFrame(json.loads(file.read()))
+
+    io_functions.write_dataframe(bucket_name, "enriched", test_data, file_format)
+    output = io_functions.read_dataframe(bucket_name, "enriched", file_format)
+    projected = io_functions.read_dataframe(bucket_name, "enriched", file_format,
+                                            columns=["responder_id", "county"])
+
+    assert_frame_equal(output, test_data)
+    assert list(projected.columns) == ["responder_id", "county"]
+
+
+@mock_s3
+def test_lookup_cache_parquet_lookup():
+    """
+    Runs LookupCache.get_table with a parquet lookup picked by its extension.
+    :param None
+    :return Test Pass/Fail
+    """
+    pytest.importorskip("pyarrow")
+    client = test_generic_library.create_bucket(bucket_name)
+
+    with open("tests/fixtures/region_lookup.json", "r") as file:
+        lookup = pd.DataFrame(json.loads(file.read()))
+    client.put_object(Bucket=bucket_name, Key="region_lookup.parquet",
+                      Body=io_functions.dataframe_to_bytes(lookup, "parquet"))
+
+    cache = lookup_functions.LookupCache()
+    table = cache.get_table(bucket_name, "region_lookup.parquet", "gor_code",
+                            ["region", "gor_code"])
+    output = table.enrich(pd.DataFrame({"gor_code": ["AA", "ZZ"]}))
+
+    assert output["region"].tolist()[0] == 1
+    assert output["region"].isnull().tolist() == [False, True]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024 * 1024])
+def test_read_json_columns(chunk_size):
+    """
+    Runs read_json_columns with chunks that split records.
+    :param chunk_size: Bytes read from the stream at a time - Type: Int
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/county_marine_lookup.json", "rb") as file:
+        body = file.read()
+
+    records = list(io_functions.iter_json_records(io.BytesIO(body), chunk_size))
+    output = io_functions.read_json_columns(io.BytesIO(body), ["county", "marine"])
+
+    assert records == json.loads(body)
+    assert_frame_equal(output, pd.read_json(body.decode("utf-8"),
+                                            dtype=False)[["county", "marine"]])
+
+
+@mock_s3
+def test_s3_multipart_writer():
+    """
+    Runs S3MultipartWriter with enough data for more than one part.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    body = b"0123456789" * (1024 * 1024 + 1)
+
+    with io_functions.S3MultipartWriter(bucket_name, "large.json") as writer:
+        for start in range(0, len(body), 1024 * 1024):
+            writer.write(body[start:start + 1024 * 1024])
+
+    assert len(writer._parts) == 3
+    assert client.get_object(Bucket=bucket_name, Key="large.json")["Body"].read() == \
+        body
+
+
+@mock_s3
+def test_dataframe_stream_writer_skips_empty():
+    """
+    Runs DataFrameStreamWriter without writing any rows.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+
+    with io_functions.DataFrameStreamWriter(bucket_name, "empty_data") as writer:
+        writer.write(pd.DataFrame())
+    with io_functions.DataFrameStreamWriter(bucket_name, "empty_anomalies",
+                                            skip_empty=True) as writer:
+        writer.write(pd.DataFrame())
+
+    keys = [item["Key"] for item in client.list_objects(Bucket=bucket_name)["Contents"]]
+    assert keys == ["empty_data.json"]
+    assert client.get_object(Bucket=bucket_name,
+                             Key="empty_data.json")["Body"].read() == b"[]"
+
+
+@pytest.mark.parametrize("file_format", ["json", "jsonl"])
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+@mock_s3
+def test_compressed_round_trip(file_format, compression):
+    """
+    Writes compressed files whole and streamed, and reads them back whole, in
+    chunks and as a lookup.
+    :param file_format: Format to write - Type: String
+    :param compression: One of compression_functions.COMPRESSIONS - Type: String
+    :return Test Pass/Fail
+    """
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    client = test_generic_library.create_bucket(bucket_name)
+
+    with open("tests/fixtures/county_marine_lookup.json", "r") as file:
+        test_data = pd.DataFrame(json.loads(file.read()))
+
+    io_functions.write_dataframe(bucket_name, "whole", test_data, file_format,
+                                 compression)
+    with io_functions.DataFrameStreamWriter(bucket_name, "streamed", file_format,
+                                            compression=compression) as writer:
+        writer.write(test_data.iloc[:3])
+        writer.write(test_data.iloc[3:])
+
+    for file_name in ["whole", "streamed"]:
+        response = client.get_object(Bucket=bucket_name,
+                                     Key=io_functions.s3_key(file_name, file_format))
+        assert response["ContentEncoding"] == compression
+        assert compression_functions.detect(response["Body"].read()) == compression
+
+        assert_frame_equal(io_functions.read_dataframe(bucket_name, file_name,
+                                                       file_format), test_data)
+        assert_frame_equal(pd.concat(io_functions.iter_dataframe_chunks(
+            bucket_name, file_name, file_format, 4), ignore_index=True), test_data)
+
+        table = lookup_functions.LookupCache().get_table(
+            bucket_name, file_name, "county", ["county", "marine"], file_format)
+        output = table.enrich(test_data[["county"]])
+        assert output["marine"].tolist() == test_data["marine"].tolist()
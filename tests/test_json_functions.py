@@ -0,0 +1,57 @@
+import json
+
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import json_functions
+
+
+@pytest.mark.parametrize("records", [
+    "tests/fixtures/test_method_input.json",
+    "tests/fixtures/test_method_output.json",
+    '[{"a": 1, "b": "x", "c": 1.5}, {"a": 2, "b": null, "c": null}]',
+    '[{"a": 1}, {"b": "2"}, {"a": "3", "b": true}]',
+    '[{"created_at": 1500000000000, "a": 1}]',
+    '[]'])
+def test_read_records(records):
+    """
+    Reads records from a string and already parsed, and checks the DataFrame is
+    the same as pd.read_json gives.
+    :param records: JSON records, or a fixture holding them - String
+    :return Test Pass/Fail
+    """
+    if records.startswith("tests/"):
+        with open(records, "r") as file:
+            records = file.read()
+
+    expected = pd.read_json(records, dtype=False)
+
+    for data in [records, json.loads(records)]:
+        produced = json_functions.read_records(data)
+        assert_frame_equal(produced, expected, check_index_type=len(expected) > 0,
+                           check_column_type=len(expected.columns) > 0)
+
+
+def test_dumps_payload():
+    """
+    Places records in a payload and checks it parses to the same payload with the
+    records in place, and is smaller than the records as a string.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_input.json", "r") as file:
+        records = json.dumps(json.load(file))
+
+    payload = {"RuntimeVariables": {"run_id": "bob", "lookups": {0: {"a": "/"}}}}
+    produced = json_functions.dumps_payload(payload, records)
+
+    assert json.loads(produced) == {"RuntimeVariables": {
+        "run_id": "bob", "lookups": {"0": {"a": "/"}}, "data": json.loads(records)}}
+    assert len(produced) < len(json.dumps({"RuntimeVariables": dict(
+        payload["RuntimeVariables"], data=records)}))
+
+    assert json.loads(json_functions.dumps_payload({"RuntimeVariables": {}}, "[]")) \
+        == {"RuntimeVariables": {"data": []}}
+    assert json.loads(json_functions.dumps_payload(payload)) == json.loads(
+        json.dumps(payload))
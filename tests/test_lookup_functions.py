@@ -0,0 +1,319 @@
+import sys
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pytest
+from es_aws_functions import test_generic_library
+from moto import mock_s3
+from pandas.testing import assert_frame_equal
+
+import disk_cache_functions
+import lookup_functions
+
+bucket_name = "test_bucket"
+
+
+@mock_s3
+def test_lookup_cache_hit():
+    """
+    Runs LookupCache.get twice against an unchanged file.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["responder_county_lookup.json"])
+
+    cache = lookup_functions.LookupCache()
+    first = cache.get(bucket_name, "responder_county_lookup")
+    second = cache.get(bucket_name, "responder_county_lookup")
+
+    assert second is first
+    assert cache.stats["misses"] == 1
+    assert cache.stats["hits"] == 1
+    assert cache.stats["bytes_saved"] == cache.stats["bytes_downloaded"]
+
+
+@mock_s3
+def test_lookup_cache_revalidates_changed_file():
+    """
+    Runs LookupCache.get before and after the file in s3 is replaced.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["responder_county_lookup.json"])
+
+    cache = lookup_functions.LookupCache()
+    cache.get(bucket_name, "responder_county_lookup")
+
+    client.put_object(Bucket=bucket_name, Key="responder_county_lookup.json",
+                      Body='[{"responder_id": 1, "county": 2}]')
+    output = cache.get(bucket_name, "responder_county_lookup")
+
+    assert cache.stats["misses"] == 2
+    assert cache.stats["hits"] == 0
+    assert output["responder_id"].tolist() == [1]
+
+
+@mock_s3
+def test_lookup_cache_evicts_least_recently_used():
+    """
+    Runs LookupCache.get with a budget that only fits one of the lookups.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["county_marine_lookup.json",
+                                       "region_lookup.json"])
+
+    cache = lookup_functions.LookupCache()
+    cache.get(bucket_name, "county_marine_lookup")
+    cache.max_bytes = cache.current_bytes
+    cache.get(bucket_name, "region_lookup")
+
+    assert cache.stats["evictions"] == 1
+    assert cache.current_bytes <= cache.max_bytes
+
+    cache.get(bucket_name, "county_marine_lookup")
+    assert cache.stats["misses"] == 3
+
+
+def test_lookup_table_matches_merge():
+    """
+    Runs LookupTable.enrich and compares it with a left merge.
+    :param None
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"responder_id": [666, 123, 8008, 666],
+                         "period": [201809, 201809, 201809, 201812]})
+    lookup = pd.DataFrame({"responder_id": [8008, 666, 1],
+                           "county": [2, 12, 5],
+                           "county_name": ["DURHAM", "LINCOLNSHIRE", "CLEVELAND"]})
+
+    table = lookup_functions.LookupTable(lookup, "responder_id",
+                                         ["responder_id", "county", "county_name"])
+    output = table.enrich(data)
+
+    assert_frame_equal(output, pd.merge(data, lookup, on="responder_id", how="left"))
+    assert "county" not in data.columns
+
+
+def test_lookup_table_duplicate_keys():
+    """
+    Runs LookupTable with a lookup that has a repeated join value.
+    :param None
+    :return Test Pass/Fail
+    """
+    for keys in [[1, 2, 2], ["1", "2", "2"]]:
+        lookup = pd.DataFrame({"county": keys, "region": [1, 1, 2]})
+
+        with pytest.raises(ValueError) as exc_info:
+            lookup_functions.LookupTable(lookup, "county", ["county", "region"],
+                                         "county_marine_lookup")
+
+        assert "duplicate values in join column county" in str(exc_info.value)
+        assert str(keys[1:2]) in str(exc_info.value)
+
+
+@pytest.mark.parametrize("spread", [1, 3, 5])
+def test_direct_index_matches_hashed_index(spread):
+    """
+    Runs LookupTable with dense and sparse integer keys, and compares the
+    positions it finds with those of a hashed index, including for keys of other
+    integer types and keys out of range.
+    :param spread: Gap between lookup keys - Int
+    :return Test Pass/Fail
+    """
+    random = np.random.RandomState(spread)
+    lookup_keys = random.permutation(np.arange(-50, 950) * spread)
+    keys = np.concatenate([random.choice(lookup_keys, 500),
+                           random.randint(-2000 * spread, 2000 * spread, 500),
+                           [np.iinfo(np.int64).min, np.iinfo(np.int64).max]])
+
+    table = lookup_functions.LookupTable(pd.DataFrame({"key": lookup_keys}), "key",
+                                         ["key"])
+    expected = pd.Index(lookup_keys).get_indexer(keys)
+
+    assert (table._direct_index is not None) == \
+        (spread <= lookup_functions.DIRECT_ADDRESS_MAX_SPAN)
+    assert table.positions(pd.Series(keys)).tolist() == expected.tolist()
+    assert table.positions(pd.Series(keys[:500].astype(np.int32))).tolist() == \
+        expected[:500].tolist()
+
+
+@mock_s3
+def test_lookup_cache_reads_only_kept_columns():
+    """
+    Runs LookupCache.get_table for two projections of the same lookup.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["county_marine_lookup.json"])
+
+    cache = lookup_functions.LookupCache()
+    cache.get_table(bucket_name, "county_marine_lookup", "county",
+                    ["county", "marine"])
+    data = cache.get(bucket_name, "county_marine_lookup", columns=["county"])
+
+    assert list(data.columns) == ["county", "marine"]
+    lookup_read = cache.stats["lookups"]["county_marine_lookup"]
+    assert lookup_read["bytes_kept"] < lookup_read["bytes_read"]
+
+    table = cache.get_table(bucket_name, "county_marine_lookup", "county",
+                            ["county", "region"])
+    data = cache.get(bucket_name, "county_marine_lookup", columns=["county"])
+
+    assert table.value_columns == ["region"]
+    assert list(data.columns) == ["county", "marine", "region"]
+    assert cache.stats["misses"] == 2
+    assert cache.stats["hits"] == 2
+
+
+@mock_s3
+def test_lookup_cache_get_tables():
+    """
+    Runs LookupCache.get_tables for lookups from different and shared files.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["responder_county_lookup.json",
+                                       "county_marine_lookup.json"])
+
+    lookups = [
+        {"file_name": "responder_county_lookup", "join_column": "responder_id",
+         "columns_to_keep": ["responder_id", "county"]},
+        {"file_name": "county_marine_lookup", "join_column": "county",
+         "columns_to_keep": ["county", "marine"]},
+        {"file_name": "county_marine_lookup", "join_column": "county",
+         "columns_to_keep": ["county", "region"]},
+    ]
+
+    cache = lookup_functions.LookupCache()
+    tables = cache.get_tables(bucket_name, lookups)
+
+    assert [table.value_columns for table in tables] == \
+        [["county"], ["marine"], ["region"]]
+    assert cache.stats["misses"] == 2
+    assert cache.current_bytes == sum(entry["size"]
+                                      for entry in cache._entries.values())
+
+    assert cache.get_tables(bucket_name, lookups) == tables
+    assert cache.stats["misses"] == 2
+
+
+@mock_s3
+def test_lookup_cache_prefetch_batch():
+    """
+    Prefetches lookups for a batch, and checks each file is read once with the
+    columns of every lookup of it, and that its ETag is only checked once.
+    :param None
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["county_marine_lookup.json"])
+
+    lookups = [
+        {"file_name": "county_marine_lookup", "join_column": "county",
+         "columns_to_keep": ["county", "marine"]},
+        {"file_name": "county_marine_lookup", "join_column": "county",
+         "columns_to_keep": ["county", "region"]},
+        {"file_name": "missing_lookup", "join_column": "county",
+         "columns_to_keep": ["county"]},
+    ]
+
+    cache = lookup_functions.LookupCache()
+    with cache.batch():
+        assert cache.prefetch(bucket_name, lookups) == ["missing_lookup"]
+        first = cache.get_tables(bucket_name, lookups[:2])
+
+        client.put_object(Bucket=bucket_name, Key="county_marine_lookup.json",
+                          Body='[{"county": 1, "marine": "y", "region": "a"}]')
+        assert cache.get_tables(bucket_name, lookups[:2]) == first
+    assert cache.stats["misses"] == 1
+    assert cache.stats["hits"] == 2
+
+    cache.get_tables(bucket_name, lookups[:2])
+    assert cache.stats["misses"] == 2
+
+
+def test_composite_table_matches_sequential_joins():
+    """
+    Runs CompositeTable.enrich and compares it with joining each lookup in turn.
+    :param None
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"responder_id": [666, 123, 8008, 666, 1],
+                         "period": 201809})
+    responder_lookup = pd.DataFrame({"responder_id": [8008, 666, 1],
+                                     "county": [2, 12, 99]})
+    county_lookup = pd.DataFrame({"county": [2, 12], "region": [1, 3]})
+
+    tables = [lookup_functions.LookupTable(responder_lookup, "responder_id",
+                                           ["responder_id", "county"]),
+              lookup_functions.LookupTable(county_lookup, "county",
+                                           ["county", "region"])]
+    composite = lookup_functions.composite_table(tables, "responder_id")
+
+    assert_frame_equal(composite.enrich(data),
+                       tables[1].enrich(tables[0].enrich(data)))
+    # Every row matches, so region stays an integer.
+    matched = data[data["responder_id"].isin([666, 8008])]
+    assert_frame_equal(composite.enrich(matched),
+                       tables[1].enrich(tables[0].enrich(matched)))
+    assert lookup_functions.composite_table(tables, "responder_id") is composite
+
+
+def test_lookup_table_matches_keys_by_value():
+    """
+    Runs LookupTable.enrich with string keys against numeric lookup keys and the
+    other way around.
+    :param None
+    :return Test Pass/Fail
+    """
+    numeric_lookup = pd.DataFrame({"survey": [76, 66], "name": ["sand", "blocks"]})
+    string_lookup = pd.DataFrame({"survey": ["076", "066", "other"],
+                                  "name": ["sand", "blocks", "other"]})
+
+    output = lookup_functions.LookupTable(numeric_lookup, "survey",
+                                          ["survey", "name"]).enrich(
+        pd.DataFrame({"survey": ["076", "066", "141"]}))
+    assert output["name"].tolist()[:2] == ["sand", "blocks"]
+    assert output["survey"].tolist() == ["076", "066", "141"]
+
+    output = lookup_functions.LookupTable(string_lookup, "survey",
+                                          ["survey", "name"]).enrich(
+        pd.DataFrame({"survey": [76, 66, 141]}))
+    assert output["name"].tolist()[:2] == ["sand", "blocks"]
+    assert output["name"].isnull().tolist() == [False, False, True]
+
+
+@mock_s3
+def test_lookup_cache_without_pyarrow(tmp_path):
+    """
+    Runs LookupCache.get with a disk cache where pyarrow is not installed, and
+    checks the disk cache is off and the lookup is read and kept in memory.
+    :param tmp_path: Temporary directory - Path
+    :return Test Pass/Fail
+    """
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["responder_county_lookup.json"])
+
+    with mock.patch.dict(sys.modules, {"pyarrow": None}):
+        disk = disk_cache_functions.DiskCache(str(tmp_path))
+        cache = lookup_functions.LookupCache(disk=disk)
+        first = cache.get(bucket_name, "responder_county_lookup")
+
+    assert not disk.enabled
+    assert cache.get(bucket_name, "responder_county_lookup") is first
+    assert cache.stats["misses"] == 1
+    assert disk._files() == []
@@ -0,0 +1,99 @@
+import json
+
+import numpy as np
+import pytest
+
+import metrics_functions
+
+
+def test_run_metrics_record():
+    """
+    Records two stages, one entered twice, and checks the EMF record.
+    :param None
+    :return Test Pass/Fail
+    """
+    metrics = metrics_functions.RunMetrics("Enrichment - Method", "bob", "BMI_SG")
+
+    for rows in [2, 3]:
+        with metrics.stage("read_input") as stage:
+            stage["rows_out"] = rows
+            stage["bytes_read"] = 10
+    with metrics.stage("join") as stage:
+        stage["rows_in"] = 5
+        stage["unknown"] = 1
+
+    record = metrics.record(success=False)
+
+    assert record["module"] == "Enrichment - Method"
+    assert record["survey"] == "BMI_SG"
+    assert record["run_id"] == "bob"
+    assert not record["success"]
+    assert record["read_input.rows_out"] == 5
+    assert record["read_input.bytes_read"] == 20
+    assert record["join.rows_in"] == 5
+    assert record["join.duration_ms"] >= 0
+    assert record["join.peak_rss_mb"] > 0
+    assert "join.unknown" not in record
+
+    directive = record["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == metrics_functions.NAMESPACE
+    assert directive["Dimensions"] == [["module", "survey"]]
+    names = [metric["Name"] for metric in directive["Metrics"]]
+    assert names == [key for key in record if "." in key]
+    assert {"Name": "read_input.bytes_read", "Unit": "Bytes"} in directive["Metrics"]
+
+
+def test_finish_run(capsys):
+    """
+    Runs a stage through the module functions and checks the emitted log line, and
+    that nothing is emitted when metrics are disabled.
+    :param None
+    :return Test Pass/Fail
+    """
+    metrics_functions.start_run(True, "Enrichment - Wrangler", "bob", "BMI_SG")
+    with metrics_functions.stage("invoke_method") as stage:
+        stage["bytes_written"] = 100
+    metrics_functions.finish_run()
+
+    record = json.loads(capsys.readouterr().out)
+    assert record["success"]
+    assert record["invoke_method.bytes_written"] == 100
+
+    # The run has finished, so later stages are not collected.
+    with metrics_functions.stage("invoke_method") as stage:
+        stage["bytes_written"] = 100
+    metrics_functions.start_run(False, "Enrichment - Wrangler", "bob", "BMI_SG")
+    with metrics_functions.stage("invoke_method") as stage:
+        stage["bytes_written"] = 100
+    metrics_functions.finish_run()
+
+    assert capsys.readouterr().out == ""
+
+
+def test_stage_peak_rss():
+    """
+    Records a stage that allocates a large array, then a smaller stage and a
+    stage holding the large one, and checks each reports the peak while it ran
+    rather than the peak of the process.
+    :param None
+    :return Test Pass/Fail
+    """
+    if not metrics_functions._reset_peak_rss():
+        pytest.skip("The peak RSS can only be reset on Linux.")
+    metrics = metrics_functions.RunMetrics("Enrichment - Method", "bob", "BMI_SG")
+    size_mb = 200
+
+    with metrics.stage("large"):
+        np.ones(size_mb * 1024 * 1024 // 8)
+    with metrics.stage("small"):
+        np.ones(1024)
+    with metrics.stage("outer"):
+        with metrics.stage("inner"):
+            np.ones(size_mb * 1024 * 1024 // 8)
+        np.ones(1024)
+
+    record = metrics.record()
+
+    assert record["small.peak_rss_mb"] < record["large.peak_rss_mb"] - size_mb / 2
+    assert record["inner.peak_rss_mb"] > record["small.peak_rss_mb"] + size_mb / 2
+    assert record["outer.peak_rss_mb"] >= record["inner.peak_rss_mb"]
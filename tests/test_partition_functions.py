@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import partition_functions
+
+
+def test_partition_count():
+    """
+    Runs partition_count with and without a requested number of partitions.
+    :param None
+    :return Test Pass/Fail
+    """
+    assert partition_functions.partition_count(10) == 1
+    assert partition_functions.partition_count(
+        partition_functions.PARTITION_ROWS * 3 + 1) == 4
+    assert partition_functions.partition_count(
+        partition_functions.PARTITION_ROWS * 100) == partition_functions.MAX_PARTITIONS
+    assert partition_functions.partition_count(10, 4) == 4
+    assert partition_functions.partition_count(3, 4) == 3
+    assert partition_functions.partition_count(0, 4) == 1
+
+
+def test_assign_partitions():
+    """
+    Assigns rows to partitions by column and by identifier, and checks values are
+    kept together and spread evenly.
+    :param None
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"responder_id": range(100, 112),
+                         "region": ["A"] * 6 + ["B"] * 3 + ["C"] * 2 + [None]})
+
+    assignment = partition_functions.assign_partitions(data, 2, "region")
+
+    assert list(assignment) == [0] * 6 + [1] * 3 + [1] * 2 + [1]
+
+    assignment = partition_functions.assign_partitions(data, 3,
+                                                       identifier_column="responder_id")
+
+    assert set(assignment) <= {0, 1, 2}
+    np.testing.assert_array_equal(
+        assignment, partition_functions.assign_partitions(
+            data.iloc[::-1], 3, identifier_column="responder_id")[::-1])
+
+
+def test_split_and_merge_partitions():
+    """
+    Splits data into partitions, stands in for the method by numbering anomalies
+    by row, then checks the merge restores the order of the input.
+    :param None
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"responder_id": [7, 3, 5, 1, 9],
+                         "county": [1, 2, None, 4, None]})
+    assignment = np.array([1, 0, 1, 0, 0])
+
+    partitions = partition_functions.split_partitions(data, assignment)
+
+    assert [list(partition["responder_id"]) for partition in partitions] == \
+        [[3, 1, 9], [7, 5]]
+
+    anomaly_partitions = []
+    for partition in partitions:
+        missing = partition[partition["county"].isnull()]
+        anomaly_partitions.append(pd.DataFrame({
+            partition_functions.ROW_NUMBER_COLUMN: list(
+                missing[partition_functions.ROW_NUMBER_COLUMN]) * 2,
+            "issue": ["first"] * len(missing) + ["second"] * len(missing)}))
+
+    merged, anomalies = partition_functions.merge_partitions(
+        partitions, anomaly_partitions, data["responder_id"].to_numpy(),
+        "responder_id")
+
+    assert_frame_equal(merged, data)
+    assert_frame_equal(anomalies, pd.DataFrame({
+        "responder_id": [5, 5, 9, 9], "issue": ["first", "second"] * 2}))
@@ -0,0 +1,81 @@
+import pytest
+
+import plan_functions
+
+lookups = {
+    0: {"file_name": "responder_county_lookup",
+        "columns_to_keep": ["responder_id", "county"],
+        "join_column": "responder_id"},
+    1: {"file_name": "county_marine_lookup",
+        "columns_to_keep": ["county_name", "region", "county", "marine"],
+        "join_column": "county"},
+    2: {"file_name": "region_lookup",
+        "columns_to_keep": ["gor_code", "region_name"],
+        "join_column": "gor_code"}
+}
+
+input_columns = ["responder_id", "gor_code", "period", "survey"]
+
+
+def test_build_join_plan():
+    """
+    Runs build_join_plan for a chain of lookups and an independent lookup.
+    :param None
+    :return Test Pass/Fail
+    """
+    join_plan = plan_functions.build_join_plan(lookups, input_columns)
+
+    assert join_plan["steps"] == [
+        {"join_column": "responder_id", "lookups": [0, 1], "fused": True},
+        {"join_column": "gor_code", "lookups": [2], "fused": False}]
+    assert join_plan["columns"] == ["county", "county_name", "region", "marine",
+                                    "region_name"]
+
+
+def test_build_join_plan_orders_dependencies():
+    """
+    Runs build_join_plan where a lookup comes before the one it joins on.
+    :param None
+    :return Test Pass/Fail
+    """
+    reordered = {0: lookups[1], 1: lookups[0]}
+
+    join_plan = plan_functions.build_join_plan(reordered, input_columns)
+
+    assert join_plan["steps"] == [
+        {"join_column": "responder_id", "lookups": [1, 0], "fused": True}]
+    assert join_plan["columns"] == ["county_name", "region", "marine", "county"]
+
+
+def test_build_join_plan_clashing_columns():
+    """
+    Runs build_join_plan with a lookup adding a column already in the input.
+    :param None
+    :return Test Pass/Fail
+    """
+    join_plan = plan_functions.build_join_plan(lookups, input_columns + ["region"])
+
+    assert [step["lookups"] for step in join_plan["steps"]] == [[0], [1], [2]]
+    assert not any(step["fused"] for step in join_plan["steps"])
+    assert join_plan["columns"] is None
+
+
+@pytest.mark.parametrize(
+    "bad_lookups,expected_message",
+    [
+        ({0: lookups[1]}, "Lookup 0 joins on county which is not in the input data"),
+        ({0: {"file_name": "a", "columns_to_keep": ["x", "y"], "join_column": "x"},
+          1: {"file_name": "b", "columns_to_keep": ["y", "x"], "join_column": "y"}},
+         "Lookups [0, 1] depend on each other")
+    ])
+def test_build_join_plan_invalid(bad_lookups, expected_message):
+    """
+    Runs build_join_plan with lookups whose join columns will not exist.
+    :param bad_lookups: Lookups to plan - Type: Dict
+    :param expected_message: Start of the error message - Type: String
+    :return Test Pass/Fail
+    """
+    with pytest.raises(ValueError) as exc_info:
+        plan_functions.build_join_plan(bad_lookups, input_columns)
+
+    assert expected_message in str(exc_info.value)
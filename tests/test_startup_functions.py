@@ -0,0 +1,83 @@
+from unittest import mock
+
+import pytest
+from marshmallow import Schema, ValidationError, fields
+
+import startup_functions
+
+
+class EnvironmentSchema(Schema):
+    loads = 0
+
+    bucket_name = fields.Str(required=True)
+    chunk_size = fields.Int(missing=10)
+
+    def load(self, *args, **kwargs):
+        EnvironmentSchema.loads += 1
+        return super().load(*args, **kwargs)
+
+
+def test_client():
+    """
+    Gets clients and checks each service's client is only made once.
+    :param None
+    :return Test Pass/Fail
+    """
+    with mock.patch("startup_functions.boto3.client",
+                    side_effect=lambda service, **kwargs: mock.Mock()) as mock_client:
+        s3 = startup_functions.client("s3")
+
+        assert startup_functions.client("s3") is s3
+        assert startup_functions.client("lambda") is not s3
+        assert mock_client.call_count == 2
+
+        startup_functions.reset()
+
+        assert startup_functions.client("s3") is not s3
+
+
+def test_load_environment():
+    """
+    Loads environment variables and checks they are only validated again when
+    they change.
+    :param None
+    :return Test Pass/Fail
+    """
+    EnvironmentSchema.loads = 0
+    environ = {"bucket_name": "test_bucket"}
+
+    environment_variables = startup_functions.load_environment(EnvironmentSchema,
+                                                               environ)
+    environment_variables["bucket_name"] = "changed"
+
+    assert startup_functions.load_environment(EnvironmentSchema, environ) == \
+        {"bucket_name": "test_bucket", "chunk_size": 10}
+    assert EnvironmentSchema.loads == 1
+
+    environ["chunk_size"] = "20"
+    assert startup_functions.load_environment(EnvironmentSchema,
+                                              environ)["chunk_size"] == 20
+    assert EnvironmentSchema.loads == 2
+
+    environ["chunk_size"] = "twenty"
+    with pytest.raises(ValidationError):
+        startup_functions.load_environment(EnvironmentSchema, environ)
+    assert EnvironmentSchema.loads == 3
+
+
+def test_load_environment_ignores_undeclared():
+    """
+    Loads environment variables with one the schema does not declare changing
+    between calls, as the trace id does on every invocation, and checks they are
+    only validated once.
+    :param None
+    :return Test Pass/Fail
+    """
+    EnvironmentSchema.loads = 0
+    environ = {"bucket_name": "test_bucket", "_X_AMZN_TRACE_ID": "Root=1-a"}
+
+    first = startup_functions.load_environment(EnvironmentSchema, environ)
+    environ["_X_AMZN_TRACE_ID"] = "Root=1-b"
+
+    assert startup_functions.load_environment(EnvironmentSchema, environ) == first
+    assert EnvironmentSchema.loads == 1